@@ -2,17 +2,47 @@ import os
 import json
 import uuid
 import shutil
-from flask import Flask, request, render_template, send_from_directory, jsonify, redirect, url_for
+from flask import Flask, Request, Response, request, render_template, jsonify, redirect, url_for, g
 from werkzeug.utils import secure_filename
 import datetime
 import hashlib
+import io
+import mimetypes
+import unicodedata
+import urllib.parse
+import hmac
+import base64
+import secrets
+import struct
+import zlib
 import random
 import string
 import sys
+import sqlite3
+import threading
+import contextlib
+import functools
+import collections
+import atexit
+import tempfile
+import heapq
+import time
+import concurrent.futures
+import multiprocessing
+import socket
 
 # 解决大文件上传413错误
 import werkzeug.formparser
 
+import assets
+import cluster
+import compression
+import events
+import metrics
+import scanner
+import transfers
+from scanner import HEADER_SNIFF_BYTES, check_file_header, check_extension_matches
+
 # 加载配置文件
 CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.json')
 try:
@@ -23,10 +53,16 @@ except (FileNotFoundError, json.JSONDecodeError) as e:
     print(f"配置文件错误: {e}")
     print("使用默认配置")
     config = {
-        "server": {"host": "0.0.0.0", "port": 5000, "debug": True},
-        "file_limits": {"max_file_size_mb": 16384, "max_group_size_mb": 32768, "max_files_per_group": 100, "total_storage_limit_gb": 100},
-        "time_limits": {"min_expiry_minutes": 1, "max_expiry_days": 10, "default_expiry_minutes": 10},
+        "server": {"host": "0.0.0.0", "port": 5000, "debug": True, "workers": 4, "threads": 8, "io_threads": 32},
+        "file_limits": {"max_file_size_mb": 16384, "max_group_size_mb": 32768, "max_files_per_group": 100, "total_storage_limit_gb": 100, "usage_rescan_minutes": 60, "chunk_size_mb": 8, "upload_session_timeout_minutes": 60},
+        "time_limits": {"min_expiry_minutes": 1, "max_expiry_days": 10, "default_expiry_minutes": 10, "download_token_hours": 24},
         "pickup_code": {"length_min": 6, "length_max": 10, "default_length": 6},
+        "storage": {"deduplicate": False, "instant_upload": True, "download_history_limit": 100, "trash_rate_mb": 0, "trash_batch_files": 100},
+        "metrics": {"enabled": True, "slow_request_ms": 0, "profile_interval_ms": 5},
+        "reconcile": {"interval_hours": 24, "workers": 4, "batch_size": 500, "orphans": "quarantine"},
+        "compression": {"enabled": False, "codec": "auto", "level": 6, "max_ratio": 0.9, "frame_kb": 1024},
+        "transfers": {"global_rate_mb": 0, "client_rate_mb": 0, "group_rate_mb": 0, "max_connections_per_client": 0, "burst_seconds": 1},
+        "cluster": {"enabled": False, "node_id": "", "url": "", "metadata_db": "", "forward": "redirect", "heartbeat_seconds": 10, "node_timeout_seconds": 30, "rebalance_margin": 0.1},
         "security": {
             "allowed_extensions": ["txt", "pdf", "png", "jpg", "jpeg", "gif", "doc", "docx", "xls", "xlsx", "ppt", "pptx", "zip", "rar", "7z", "mp3", "mp4", "avi", "mov"],
             "forbidden_extensions": ["php", "exe", "bat", "cmd", "sh", "js", "vbs", "py"]
@@ -37,115 +73,1257 @@ except (FileNotFoundError, json.JSONDecodeError) as e:
 max_size_bytes = config["file_limits"]["max_file_size_mb"] * 1024 * 1024
 werkzeug.formparser.default_max_form_memory_size = max_size_bytes
 
-app = Flask(__name__)
+# 静态文件由资源管道处理（带指纹的地址、预压缩和长期缓存）
+app = Flask(__name__, static_folder=None)
 
 # 配置
 UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'files')
 DATA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'file_data.json')
+DB_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'file_data.db')
+UPLOAD_SESSION_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'upload_sessions')
+# 内容寻址存储目录，按SHA-256前两级分片
+BLOB_FOLDER = os.path.join(UPLOAD_FOLDER, 'blobs')
+# 删除队列：待删除的目录和文件先原子地重命名到回收目录（与上传目录在同一文件系统上，不复制数据），由后台线程分批删除
+TRASH_FOLDER = os.path.join(UPLOAD_FOLDER, '.trash')
+TRASH_BATCH_FILES = config.get("storage", {}).get("trash_batch_files", 100)
+# 删除速度上限（每秒字节数），0 为不限制；限速时每删除一个文件按其大小等待，不截短文件
+TRASH_RATE_BYTES = int(config.get("storage", {}).get("trash_rate_mb", 0) * 1024 * 1024)
+# 多进程部署时其他进程放入回收目录的内容由维护进程定期处理
+TRASH_POLL_SECONDS = 10
+DEDUP_ENABLED = config.get("storage", {}).get("deduplicate", False)
+# 秒传只校验两个随机分块，知道文件哈希并拿到抽样分块内容的人即可引用整个文件；对上传者互不信任的部署可关闭
+INSTANT_UPLOAD_ENABLED = DEDUP_ENABLED and config.get("storage", {}).get("instant_upload", True)
 ALLOWED_EXTENSIONS = set(config["security"]["allowed_extensions"])
 FORBIDDEN_EXTENSIONS = set(config["security"]["forbidden_extensions"])
 MAX_CONTENT_LENGTH = max_size_bytes
+UPLOAD_CHUNK_SIZE = config["file_limits"].get("chunk_size_mb", 8) * 1024 * 1024
+UPLOAD_SESSION_TIMEOUT = config["file_limits"].get("upload_session_timeout_minutes", 60)
+# 下载令牌的有效期（秒），不会超过文件组本身的过期时间
+DOWNLOAD_TOKEN_TTL = config["time_limits"].get("download_token_hours", 24) * 3600
+DOWNLOAD_TOKEN_CACHE_SIZE = 1024
+# 每个文件组只保留最近的下载记录，更早的记录只计入按文件汇总的统计
+DOWNLOAD_HISTORY_LIMIT = config.get("storage", {}).get("download_history_limit", 100)
+# 同一客户端在该时间内重复下载只计一次
+DOWNLOAD_DEDUP_SECONDS = 300
+# 下载事件批量写入数据库的间隔和批量大小
+DOWNLOAD_FLUSH_SECONDS = 2
+DOWNLOAD_FLUSH_BATCH = 500
+# 运行指标（/metrics）；多进程部署时各进程定期把快照写入 METRICS_FOLDER，读取时合并
+METRICS_CONFIG = config.get("metrics", {})
+METRICS_ENABLED = METRICS_CONFIG.get("enabled", True)
+METRICS_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'metrics')
+METRICS_WRITE_SECONDS = 5
+# 处理时间超过该值（毫秒）的请求把采样到的调用栈写入 PROFILE_FOLDER，0 表示不采样
+SLOW_REQUEST_MS = METRICS_CONFIG.get("slow_request_ms", 0)
+PROFILE_INTERVAL = METRICS_CONFIG.get("profile_interval_ms", 5) / 1000
+PROFILE_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'profiles')
+
+# 管理页面实时更新：心跳间隔，多进程部署时其他进程中的变化在心跳时从数据库核对
+EVENT_HEARTBEAT_SECONDS = 15
+# 每个进程同时打开的实时更新连接上限，None 为不限制；生产模式下每个连接占用一个工作线程，启动时按线程数设置
+EVENT_STREAM_LIMIT = None
+
+# 压缩存储（可选）：安全检查通过后在检查进程池中压缩值得压缩的文件，去重存储的blob不压缩
+COMPRESSION_CONFIG = config.get("compression", {})
+COMPRESSION_ENABLED = COMPRESSION_CONFIG.get("enabled", False)
+COMPRESSION_OPTIONS = {
+    'codec': COMPRESSION_CONFIG.get("codec", "auto"),
+    'level': COMPRESSION_CONFIG.get("level", 6),
+    # 压缩后大小超过原大小的该比例时不压缩
+    'max_ratio': COMPRESSION_CONFIG.get("max_ratio", 0.9),
+    # 每帧的原始大小，Range请求最多需要多解压一帧
+    'frame_size': COMPRESSION_CONFIG.get("frame_kb", 1024) * 1024,
+}
+
+# 传输整形：按客户端、文件组和全局限速（MB/秒，0 为不限制，上传和下载分别计算），限制每个客户端同时进行的传输数
+TRANSFER_CONFIG = config.get("transfers", {})
+# 异步服务器（asgi.py）在环境中设置这些键：不在线程中等待限速；请求体已在接收时限速
+ASYNC_THROTTLE_KEY = 'file_share.async_throttle'
+BODY_THROTTLED_KEY = 'file_share.body_throttled'
+TRANSFER_KEY = 'file_share.transfer'
+
+# 集群模式：多个节点共用元数据目录（所有节点都能访问的 SQLite 文件），文件组分布存储在各节点
+CLUSTER_CONFIG = config.get("cluster", {})
+CLUSTER_ENABLED = CLUSTER_CONFIG.get("enabled", False)
+NODE_ID = CLUSTER_CONFIG.get("node_id") or f'{socket.gethostname()}-{config["server"]["port"]}'
+# 其他节点和浏览器访问本节点的地址
+NODE_URL = (CLUSTER_CONFIG.get("url") or f'http://127.0.0.1:{config["server"]["port"]}').rstrip('/')
+CLUSTER_DB = os.path.join(os.path.dirname(os.path.abspath(__file__)), CLUSTER_CONFIG.get("metadata_db") or 'cluster.db')
+# 其他节点上的文件组：redirect 让浏览器直接访问所在节点下载，proxy 由本节点转发
+CLUSTER_FORWARD = CLUSTER_CONFIG.get("forward", "redirect")
+HEARTBEAT_SECONDS = CLUSTER_CONFIG.get("heartbeat_seconds", 10)
+NODE_TIMEOUT = CLUSTER_CONFIG.get("node_timeout_seconds", 30)
+# 节点的用量比例高出集群平均值超过该值时，把部分文件组移到其他节点
+REBALANCE_MARGIN = CLUSTER_CONFIG.get("rebalance_margin", 0.1)
+NODE_STARTED_AT = datetime.datetime.now().isoformat()
+
+# 一致性检查：在后台分批核对元数据与上传目录，进度保存在数据库中，重启后从上次的批次继续
+RECONCILE_CONFIG = config.get("reconcile", {})
+# 两次完整检查的间隔，0 表示只通过命令行运行
+RECONCILE_INTERVAL = RECONCILE_CONFIG.get("interval_hours", 24) * 3600
+RECONCILE_WORKERS = RECONCILE_CONFIG.get("workers", 4)
+RECONCILE_BATCH = RECONCILE_CONFIG.get("batch_size", 500)
+# 没有元数据的文件组目录：quarantine 移到隔离目录，adopt 为其创建新的文件组
+RECONCILE_ORPHANS = RECONCILE_CONFIG.get("orphans", "quarantine")
+# 启动后等待一段时间再开始，不和启动时的请求争抢磁盘
+RECONCILE_START_DELAY = 30
+QUARANTINE_FOLDER = os.path.join(UPLOAD_FOLDER, '.quarantine')
+# 上传中的文件先写入文件组目录再创建记录，最近修改过的内容不视为孤立
+ORPHAN_GRACE_SECONDS = UPLOAD_SESSION_TIMEOUT * 60
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = MAX_CONTENT_LENGTH
 
-# 工具函数
-def load_data():
+# 静态资源：启动时生成带指纹的文件名和压缩版本，调试服务器下文件修改后自动重新生成
+STATIC_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+STATIC_IMMUTABLE_CACHE = 'public, max-age=31536000, immutable'
+_assets = assets.AssetPipeline(STATIC_FOLDER)
+_pages = assets.PageCache()
+
+@app.template_global()
+def asset_url(path):
+    """模板中引用静态文件：返回带内容指纹的地址"""
+    return '/static/' + _assets.url_path(path)
+
+# 元数据存储（SQLite WAL模式，按记录更新，读写互不阻塞）
+_db_local = threading.local()
+_db_init_lock = threading.Lock()
+_db_initialized = False
+
+# 下载计数与去重窗口（内存中），下载记录先进入队列再批量写入数据库
+_download_lock = threading.Lock()
+_download_cond = threading.Condition(_download_lock)
+_download_flush_lock = threading.Lock()
+_download_limits = {}  # 文件组ID -> 下载上限（None 表示不限制）
+_pending_counts = {}  # 不限次数的文件组尚未写入数据库的下载次数
+_recent_clients = collections.OrderedDict()  # (文件组ID, 客户端) -> 最近一次计数的时间，按时间排序
+_download_events = []
+_download_writer_started = False
+
+METRICS = metrics.Registry()
+HTTP_REQUESTS = METRICS.counter('file_share_http_requests_total', '按路由统计的请求数', ('route', 'method', 'status'))
+HTTP_LATENCY = METRICS.histogram('file_share_http_request_duration_seconds',
+                                 '请求处理时间（到开始发送响应体为止）', ('route',))
+UPLOADED_BYTES = METRICS.counter('file_share_uploaded_bytes_total', '接收的上传字节数')
+DOWNLOADED_BYTES = METRICS.counter('file_share_downloaded_bytes_total', '发送的下载字节数')
+ACTIVE_TRANSFERS = METRICS.gauge('file_share_active_transfers', '正在进行的上传和下载', ('direction',))
+CLIENT_TRANSFERS = METRICS.gauge('file_share_client_transfers', '各客户端正在进行的传输数', ('client', 'direction'))
+CLIENT_TRANSFER_RATE = METRICS.gauge('file_share_client_transfer_rate_bytes',
+                                     f'各客户端最近{transfers.RATE_WINDOW_SECONDS}秒的平均传输速率（字节/秒）',
+                                     ('client', 'direction'))
+OPERATION_SECONDS = METRICS.histogram('file_share_operation_duration_seconds',
+                                      '元数据读写、过期清理和安全检查的耗时', ('operation',))
+COMPRESSION_SAVED_BYTES = METRICS.counter('file_share_compression_saved_bytes_total', '压缩存储节省的字节数')
+GROUPS_REMOVED = METRICS.counter('file_share_groups_removed_total', '删除的文件组（过期、手动删除、未通过安全检查）',
+                                 ('reason',))
+EVENT_STREAMS = METRICS.gauge('file_share_event_streams', '打开的管理页面实时更新连接')
+_metrics_store = metrics.SnapshotStore(METRICS_FOLDER)
+_metrics_writer_lock = threading.Lock()
+_metrics_writer_started = False
+_profiler = metrics.SamplingProfiler(PROFILE_INTERVAL) if SLOW_REQUEST_MS else None
+
+# 文件组事件（下载、检查结果、删除），推送给本进程中打开的管理页面
+_group_events = events.EventBus(history=DOWNLOAD_HISTORY_LIMIT)
+_event_stream_lock = threading.Lock()
+_event_stream_count = 0
+
+# 上传下载的带宽整形和并发限制
+_transfers = transfers.TransferScheduler()
+
+# 集群目录，未启用集群模式时为 None
+_catalog = cluster.Catalog(CLUSTER_DB, NODE_TIMEOUT) if CLUSTER_ENABLED else None
+
+def configure_transfers(processes=1):
+    # 每个进程分别限速，多进程部署时速率上限按进程数平分；并发传输数按进程计算
+    mb = 1024 * 1024
+    _transfers.configure(global_rate=TRANSFER_CONFIG.get("global_rate_mb", 0) * mb / processes,
+                         client_rate=TRANSFER_CONFIG.get("client_rate_mb", 0) * mb / processes,
+                         group_rate=TRANSFER_CONFIG.get("group_rate_mb", 0) * mb / processes,
+                         max_connections=TRANSFER_CONFIG.get("max_connections_per_client", 0),
+                         burst_seconds=TRANSFER_CONFIG.get("burst_seconds", 1))
+
+configure_transfers()
+
+GROUP_COLUMNS = ('pickup_code', 'files', 'created_at', 'expiry_date', 'max_downloads',
+                 'download_count', 'total_size', 'status', 'scan_error', 'missing_files', 'token_generation')
+
+def _connect():
+    conn = sqlite3.connect(DB_FILE, timeout=30, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA busy_timeout=30000')
+    return conn
+
+def init_db():
+    """创建数据表，并在首次启动时从旧的 file_data.json 迁移数据"""
+    global _db_initialized
+    with _db_init_lock:
+        if _db_initialized:
+            return
+        conn = _connect()
+        with conn:
+            conn.executescript('''
+                CREATE TABLE IF NOT EXISTS counters (
+                    name TEXT PRIMARY KEY,
+                    value INTEGER NOT NULL DEFAULT 0
+                );
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY,
+                    value TEXT
+                );
+                CREATE TABLE IF NOT EXISTS file_groups (
+                    id TEXT PRIMARY KEY,
+                    pickup_code TEXT NOT NULL,
+                    files TEXT NOT NULL,
+                    created_at TEXT NOT NULL,
+                    expiry_date TEXT,
+                    max_downloads INTEGER,
+                    download_count INTEGER NOT NULL DEFAULT 0,
+                    total_size INTEGER NOT NULL DEFAULT 0,
+                    download_token TEXT,
+                    token_created TEXT,
+                    status TEXT NOT NULL DEFAULT 'ready',
+                    scan_error TEXT,
+                    scan_pid INTEGER
+                );
+                DROP INDEX IF EXISTS idx_file_groups_code;
+                CREATE UNIQUE INDEX IF NOT EXISTS idx_file_groups_pickup_code ON file_groups(pickup_code);
+                CREATE INDEX IF NOT EXISTS idx_file_groups_expiry ON file_groups(expiry_date);
+                CREATE TABLE IF NOT EXISTS download_history (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    group_id TEXT NOT NULL,
+                    filename TEXT,
+                    time TEXT,
+                    ip TEXT
+                );
+                CREATE INDEX IF NOT EXISTS idx_download_history_group ON download_history(group_id);
+                CREATE TABLE IF NOT EXISTS blobs (
+                    sha256 TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    refcount INTEGER NOT NULL DEFAULT 0,
+                    crc32 INTEGER
+                );
+                CREATE TABLE IF NOT EXISTS upload_sessions (
+                    id TEXT PRIMARY KEY,
+                    files TEXT NOT NULL,
+                    chunk_size INTEGER NOT NULL,
+                    total_size INTEGER NOT NULL,
+                    expiry_unit TEXT,
+                    expiry_value INTEGER,
+                    max_downloads INTEGER,
+                    created_at TEXT NOT NULL,
+                    updated_at TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS upload_chunks (
+                    upload_id TEXT NOT NULL,
+                    file_index INTEGER NOT NULL,
+                    chunk_index INTEGER NOT NULL,
+                    PRIMARY KEY (upload_id, file_index, chunk_index)
+                );
+                CREATE TABLE IF NOT EXISTS download_summary (
+                    group_id TEXT NOT NULL,
+                    filename TEXT NOT NULL,
+                    count INTEGER NOT NULL DEFAULT 0,
+                    last_time TEXT,
+                    PRIMARY KEY (group_id, filename)
+                );
+                DROP TABLE IF EXISTS recent_downloads;
+                CREATE TABLE IF NOT EXISTS storage_reservations (
+                    id TEXT PRIMARY KEY,
+                    bytes INTEGER NOT NULL,
+                    pid INTEGER NOT NULL,
+                    created_at TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS frame_index (
+                    group_id TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    offsets BLOB NOT NULL,
+                    PRIMARY KEY (group_id, name)
+                );
+                CREATE TABLE IF NOT EXISTS trash (
+                    name TEXT PRIMARY KEY,
+                    source TEXT NOT NULL,
+                    bytes INTEGER NOT NULL,
+                    created_at TEXT NOT NULL
+                );
+            ''')
+        _ensure_column(conn, 'blobs', 'crc32', 'INTEGER')
+        # 安全检查状态：scanning（检查中，不能取件）、ready、rejected
+        _ensure_column(conn, 'file_groups', 'status', "TEXT NOT NULL DEFAULT 'ready'")
+        _ensure_column(conn, 'file_groups', 'scan_error', 'TEXT')
+        _ensure_column(conn, 'file_groups', 'scan_pid', 'INTEGER')
+        # 一致性检查发现磁盘上缺失或大小不符的文件名（JSON列表），没有问题时为 NULL
+        _ensure_column(conn, 'file_groups', 'missing_files', 'TEXT')
+        # 下载令牌的代数，写入令牌中；增加后已发出的令牌在所有进程和节点上同时失效
+        _ensure_column(conn, 'file_groups', 'token_generation', 'INTEGER NOT NULL DEFAULT 0')
+        with conn:
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_file_groups_scanning ON file_groups(status) "
+                         "WHERE status = 'scanning'")
+        build_download_summary(conn)
+        migrate_json_data(conn)
+        with conn:
+            # 首次启动时用元数据估算存储用量，之后由后台扫描校准
+            conn.execute("INSERT OR IGNORE INTO counters VALUES ('storage_used_bytes', "
+                         "(SELECT COALESCE(SUM(total_size), 0) FROM file_groups))")
+            conn.execute("INSERT OR IGNORE INTO counters VALUES ('logical_bytes', "
+                         "(SELECT COALESCE(SUM(total_size), 0) FROM file_groups))")
+            # 文件组和文件数量，之后随创建和删除增量维护
+            conn.execute("INSERT OR IGNORE INTO counters VALUES ('group_count', (SELECT COUNT(*) FROM file_groups))")
+            if conn.execute("SELECT 1 FROM counters WHERE name = 'file_count'").fetchone() is None:
+                file_count = sum(len(json.loads(row['files'])) for row in conn.execute('SELECT files FROM file_groups'))
+                conn.execute("INSERT INTO counters VALUES ('file_count', ?)", (file_count,))
+        conn.close()
+        _db_initialized = True
+
+def _ensure_column(conn, table, column, declaration):
+    # 为旧版本创建的数据表补充新增的列
+    columns = [row['name'] for row in conn.execute(f'PRAGMA table_info({table})')]
+    if column not in columns:
+        with conn:
+            conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {declaration}')
+
+def build_download_summary(conn):
+    """一次性为已有的下载记录生成汇总统计，并把每个文件组的记录裁剪到保留条数"""
+    if conn.execute("SELECT 1 FROM meta WHERE key = 'download_summary_built'").fetchone():
+        return
+    with immediate_transaction(conn):
+        # 多个进程同时启动时只有一个执行
+        if conn.execute("SELECT 1 FROM meta WHERE key = 'download_summary_built'").fetchone():
+            return
+        conn.execute('INSERT OR IGNORE INTO download_summary (group_id, filename, count, last_time) '
+                     'SELECT group_id, COALESCE(filename, \'\'), COUNT(*), MAX(time) FROM download_history '
+                     'GROUP BY group_id, COALESCE(filename, \'\')')
+        group_ids = [row['group_id'] for row in conn.execute('SELECT DISTINCT group_id FROM download_history')]
+        _trim_download_history(conn, group_ids)
+        conn.execute("INSERT OR REPLACE INTO meta VALUES ('download_summary_built', ?)",
+                     (datetime.datetime.now().isoformat(),))
+
+def migrate_json_data(conn):
+    """一次性把 file_data.json 中的文件组导入数据库，原文件保留作为备份"""
+    if conn.execute("SELECT 1 FROM meta WHERE key = 'json_migrated'").fetchone():
+        return
+    groups = {}
     if os.path.exists(DATA_FILE):
-        with open(DATA_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    return {"file_groups": {}}
+        try:
+            with open(DATA_FILE, 'r', encoding='utf-8') as f:
+                groups = json.load(f).get("file_groups", {})
+        except (OSError, json.JSONDecodeError) as e:
+            print(f"旧数据文件读取失败，跳过迁移: {e}")
+    with immediate_transaction(conn):
+        # 多个进程同时启动时只有一个执行迁移
+        if conn.execute("SELECT 1 FROM meta WHERE key = 'json_migrated'").fetchone():
+            return
+        for file_group_id, info in groups.items():
+            try:
+                _insert_group(conn, file_group_id, info)
+            except sqlite3.IntegrityError:
+                # 旧数据没有保证取件码唯一，重复的取件码重新分配
+                info = dict(info, pickup_code=generate_pickup_code(conn=conn))
+                _insert_group(conn, file_group_id, info)
+                print(f"文件组 {file_group_id} 的取件码重复，已重新分配为 {info['pickup_code']}")
+            # 旧的 recent_downloads 只用于5分钟内去重，不再迁移
+            _append_download_history(conn, [
+                (file_group_id, item.get('filename'), item.get('time'), item.get('ip'))
+                for item in info.get('download_history', [])
+            ])
+        conn.execute("INSERT OR REPLACE INTO meta VALUES ('json_migrated', ?)",
+                     (datetime.datetime.now().isoformat(),))
+    if groups:
+        print(f"已从 {os.path.basename(DATA_FILE)} 迁移 {len(groups)} 个文件组")
+
+def get_db():
+    # 每个线程使用独立的数据库连接
+    conn = getattr(_db_local, 'conn', None)
+    if conn is None:
+        init_db()
+        conn = _connect()
+        _db_local.conn = conn
+    return conn
+
+def _insert_group(conn, file_group_id, info):
+    conn.execute(
+        'INSERT INTO file_groups (id, pickup_code, files, created_at, expiry_date, max_downloads, '
+        'download_count, total_size, download_token, token_created, status, scan_pid, token_generation) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+        (file_group_id, info['pickup_code'], json.dumps(info.get('files', []), ensure_ascii=False),
+         info.get('created_at') or datetime.datetime.now().isoformat(), info.get('expiry_date'),
+         info.get('max_downloads'), info.get('download_count', 0), info.get('total_size', 0),
+         info.get('download_token'), info.get('token_created'), info.get('status', 'ready'),
+         info.get('scan_pid'), info.get('token_generation', 0)))
+
+@contextlib.contextmanager
+def immediate_transaction(conn):
+    # 立即获取写锁的事务，用于需要和文件系统操作串行化的更新
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    else:
+        conn.commit()
+
+def _physical_size(files):
+    # 存放在文件组目录中的字节数（引用blob的文件不占用文件组目录，压缩存储的文件按压缩后的大小）
+    return sum(file.get('stored_size', file.get('size', 0)) for file in files if not file.get('blob'))
+
+@OPERATION_SECONDS.time(operation='save_group')
+def create_group_record(file_group_id, info):
+    """写入新文件组；取件码冲突时（并发上传抢到同一个码）重新生成后重试"""
+    conn = get_db()
+    while True:
+        # 集群模式下先在目录中登记，取件码在所有节点中唯一
+        if _catalog is not None and not _catalog.register_group(file_group_id, info['pickup_code'], NODE_ID,
+                                                                info.get('created_at')):
+            info['pickup_code'] = generate_pickup_code()
+            continue
+        try:
+            with conn:
+                _insert_group(conn, file_group_id, info)
+                _add_storage_usage(conn, _physical_size(info.get('files', [])))
+                _add_storage_usage(conn, info.get('total_size', 0), 'logical_bytes')
+                _add_storage_usage(conn, 1, 'group_count')
+                _add_storage_usage(conn, len(info.get('files', [])), 'file_count')
+            return info['pickup_code']
+        except sqlite3.IntegrityError:
+            if _catalog is not None:
+                _catalog.remove_group(file_group_id, NODE_ID)
+            if find_group_id_by_code(info['pickup_code']) is None:
+                raise
+            info['pickup_code'] = generate_pickup_code()
+
+@OPERATION_SECONDS.time(operation='load_group')
+def get_group_record(file_group_id, with_history=True):
+    # 按ID读取文件组，返回与旧JSON结构一致的字典
+    if with_history:
+        # 下载记录是批量写入的，读取前先把排队中的事件写入
+        flush_download_events()
+    conn = get_db()
+    row = conn.execute('SELECT * FROM file_groups WHERE id = ?', (file_group_id,)).fetchone()
+    if row is None:
+        return None
+    info = {key: row[key] for key in GROUP_COLUMNS}
+    info['files'] = json.loads(row['files'])
+    info['missing_files'] = json.loads(row['missing_files']) if row['missing_files'] else []
+    with _download_lock:
+        # 加上本进程中尚未写入数据库的下载
+        info['download_count'] += _pending_counts.get(file_group_id, 0)
+    if with_history:
+        info['download_history'] = [
+            {'filename': r['filename'], 'time': r['time'], 'ip': r['ip']}
+            for r in conn.execute('SELECT filename, time, ip FROM download_history WHERE group_id = ? ORDER BY id',
+                                  (file_group_id,))
+        ]
+        info['download_summary'] = [
+            {'filename': r['filename'], 'count': r['count'], 'last_time': r['last_time']}
+            for r in conn.execute('SELECT filename, count, last_time FROM download_summary WHERE group_id = ? '
+                                  'ORDER BY count DESC, filename', (file_group_id,))
+        ]
+    return info
+
+@OPERATION_SECONDS.time(operation='find_pickup_code')
+def find_group_id_by_code(pickup_code, conn=None):
+    # 取件码唯一索引查询，耗时与文件组数量无关
+    row = (conn or get_db()).execute('SELECT id FROM file_groups WHERE pickup_code = ?', (pickup_code,)).fetchone()
+    return row['id'] if row else None
+
+class DownloadLimitReached(Exception):
+    """文件组已达下载上限或已不存在"""
+
+def record_download(file_group_id, client_id, filename, ip):
+    """
+    记录一次下载，同一客户端在 DOWNLOAD_DEDUP_SECONDS 内只计一次
+    返回 (状态, 下载次数)，状态为 'recorded'、'duplicate' 或 'limit'（已达下载上限，拒绝下载）；
+    下载次数只对设置了下载上限的文件组返回
+    有下载上限的文件组在数据库中原子计数（多进程部署时也不会超出上限），
+    其余文件组只在内存中计数；下载记录排队后由后台线程批量写入数据库
+    """
+    now = time.monotonic()
+    key = (file_group_id, client_id)
+    # 锁只保护内存中的去重表和计数，数据库操作在锁外进行，其他进程持有写锁时不会阻塞本进程的所有下载
+    with _download_lock:
+        while _recent_clients:
+            recent, last_time = next(iter(_recent_clients.items()))
+            if now - last_time < DOWNLOAD_DEDUP_SECONDS:
+                break
+            del _recent_clients[recent]
+        if key in _recent_clients:
+            return 'duplicate', None
+        # 先占位，同一客户端并发的请求不会重复计数；未能计数时移除
+        _recent_clients[key] = now
+        limit = _download_limits.get(file_group_id, False)
+    
+    try:
+        conn = get_db()
+        if limit is False:
+            # 下载上限在文件组创建后不会改变，缓存起来避免每次下载都查询
+            row = conn.execute('SELECT max_downloads FROM file_groups WHERE id = ?', (file_group_id,)).fetchone()
+            if row is None:
+                raise DownloadLimitReached
+            limit = row['max_downloads']
+            with _download_lock:
+                _download_limits[file_group_id] = limit
+        count = None
+        if limit:
+            # 计数与上限检查在同一条语句中完成，并发下载（包括其他进程）也不会超出上限
+            with conn:
+                cur = conn.execute('UPDATE file_groups SET download_count = download_count + 1 WHERE id = ? '
+                                   'AND download_count < max_downloads', (file_group_id,))
+                if cur.rowcount == 0:
+                    raise DownloadLimitReached
+                count = conn.execute('SELECT download_count FROM file_groups WHERE id = ?',
+                                     (file_group_id,)).fetchone()[0]
+    except BaseException as e:
+        with _download_lock:
+            _recent_clients.pop(key, None)
+        if isinstance(e, DownloadLimitReached):
+            return 'limit', None
+        raise
+    
+    with _download_lock:
+        if not limit:
+            _pending_counts[file_group_id] = _pending_counts.get(file_group_id, 0) + 1
+        at = datetime.datetime.now().isoformat()
+        _download_events.append((file_group_id, filename, at, ip))
+        # 在锁内发布，实时更新连接读到的下载次数与已收到的事件一致
+        _group_events.publish(file_group_id, 'download', {'filename': filename, 'time': at, 'ip': ip})
+        start_download_writer()
+        if len(_download_events) >= DOWNLOAD_FLUSH_BATCH:
+            _download_cond.notify()
+        return 'recorded', count
+
+def start_download_writer():
+    # 第一次有下载事件时启动写入线程（调用方持有 _download_lock）
+    global _download_writer_started
+    if not _download_writer_started:
+        _download_writer_started = True
+        threading.Thread(target=download_writer_loop, name='download-writer', daemon=True).start()
+        atexit.register(flush_download_events)
+
+def download_writer_loop():
+    while True:
+        with _download_cond:
+            _download_cond.wait(DOWNLOAD_FLUSH_SECONDS)
+        try:
+            flush_download_events()
+        except Exception as e:
+            print(f"写入下载记录失败: {e}", flush=True)
+
+@OPERATION_SECONDS.time(operation='flush_downloads')
+def flush_download_events():
+    """把排队的下载事件在一个事务中写入数据库"""
+    with _download_flush_lock:
+        with _download_lock:
+            events = list(_download_events)
+            _download_events.clear()
+            increments = dict(_pending_counts)
+        if not events and not increments:
+            return
+        conn = get_db()
+        try:
+            with conn:
+                conn.executemany('UPDATE file_groups SET download_count = download_count + ? WHERE id = ?',
+                                 [(count, file_group_id) for file_group_id, count in increments.items()])
+                _append_download_history(conn, events)
+        except Exception:
+            # 写入失败时放回队列，下次重试
+            with _download_lock:
+                _download_events[:0] = events
+            raise
+        with _download_lock:
+            # 已写入数据库的次数从内存计数中扣除
+            for file_group_id, count in increments.items():
+                remaining = _pending_counts.get(file_group_id, 0) - count
+                if remaining > 0:
+                    _pending_counts[file_group_id] = remaining
+                else:
+                    _pending_counts.pop(file_group_id, None)
+
+def _append_download_history(conn, events):
+    # 写入下载记录并更新汇总，已删除的文件组直接忽略
+    if not events:
+        return
+    conn.executemany('INSERT INTO download_history (group_id, filename, time, ip) SELECT ?, ?, ?, ? '
+                     'WHERE EXISTS (SELECT 1 FROM file_groups WHERE id = ?)',
+                     [(group_id, filename, at, ip, group_id) for group_id, filename, at, ip in events])
+    conn.executemany('INSERT INTO download_summary (group_id, filename, count, last_time) SELECT ?, ?, 1, ? '
+                     'WHERE EXISTS (SELECT 1 FROM file_groups WHERE id = ?) '
+                     'ON CONFLICT(group_id, filename) DO UPDATE SET count = count + 1, '
+                     'last_time = MAX(COALESCE(last_time, \'\'), excluded.last_time)',
+                     [(group_id, filename or '', at, group_id) for group_id, filename, at, ip in events])
+    _trim_download_history(conn, {event[0] for event in events})
+
+def _trim_download_history(conn, group_ids):
+    # 下载记录按文件组只保留最近 DOWNLOAD_HISTORY_LIMIT 条
+    for group_id in group_ids:
+        conn.execute('DELETE FROM download_history WHERE group_id = ? AND id <= ('
+                     'SELECT id FROM download_history WHERE group_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?)',
+                     (group_id, group_id, DOWNLOAD_HISTORY_LIMIT))
+
+@OPERATION_SECONDS.time(operation='delete_group')
+def delete_group_record(file_group_id):
+    """
+    删除文件组记录，并把文件组目录登记为待删除（占用的空间在真正删除后才从存储用量中扣除）
+    返回回收目录中的名称，文件组不存在时返回 None
+    """
+    conn = get_db()
+    trash_name = None
+    with immediate_transaction(conn):
+        row = conn.execute('SELECT total_size, files FROM file_groups WHERE id = ?', (file_group_id,)).fetchone()
+        conn.execute('DELETE FROM file_groups WHERE id = ?', (file_group_id,))
+        if row is not None:
+            files = json.loads(row['files'])
+            _add_storage_usage(conn, -row['total_size'], 'logical_bytes')
+            _add_storage_usage(conn, -1, 'group_count')
+            _add_storage_usage(conn, -len(files), 'file_count')
+            trash_name = _queue_trash(conn, file_group_id, _physical_size(files))
+            _release_blobs(conn, [file['blob'] for file in files if file.get('blob')])
+        conn.execute('DELETE FROM download_history WHERE group_id = ?', (file_group_id,))
+        conn.execute('DELETE FROM download_summary WHERE group_id = ?', (file_group_id,))
+        conn.execute('DELETE FROM frame_index WHERE group_id = ?', (file_group_id,))
+    if _catalog is not None:
+        _catalog.remove_group(file_group_id, NODE_ID)
+    with _download_lock:
+        _download_limits.pop(file_group_id, None)
+        _pending_counts.pop(file_group_id, None)
+    return trash_name
+
+def mark_group_ready(file_group_id):
+    # 安全检查通过，文件组可以取件
+    conn = get_db()
+    with conn:
+        cur = conn.execute("UPDATE file_groups SET status = 'ready', scan_pid = NULL "
+                           "WHERE id = ? AND status = 'scanning'", (file_group_id,))
+    return cur.rowcount > 0
+
+def reject_group_record(file_group_id, reason, keep_until):
+    """
+    安全检查未通过：登记删除文件，记录保留到 keep_until（不晚于原有效期）供上传者查看原因，
+    返回 (记录最终的过期时间, 回收目录中的名称)，文件组已不存在或不在检查中时返回 None
+    """
+    conn = get_db()
+    with immediate_transaction(conn):
+        row = conn.execute("SELECT total_size, files, expiry_date FROM file_groups WHERE id = ? AND status = 'scanning'",
+                           (file_group_id,)).fetchone()
+        if row is None:
+            return None
+        files = json.loads(row['files'])
+        _add_storage_usage(conn, -row['total_size'], 'logical_bytes')
+        _add_storage_usage(conn, -len(files), 'file_count')
+        trash_name = _queue_trash(conn, file_group_id, _physical_size(files))
+        _release_blobs(conn, [file['blob'] for file in files if file.get('blob')])
+        conn.execute('DELETE FROM frame_index WHERE group_id = ?', (file_group_id,))
+        expiry_date = min(row['expiry_date'] or keep_until, keep_until)
+        conn.execute("UPDATE file_groups SET status = 'rejected', scan_error = ?, files = '[]', total_size = 0, "
+                     "expiry_date = ?, scan_pid = NULL, token_generation = token_generation + 1 WHERE id = ?",
+                     (reason, expiry_date, file_group_id))
+    return expiry_date, trash_name
+
+def claim_stale_scans():
+    """认领检查进程已退出的 scanning 文件组，返回需要重新检查的文件组ID"""
+    conn = get_db()
+    rows = conn.execute("SELECT id, scan_pid FROM file_groups WHERE status = 'scanning'").fetchall()
+    claimed = []
+    for row in rows:
+        pid = row['scan_pid']
+        if pid == os.getpid() or (os.name == 'posix' and pid and _pid_alive(pid)):
+            continue
+        with conn:
+            cur = conn.execute("UPDATE file_groups SET scan_pid = ? WHERE id = ? AND status = 'scanning' "
+                               "AND scan_pid IS ?", (os.getpid(), row['id'], pid))
+        if cur.rowcount:
+            claimed.append(row['id'])
+    return claimed
+
+def list_expired_group_ids(now=None):
+    # 已过期或已达到下载次数上限的文件组
+    now = now or datetime.datetime.now()
+    rows = get_db().execute(
+        'SELECT id FROM file_groups WHERE (expiry_date IS NOT NULL AND expiry_date < ?) '
+        'OR (max_downloads IS NOT NULL AND download_count >= max_downloads)',
+        (now.isoformat(),)).fetchall()
+    return [row['id'] for row in rows]
+
+def clear_all_records():
+    conn = get_db()
+    with conn:
+        conn.execute('DELETE FROM file_groups')
+        conn.execute('DELETE FROM download_history')
+        conn.execute('DELETE FROM download_summary')
+        conn.execute('DELETE FROM upload_sessions')
+        conn.execute('DELETE FROM upload_chunks')
+        conn.execute('DELETE FROM blobs')
+        conn.execute('DELETE FROM trash')
+        conn.execute('DELETE FROM frame_index')
+        conn.execute("DELETE FROM meta WHERE key = 'reconcile_state'")
+        conn.execute("UPDATE counters SET value = 0 WHERE name IN "
+                     "('storage_used_bytes', 'logical_bytes', 'group_count', 'file_count')")
+        # 更换签名密钥，之前发出的下载令牌全部失效
+        conn.execute("DELETE FROM meta WHERE key = 'token_secret'")
+    if _catalog is not None:
+        _catalog.clear_node(NODE_ID)
+    with _download_lock:
+        _download_limits.clear()
+        _pending_counts.clear()
+        _recent_clients.clear()
+        _download_events.clear()
+    global _token_secret
+    with _token_lock:
+        _token_secret = None
+        _token_cache.clear()
+
+def create_upload_session_record(upload_id, session, max_bytes):
+    """
+    写入上传会话；会话记录本身就是空间预留，容量检查与写入在同一个写事务中完成
+    返回 (是否成功, 当前用量)
+    """
+    conn = get_db()
+    now = datetime.datetime.now().isoformat()
+    with immediate_transaction(conn):
+        current_bytes = get_total_storage_usage() + get_reserved_storage()
+        if current_bytes + session['total_size'] > max_bytes:
+            return False, current_bytes
+        conn.execute('INSERT INTO upload_sessions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                     (upload_id, json.dumps(session['files'], ensure_ascii=False), session['chunk_size'],
+                      session['total_size'], session['expiry_unit'], session['expiry_value'],
+                      session['max_downloads'], now, now))
+    return True, current_bytes
+
+def get_upload_session_record(upload_id):
+    conn = get_db()
+    row = conn.execute('SELECT * FROM upload_sessions WHERE id = ?', (upload_id,)).fetchone()
+    if row is None:
+        return None
+    session = dict(row)
+    session['files'] = json.loads(row['files'])
+    received = {}
+    for r in conn.execute('SELECT file_index, chunk_index FROM upload_chunks WHERE upload_id = ?', (upload_id,)):
+        received.setdefault(r['file_index'], []).append(r['chunk_index'])
+    for index, file in enumerate(session['files']):
+        file['received'] = sorted(received.get(index, []))
+    return session
+
+def mark_chunk_received(upload_id, file_index, chunk_index):
+    conn = get_db()
+    with conn:
+        conn.execute('INSERT OR IGNORE INTO upload_chunks VALUES (?, ?, ?)', (upload_id, file_index, chunk_index))
+        conn.execute('UPDATE upload_sessions SET updated_at = ? WHERE id = ?',
+                     (datetime.datetime.now().isoformat(), upload_id))
+
+def delete_upload_session_record(upload_id):
+    conn = get_db()
+    with conn:
+        cur = conn.execute('DELETE FROM upload_sessions WHERE id = ?', (upload_id,))
+        conn.execute('DELETE FROM upload_chunks WHERE upload_id = ?', (upload_id,))
+    return cur.rowcount > 0
+
+def claim_upload_session(upload_id):
+    """
+    删除会话记录即视为认领，并发的完成请求（可能在不同进程中）只有一个能成功；
+    会话的空间预留在同一事务中转为预留记录，返回预留ID，会话不存在时返回 None
+    """
+    conn = get_db()
+    with immediate_transaction(conn):
+        row = conn.execute('SELECT total_size FROM upload_sessions WHERE id = ?', (upload_id,)).fetchone()
+        if row is None:
+            return None
+        conn.execute('DELETE FROM upload_sessions WHERE id = ?', (upload_id,))
+        conn.execute('DELETE FROM upload_chunks WHERE upload_id = ?', (upload_id,))
+        return _insert_reservation(conn, row['total_size'])
+
+def list_stale_upload_sessions(cutoff):
+    rows = get_db().execute('SELECT id FROM upload_sessions WHERE updated_at < ?', (cutoff.isoformat(),)).fetchall()
+    return [row['id'] for row in rows]
+
+def get_reserved_storage():
+    # 进行中的上传预留的空间：表单上传和正在入库的预留记录，加上未完成的分块上传会话
+    return get_db().execute('SELECT (SELECT COALESCE(SUM(bytes), 0) FROM storage_reservations) + '
+                            '(SELECT COALESCE(SUM(total_size), 0) FROM upload_sessions)').fetchone()[0]
+
+def _insert_reservation(conn, nbytes):
+    reservation_id = str(uuid.uuid4())
+    conn.execute('INSERT INTO storage_reservations VALUES (?, ?, ?, ?)',
+                 (reservation_id, nbytes, os.getpid(), datetime.datetime.now().isoformat()))
+    return reservation_id
+
+def _add_storage_usage(conn, delta, counter='storage_used_bytes'):
+    conn.execute('UPDATE counters SET value = MAX(value + ?, 0) WHERE name = ?', (delta, counter))
+
+def blob_path(sha256):
+    return os.path.join(BLOB_FOLDER, sha256[:2], sha256[2:4], sha256)
+
+def store_blob(file_path, sha256, size, crc32=None):
+    """
+    把文件放入内容寻址存储并增加引用计数，已有相同内容时丢弃新文件
+    文件移动在写锁内完成，不会和删除最后一个引用的操作交错
+    """
+    conn = get_db()
+    target = blob_path(sha256)
+    with immediate_transaction(conn):
+        row = conn.execute('SELECT refcount FROM blobs WHERE sha256 = ?', (sha256,)).fetchone()
+        if row is not None and os.path.exists(target):
+            os.remove(file_path)
+        else:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(file_path, target)
+            if row is None:
+                _add_storage_usage(conn, size)
+        conn.execute('INSERT INTO blobs (sha256, size, refcount, crc32) VALUES (?, ?, 1, ?) '
+                     'ON CONFLICT(sha256) DO UPDATE SET refcount = refcount + 1, crc32 = COALESCE(crc32, excluded.crc32)',
+                     (sha256, size, crc32))
+
+def add_blob_ref(sha256, size):
+    # 为已存在的blob增加引用（秒传），返回blob记录，blob不存在时返回 None
+    conn = get_db()
+    with immediate_transaction(conn):
+        row = conn.execute('SELECT * FROM blobs WHERE sha256 = ?', (sha256,)).fetchone()
+        if row is None or row['size'] != size or not os.path.exists(blob_path(sha256)):
+            return None
+        conn.execute('UPDATE blobs SET refcount = refcount + 1 WHERE sha256 = ?', (sha256,))
+    return dict(row)
+
+def find_blob(sha256, size):
+    row = get_db().execute('SELECT size FROM blobs WHERE sha256 = ?', (sha256,)).fetchone()
+    return row is not None and row['size'] == size and os.path.exists(blob_path(sha256))
+
+def _release_blobs(conn, hashes):
+    # 在调用方的写事务中减少引用计数，最后一个引用释放时把blob文件移到回收目录
+    for sha256 in hashes:
+        conn.execute('UPDATE blobs SET refcount = refcount - 1 WHERE sha256 = ?', (sha256,))
+        row = conn.execute('SELECT size, refcount FROM blobs WHERE sha256 = ?', (sha256,)).fetchone()
+        if row is not None and row['refcount'] <= 0:
+            conn.execute('DELETE FROM blobs WHERE sha256 = ?', (sha256,))
+            # 在写锁内移走，不会和 store_blob 放入相同内容的新文件交错
+            source = os.path.relpath(blob_path(sha256), UPLOAD_FOLDER)
+            move_to_trash(_queue_trash(conn, source, row['size']), source)
+
+def release_blobs(hashes):
+    if hashes:
+        conn = get_db()
+        with immediate_transaction(conn):
+            _release_blobs(conn, hashes)
+
+_trash_cond = threading.Condition()
+_trash_pending = False
+
+def _queue_trash(conn, source, nbytes):
+    """
+    在调用方的写事务中登记待删除的内容（source 为相对上传目录的路径，nbytes 为其计入存储用量的字节数），
+    返回回收目录中的名称；事务提交后由调用方移动，移动前进程退出时由回收线程补做
+    """
+    name = uuid.uuid4().hex
+    conn.execute('INSERT INTO trash (name, source, bytes, created_at) VALUES (?, ?, ?, ?)',
+                 (name, source, nbytes, datetime.datetime.now().isoformat()))
+    return name
 
-def save_data(data):
-    with open(DATA_FILE, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=4)
+def move_to_trash(name, source):
+    # 重命名到回收目录；源已不存在时不做任何事，登记的字节数由回收线程结清
+    try:
+        os.makedirs(TRASH_FOLDER, exist_ok=True)
+        os.rename(os.path.join(UPLOAD_FOLDER, source), os.path.join(TRASH_FOLDER, name))
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        # 例如Windows上文件仍被打开，由回收线程稍后重试
+        print(f"移动到回收目录失败，稍后重试: {e}", flush=True)
+    wake_trash_reaper()
+
+def discard_folder(path):
+    """丢弃未计入存储用量的目录（失败的上传、上传会话），重命名到回收目录后由回收线程删除"""
+    try:
+        os.makedirs(TRASH_FOLDER, exist_ok=True)
+        os.rename(path, os.path.join(TRASH_FOLDER, uuid.uuid4().hex))
+    except FileNotFoundError:
+        return
+    except OSError:
+        # 不在同一文件系统等无法重命名的情况，直接删除
+        shutil.rmtree(path, ignore_errors=True)
+        return
+    wake_trash_reaper()
+
+def wake_trash_reaper():
+    global _trash_pending
+    with _trash_cond:
+        _trash_pending = True
+        _trash_cond.notify()
+
+def _release_trash_bytes(name, nbytes=None):
+    # 空间已真正释放：从存储用量中扣除，最多扣到登记的字节数；nbytes 为 None 时结清并删除登记
+    conn = get_db()
+    with immediate_transaction(conn):
+        row = conn.execute('SELECT bytes FROM trash WHERE name = ?', (name,)).fetchone()
+        if row is None:
+            return
+        freed = row['bytes'] if nbytes is None else min(nbytes, row['bytes'])
+        _add_storage_usage(conn, -freed)
+        if nbytes is None:
+            conn.execute('DELETE FROM trash WHERE name = ?', (name,))
+        else:
+            conn.execute('UPDATE trash SET bytes = bytes - ? WHERE name = ?', (freed, name))
 
+def unlink_trash_file(file_path):
+    """删除一个文件，限速时按文件大小等待，返回释放的字节数"""
+    # 不截短文件：已删除文件组中正在进行的下载仍持有文件，删除目录项后可以继续读完
+    try:
+        size = os.lstat(file_path).st_size
+        os.unlink(file_path)
+    except FileNotFoundError:
+        return 0
+    if TRASH_RATE_BYTES:
+        time.sleep(size / TRASH_RATE_BYTES)
+    return size
+
+def reap_trash_entry(name):
+    """分批删除回收目录中的一项，每批更新一次存储用量；全部删除后结清登记，返回是否已删除完"""
+    path = os.path.join(TRASH_FOLDER, name)
+    freed = 0
+    count = 0
+    if os.path.isdir(path) and not os.path.islink(path):
+        for root, dirs, files in os.walk(path, topdown=False):
+            for file in files:
+                try:
+                    freed += unlink_trash_file(os.path.join(root, file))
+                except OSError:
+                    continue  # 删除失败的留到下一轮
+                count += 1
+                if count % TRASH_BATCH_FILES == 0:
+                    _release_trash_bytes(name, freed)
+                    freed = 0
+            for folder in dirs:
+                folder_path = os.path.join(root, folder)
+                try:
+                    if os.path.islink(folder_path):
+                        os.unlink(folder_path)
+                    else:
+                        os.rmdir(folder_path)
+                except OSError:
+                    pass
+        if freed:
+            _release_trash_bytes(name, freed)
+        try:
+            os.rmdir(path)
+        except FileNotFoundError:
+            pass
+        except OSError:
+            return False
+    else:
+        try:
+            unlink_trash_file(path)
+        except OSError:
+            return False
+    _release_trash_bytes(name)
+    return True
+
+def retry_trash_move(name, source):
+    """补做中断或失败的移动；blob可能已被重新上传的相同内容替换，此时旧文件已不存在，只结清登记"""
+    sha256 = os.path.basename(source)
+    conn = get_db()
+    with immediate_transaction(conn):
+        if (source == os.path.relpath(blob_path(sha256), UPLOAD_FOLDER) and
+                conn.execute('SELECT 1 FROM blobs WHERE sha256 = ?', (sha256,)).fetchone()):
+            row = conn.execute('SELECT bytes FROM trash WHERE name = ?', (name,)).fetchone()
+            if row is not None:
+                _add_storage_usage(conn, -row['bytes'])
+                conn.execute('DELETE FROM trash WHERE name = ?', (name,))
+            return
+        # 在写锁内移动，不会和 store_blob 交错
+        move_to_trash(name, source)
+
+@OPERATION_SECONDS.time(operation='reap_trash')
+def reap_trash():
+    """处理回收目录：补做中断的移动，逐项删除，登记了但源和回收目录中都已不存在的内容直接结清"""
+    rows = get_db().execute('SELECT name, source FROM trash').fetchall()
+    for row in rows:
+        if not os.path.lexists(os.path.join(TRASH_FOLDER, row['name'])):
+            retry_trash_move(row['name'], row['source'])
+    if os.path.isdir(TRASH_FOLDER):
+        for name in os.listdir(TRASH_FOLDER):
+            reap_trash_entry(name)
+    for row in rows:
+        if (not os.path.lexists(os.path.join(TRASH_FOLDER, row['name'])) and
+                not os.path.lexists(os.path.join(UPLOAD_FOLDER, row['source']))):
+            _release_trash_bytes(row['name'])
+
+def trash_reaper_loop():
+    global _trash_pending
+    while True:
+        try:
+            reap_trash()
+        except Exception as e:
+            print(f"清理回收目录失败: {e}", flush=True)
+        with _trash_cond:
+            if not _trash_pending:
+                _trash_cond.wait(TRASH_POLL_SECONDS)
+            _trash_pending = False
+
+def get_counter(name):
+    row = get_db().execute('SELECT value FROM counters WHERE name = ?', (name,)).fetchone()
+    return row['value'] if row else 0
+
+# 工具函数
 def allowed_file(filename):
     ext = filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
     return ext not in FORBIDDEN_EXTENSIONS and (ext in ALLOWED_EXTENSIONS or '*' in ALLOWED_EXTENSIONS)
 
-def generate_pickup_code(length=None):
+PICKUP_CODE_ATTEMPTS = 8
+
+def generate_pickup_code(length=None, conn=None):
     # 从配置获取取件码长度
+    code_config = config["pickup_code"]
     if length is None:
-        length = config["pickup_code"]["default_length"]
+        length = code_config["default_length"]
+    length = max(code_config["length_min"], min(length, code_config["length_max"]))
     # 生成数字+字母的取件码
     chars = string.ascii_uppercase + string.digits
-    return ''.join(random.choice(chars) for _ in range(length))
+    while True:
+        # 通过取件码索引保证唯一；连续冲突说明当前长度的码空间已拥挤，自动加长
+        for _ in range(PICKUP_CODE_ATTEMPTS):
+            code = ''.join(random.choice(chars) for _ in range(length))
+            if find_group_id_by_code(code, conn=conn) is None and (
+                    _catalog is None or _catalog.lookup_code(code) is None):
+                return code
+        if length >= code_config["length_max"]:
+            raise RuntimeError('可用取件码已耗尽')
+        length += 1
+
+def check_filename_safety(filename):
+    # 检查文件扩展名，以及隐藏的多个扩展名（如 file.php.jpg）
+    return scanner.check_filename_safety(filename, FORBIDDEN_EXTENSIONS)
 
-def check_file_for_virus(file_path):
+def hash_file(file_path):
+    # 计算已保存文件的SHA-256和CRC-32（分块上传无法按顺序边收边算）
+    digest = hashlib.sha256()
+    crc32 = 0
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+            crc32 = zlib.crc32(block, crc32)
+    return digest.hexdigest(), crc32
+
+class UploadRejected(Exception):
+    """上传流水线在接收过程中拒绝文件，status 为返回的HTTP状态码"""
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+# 正在接收的上传临时文件，占用的空间已计入 storage_reservations
+UPLOAD_TEMP_SUFFIX = '.uploading'
+
+class UploadFileWriter:
     """
-    检查文件是否存在安全风险
-    1. 检查文件扩展名
-    2. 对特定类型文件进行内容检查
-    3. 检查隐藏的扩展名（如 file.php.jpg）
+    单个上传文件的接收端：写入临时文件的同时计算SHA-256、统计大小并检查文件头，
+    超出限制或发现危险内容时立即中止接收
     """
-    filename = os.path.basename(file_path)
+    def __init__(self, pipeline, filename):
+        self.pipeline = pipeline
+        self.filename = filename
+        fd, self.temp_path = tempfile.mkstemp(dir=pipeline.folder, suffix=UPLOAD_TEMP_SUFFIX)
+        self.file = os.fdopen(fd, 'w+b')
+        self.sha256 = hashlib.sha256()
+        self.crc32 = 0
+        self.size = 0
+        self.head = b''
+        self.head_checked = False
     
-    # 1. 检查文件扩展名
-    ext = filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
-    if ext in FORBIDDEN_EXTENSIONS:
-        return False
+    def write(self, data):
+        self.size += len(data)
+        self.pipeline.add_bytes(self.filename, self.size, len(data))
+        if not self.head_checked:
+            self.head += data[:HEADER_SNIFF_BYTES - len(self.head)]
+            if len(self.head) >= HEADER_SNIFF_BYTES:
+                self.check_head()
+        self.sha256.update(data)
+        self.crc32 = zlib.crc32(data, self.crc32)
+        return self.file.write(data)
     
-    # 2. 检查文件名是否包含多个扩展名，如 file.php.jpg
-    name_parts = filename.split('.')
-    if len(name_parts) > 2:
-        suspicious_exts = [part.lower() for part in name_parts[1:-1]]
-        if any(ext in FORBIDDEN_EXTENSIONS for ext in suspicious_exts):
-            return False
+    def check_head(self):
+        self.head_checked = True
+        if not check_file_header(self.filename, self.head):
+            raise UploadRejected('发现潜在危险文件，上传已取消')
+        if not check_extension_matches(self.filename, self.head):
+            raise UploadRejected('文件内容与扩展名不符，上传已取消')
     
-    # 3. 对特定类型文件进行内容检查
-    # 检查图片文件是否包含PHP代码
-    if ext in ['jpg', 'jpeg', 'png', 'gif']:
-        try:
-            with open(file_path, 'rb') as f:
-                content = f.read(4096)  # 读取文件头部
-                # 检查是否包含PHP标签
-                if b'<?php' in content or b'<?=' in content:
-                    return False
-        except Exception:
-            pass  # 如果读取失败，继续执行
-            
-    # 4. 检查ZIP文件内容
-    if ext in ['zip']:
-        import zipfile
-        try:
-            if zipfile.is_zipfile(file_path):
-                with zipfile.ZipFile(file_path) as zf:
-                    for info in zf.infolist():
-                        if any(info.filename.lower().endswith('.' + forbidden_ext) 
-                               for forbidden_ext in FORBIDDEN_EXTENSIONS):
-                            return False
-        except Exception:
-            pass  # 如果读取失败，继续执行
+    def finish(self, target_path):
+        # 接收完成：检查过短文件的文件头，并把临时文件移动到最终位置
+        if not self.head_checked:
+            self.check_head()
+        self.file.close()
+        os.replace(self.temp_path, target_path)
+        return self.sha256.hexdigest()
     
-    return True
+    def __getattr__(self, name):
+        # seek、read等其他文件操作交给临时文件
+        return getattr(self.file, name)
 
-def create_download_token(file_group_id):
-    # 创建下载令牌
-    token = str(uuid.uuid4())
-    data = load_data()
-    if file_group_id in data["file_groups"]:
-        data["file_groups"][file_group_id]["download_token"] = token
-        data["file_groups"][file_group_id]["token_created"] = datetime.datetime.now().isoformat()
-        save_data(data)
-    return token
-
-def validate_token(file_group_id, token):
-    # 验证下载令牌
-    data = load_data()
-    if file_group_id in data["file_groups"]:
-        if data["file_groups"][file_group_id].get("download_token") == token:
-            return True
-    return False
+class UploadPipeline:
+    """一个上传请求的流水线，汇总整个文件组的文件数量和大小限制"""
+    def __init__(self, folder, transfer=None):
+        self.folder = folder
+        self.transfer = transfer
+        self.writers = []
+        self.total_size = 0
+    
+    def open_file(self, filename):
+        if not allowed_file(filename) or not check_filename_safety(filename):
+            raise UploadRejected('不支持的文件类型或包含潜在危险文件')
+        if len(self.writers) >= config["file_limits"]["max_files_per_group"]:
+            raise UploadRejected(f'一次最多只能上传{config["file_limits"]["max_files_per_group"]}个文件')
+        writer = UploadFileWriter(self, filename)
+        self.writers.append(writer)
+        return writer
+    
+    def close(self):
+        for writer in self.writers:
+            writer.file.close()
+    
+    def add_bytes(self, filename, file_size, nbytes):
+        self.total_size += nbytes
+        UPLOADED_BYTES.inc(nbytes)
+        if self.transfer is not None:
+            # 放慢读取请求体的速度，由TCP流控限制客户端的发送速度
+            self.transfer.throttle(nbytes)
+        if file_size > MAX_CONTENT_LENGTH:
+            raise UploadRejected(f'文件 {filename} 过大，超过{config["file_limits"]["max_file_size_mb"]}MB限制', 413)
+        if self.total_size > config["file_limits"]["max_group_size_mb"] * 1024 * 1024:
+            raise UploadRejected(f'文件组总大小超过{config["file_limits"]["max_group_size_mb"]}MB限制', 413)
+
+class UploadRequest(Request):
+    # 设置了 upload_pipeline 的请求，表单中的文件直接写入流水线
+    upload_pipeline = None
+    
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if self.upload_pipeline is not None and filename:
+            return self.upload_pipeline.open_file(filename)
+        return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+
+app.request_class = UploadRequest
+
+# 下载令牌：HMAC签名的 文件组ID:过期时间:令牌代数:文件名；
+# 文件组记录删除或令牌代数增加后令牌即失效，撤销状态保存在数据库中，所有进程一致
+_token_secret = None
+_token_lock = threading.Lock()
+_token_cache = collections.OrderedDict()  # 令牌 -> (文件组ID, 过期时间, 令牌代数, 文件名)，只缓存签名有效的令牌
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+def get_token_secret():
+    # 签名密钥保存在数据库中，重启或多进程时令牌依然有效；集群模式下使用目录中的密钥，令牌在任一节点都有效
+    global _token_secret
+    if _token_secret is None:
+        conn = _catalog.connect() if _catalog is not None else get_db()
+        with conn:
+            conn.execute("INSERT OR IGNORE INTO meta VALUES ('token_secret', ?)", (secrets.token_hex(32),))
+        _token_secret = bytes.fromhex(conn.execute("SELECT value FROM meta WHERE key = 'token_secret'").fetchone()[0])
+    return _token_secret
+
+def _sign_token(payload):
+    return hmac.new(get_token_secret(), payload, hashlib.sha256).digest()
+
+def create_download_token(file_group_id, file_group, filename=None):
+    """
+    创建下载令牌，同一文件组可以同时存在多个有效令牌
+    有效期不超过文件组的过期时间，filename 不为空时令牌只能下载该文件
+    """
+    expires = int(time.time()) + DOWNLOAD_TOKEN_TTL
+    if file_group.get('expiry_date'):
+        expires = min(expires, int(datetime.datetime.fromisoformat(file_group['expiry_date']).timestamp()) + 1)
+    payload = f"{file_group_id}:{expires}:{file_group['token_generation']}:{filename or ''}".encode('utf-8')
+    return f"{_b64encode(payload)}.{_b64encode(_sign_token(payload))}"
+
+def _parse_token(token):
+    # 校验签名并解析令牌，无效时返回 None
+    with _token_lock:
+        cached = _token_cache.get(token)
+        if cached is not None:
+            _token_cache.move_to_end(token)
+            return cached
+    try:
+        payload_text, signature_text = token.split('.')
+        payload = _b64decode(payload_text)
+        if not hmac.compare_digest(_sign_token(payload), _b64decode(signature_text)):
+            return None
+        file_group_id, expires, generation, filename = payload.decode('utf-8').split(':', 3)
+        parsed = (file_group_id, int(expires), int(generation), filename or None)
+    except (ValueError, UnicodeDecodeError):
+        return None
+    with _token_lock:
+        _token_cache[token] = parsed
+        if len(_token_cache) > DOWNLOAD_TOKEN_CACHE_SIZE:
+            _token_cache.popitem(last=False)
+    return parsed
+
+def validate_token(file_group_id, file_group, token, filename=None):
+    # 验证下载令牌：签名、过期时间、文件组、令牌代数和文件范围；file_group 为数据库中的记录，已删除时为 None
+    parsed = _parse_token(token)
+    if parsed is None or file_group is None:
+        return False
+    token_group_id, expires, generation, token_filename = parsed
+    if token_group_id != file_group_id or expires < time.time():
+        return False
+    if generation != file_group['token_generation']:
+        return False
+    return token_filename is None or token_filename == filename
+
+_rescan_lock = threading.Lock()
 
 def get_total_storage_usage():
-    # 计算当前储存使用量
+    # 当前储存使用量（磁盘实际占用），由上传/删除/过期增量维护
+    return get_counter('storage_used_bytes')
+
+def get_logical_storage_usage():
+    # 所有文件组的文件大小之和，开启去重时可能大于实际占用
+    return get_counter('logical_bytes')
+
+def scan_storage_usage():
+    # 遍历上传目录计算真实占用；回收目录中只计入已删除文件组尚未释放的部分（与回收线程的扣减一致），
+    # 上传中的临时文件已计入预留，不重复计算
     total_bytes = 0
     for root, dirs, files in os.walk(UPLOAD_FOLDER):
+        if root == UPLOAD_FOLDER and os.path.basename(TRASH_FOLDER) in dirs:
+            dirs.remove(os.path.basename(TRASH_FOLDER))
         for file in files:
-            file_path = os.path.join(root, file)
-            total_bytes += os.path.getsize(file_path)
-    return total_bytes
+            if file.endswith(UPLOAD_TEMP_SUFFIX):
+                continue
+            try:
+                total_bytes += os.path.getsize(os.path.join(root, file))
+            except OSError:
+                pass  # 扫描期间文件可能已被删除
+    return total_bytes + get_trash_bytes()
+
+def get_trash_bytes():
+    # 已删除但尚未释放、仍计入存储用量的字节数
+    return get_db().execute('SELECT COALESCE(SUM(bytes), 0) FROM trash').fetchone()[0]
+
+def reconcile_storage_usage():
+    """重新扫描磁盘并校准用量计数器；已有扫描在进行时直接返回 None"""
+    if not _rescan_lock.acquire(blocking=False):
+        return None
+    try:
+        # 按扫描开始时的计数计算偏差，以增量写入，扫描期间其他请求对计数器的增减不会被覆盖
+        counted_bytes = get_total_storage_usage()
+        total_bytes = scan_storage_usage()
+        conn = get_db()
+        with immediate_transaction(conn):
+            _add_storage_usage(conn, total_bytes - counted_bytes)
+        return total_bytes
+    finally:
+        _rescan_lock.release()
+
+def storage_rescan_loop():
+    interval = config["file_limits"].get("usage_rescan_minutes", 60) * 60
+    while True:
+        try:
+            clear_stale_reservations()
+            reconcile_storage_usage()
+        except Exception as e:
+            print(f"存储用量校准失败: {e}", flush=True)
+        time.sleep(interval)
 
 def check_storage_limit():
     # 检查是否超出总存储限制
@@ -153,32 +1331,439 @@ def check_storage_limit():
     current_bytes = get_total_storage_usage()
     return current_bytes <= max_bytes, current_bytes, max_bytes
 
+def reserve_storage(nbytes):
+    """
+    按上传请求大小预先占用空间；预留记录保存在数据库中，多个进程的并发上传合计也不会超出总容量
+    返回 (预留ID, 当前用量, 上限)，空间不足时预留ID为 None
+    """
+    max_bytes = config["file_limits"]["total_storage_limit_gb"] * 1024 * 1024 * 1024
+    conn = get_db()
+    with immediate_transaction(conn):
+        current_bytes = get_total_storage_usage() + get_reserved_storage()
+        if current_bytes + nbytes > max_bytes:
+            return None, current_bytes, max_bytes
+        reservation_id = _insert_reservation(conn, nbytes)
+    return reservation_id, current_bytes, max_bytes
+
+def release_storage(reservation_id):
+    conn = get_db()
+    with conn:
+        conn.execute('DELETE FROM storage_reservations WHERE id = ?', (reservation_id,))
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def clear_stale_reservations():
+    # 清理异常退出的进程没来得及释放的预留（只有POSIX系统会以多进程方式运行）
+    conn = get_db()
+    pids = [row['pid'] for row in conn.execute('SELECT DISTINCT pid FROM storage_reservations')]
+    if os.name == 'posix':
+        stale = [pid for pid in pids if not _pid_alive(pid)]
+    else:
+        stale = [pid for pid in pids if pid != os.getpid()]
+    if stale:
+        with conn:
+            conn.executemany('DELETE FROM storage_reservations WHERE pid = ?', [(pid,) for pid in stale])
+
+def clear_storage_reservations():
+    # 启动时还没有任何上传在进行，之前留下的预留全部作废
+    conn = get_db()
+    with conn:
+        conn.execute('DELETE FROM storage_reservations')
+
+def get_stored_file_path(file_group_id, file):
+    # 文件在磁盘上的位置：去重模式下为blob，否则在文件组目录中
+    if file.get('blob'):
+        return blob_path(file['blob'])
+    # 如果是旧数据可能没有safe_name字段，此时name和safe_name相同
+    return os.path.join(app.config['UPLOAD_FOLDER'], file_group_id, file.get('safe_name', file['name']))
+
+def finish_compressed_file(file_group_id, file):
+    # 压缩结果先写入记录再替换原文件：替换前进程退出或替换出错时临时文件仍在，读取前完成替换
+    if file.get('encoding') and not file.get('blob'):
+        path = get_stored_file_path(file_group_id, file)
+        with contextlib.suppress(FileNotFoundError):
+            os.replace(path + compression.TEMP_SUFFIX, path)
+
+def stored_file_intact(file_group_id, file):
+    # 磁盘上的文件存在且大小与记录一致（压缩存储的文件按压缩后的大小）
+    finish_compressed_file(file_group_id, file)
+    try:
+        return os.path.getsize(get_stored_file_path(file_group_id, file)) == file.get('stored_size', file['size'])
+    except OSError:
+        return False
+
+def load_frame_index(file_group_id, file):
+    row = get_db().execute('SELECT offsets FROM frame_index WHERE group_id = ? AND name = ?',
+                           (file_group_id, file.get('safe_name', file['name']))).fetchone()
+    if row is None:
+        raise FileNotFoundError(f"找不到 {file['name']} 的帧索引")
+    return compression.unpack_offsets(row['offsets'])
+
+def open_stored_file(file_group_id, file):
+    """打开文件读取原始内容，压缩存储的文件按帧解压；返回的文件对象关闭时执行 DownloadFile 的回调"""
+    finish_compressed_file(file_group_id, file)
+    raw = DownloadFile(get_stored_file_path(file_group_id, file))
+    if not file.get('encoding'):
+        return raw
+    try:
+        return compression.FrameReader(raw, file['encoding'], file['size'], file['frame_size'],
+                                       load_frame_index(file_group_id, file))
+    except BaseException:
+        raw.close()
+        raise
+
+def remove_file_group(file_group_id, reason):
+    # 删除数据记录，文件夹移到回收目录后由后台删除；reason 为 'expired' 或 'deleted'
+    trash_name = delete_group_record(file_group_id)
+    if trash_name is None:
+        return False
+    move_to_trash(trash_name, file_group_id)
+    GROUPS_REMOVED.inc(reason=reason)
+    _group_events.publish(file_group_id, 'removed', {'reason': reason})
+    return True
+
+def is_group_expired(info, now=None, check_downloads=True):
+    # 检查单个文件组是否已过期或已达到下载次数上限
+    now = now or datetime.datetime.now()
+    if info.get('expiry_date') and now > datetime.datetime.fromisoformat(info['expiry_date']):
+        return True
+    if check_downloads and info.get('max_downloads') and info.get('download_count', 0) >= info['max_downloads']:
+        return True
+    return False
+
+def get_valid_group(file_group_id, with_history=False):
+    # 只检查目标文件组，已失效的交给后台清理
+    if not file_group_id:
+        return None
+    info = get_group_record(file_group_id, with_history=with_history)
+    if info is None:
+        return None
+    if is_group_expired(info):
+        schedule_expiry(file_group_id)
+        return None
+    return info
+
+@OPERATION_SECONDS.time(operation='clean_expired_files')
 def clean_expired_files():
-    data = load_data()
-    now = datetime.datetime.now()
-    to_delete = []
-    
-    for file_id, info in data["file_groups"].items():
-        # 检查有效期
-        if "expiry_date" in info:
-            expiry_date = datetime.datetime.fromisoformat(info["expiry_date"])
-            if now > expiry_date:
-                to_delete.append(file_id)
-                continue
-                
-    # 检查下载次数
-        if "max_downloads" in info and info["max_downloads"] is not None and info.get("download_count", 0) >= info["max_downloads"]:
-            to_delete.append(file_id)
+    # 通过索引查询过期或已达下载上限的文件组
+    to_delete = list_expired_group_ids()
     
     # 删除过期文件
     for file_id in to_delete:
-        folder_path = os.path.join(app.config['UPLOAD_FOLDER'], file_id)
-        if os.path.exists(folder_path):
-            shutil.rmtree(folder_path)
-        if file_id in data["file_groups"]:
-            del data["file_groups"][file_id]
-    
-    save_data(data)
+        remove_file_group(file_id, 'expired')
+
+# 后台过期调度：按 expiry_date 排序的最小堆，只在最近的截止时间到达时唤醒
+_expiry_heap = []
+_expiry_cond = threading.Condition()
+_expiry_worker_running = False
+# 多进程部署时其他进程创建的文件组不在本进程的堆中，过期线程定期从数据库取即将到期的文件组
+EXPIRY_POLL_SECONDS = 60
+
+def schedule_expiry(file_group_id, expiry_date=None):
+    """安排文件组在 expiry_date（ISO字符串，默认立即）到期时被清理"""
+    deadline = datetime.datetime.fromisoformat(expiry_date).timestamp() if expiry_date else time.time()
+    if not _expiry_worker_running:
+        # 本进程没有运行过期线程（多进程部署中的非维护进程）：到期的立即清理，其余由维护进程定期取出
+        if deadline <= time.time():
+            try:
+                expire_if_due(file_group_id)
+            except Exception as e:
+                print(f"清理过期文件组 {file_group_id} 失败: {e}", flush=True)
+        return
+    with _expiry_cond:
+        heapq.heappush(_expiry_heap, (deadline, file_group_id))
+        if _expiry_heap[0][1] == file_group_id:
+            _expiry_cond.notify()
+
+def load_expiry_schedule():
+    # 启动时把所有设置了有效期的文件组放入堆中，已达下载上限的立即清理
+    rows = get_db().execute('SELECT id, expiry_date FROM file_groups WHERE expiry_date IS NOT NULL').fetchall()
+    entries = [(datetime.datetime.fromisoformat(row['expiry_date']).timestamp(), row['id']) for row in rows]
+    entries.extend((time.time(), file_group_id) for file_group_id in list_expired_group_ids())
+    with _expiry_cond:
+        _expiry_heap.extend(entries)
+        heapq.heapify(_expiry_heap)
+        _expiry_cond.notify()
+
+def load_upcoming_expiries():
+    # 取出下一个轮询周期内到期的文件组（可能与堆中已有条目重复，清理时以数据库为准）
+    horizon = datetime.datetime.now() + datetime.timedelta(seconds=EXPIRY_POLL_SECONDS)
+    rows = get_db().execute('SELECT id, expiry_date FROM file_groups WHERE expiry_date IS NOT NULL AND expiry_date < ?',
+                            (horizon.isoformat(),)).fetchall()
+    entries = [(datetime.datetime.fromisoformat(row['expiry_date']).timestamp(), row['id']) for row in rows]
+    entries.extend((time.time(), file_group_id) for file_group_id in list_expired_group_ids())
+    with _expiry_cond:
+        for entry in entries:
+            heapq.heappush(_expiry_heap, entry)
+
+@OPERATION_SECONDS.time(operation='expire_group')
+def expire_if_due(file_group_id):
+    # 堆中的条目可能已失效（文件组已被删除），以数据库为准
+    info = get_group_record(file_group_id, with_history=False)
+    if info is not None and is_group_expired(info):
+        remove_file_group(file_group_id, 'expired')
+
+def expiry_worker_loop():
+    next_poll = time.time() + EXPIRY_POLL_SECONDS
+    while True:
+        file_group_id = None
+        with _expiry_cond:
+            while time.time() < next_poll:
+                if _expiry_heap and _expiry_heap[0][0] <= time.time():
+                    _, file_group_id = heapq.heappop(_expiry_heap)
+                    break
+                deadline = min(_expiry_heap[0][0], next_poll) if _expiry_heap else next_poll
+                _expiry_cond.wait(max(deadline - time.time(), 0))
+        if file_group_id is None:
+            next_poll = time.time() + EXPIRY_POLL_SECONDS
+            try:
+                load_upcoming_expiries()
+            except Exception as e:
+                print(f"读取即将过期的文件组失败: {e}", flush=True)
+            continue
+        try:
+            expire_if_due(file_group_id)
+        except Exception as e:
+            print(f"清理过期文件组 {file_group_id} 失败: {e}", flush=True)
+
+def make_safe_filename(original_filename):
+    # 生成一个安全的文件名用于存储
+    safe_filename = secure_filename(original_filename)
+    # 如果安全文件名为空（例如只包含非ASCII字符），使用一个哈希值作为文件名
+    if not safe_filename:
+        name_hash = hashlib.md5(original_filename.encode('utf-8')).hexdigest()
+        ext = original_filename.rsplit('.', 1)[1].lower() if '.' in original_filename else ''
+        safe_filename = f"{name_hash}.{ext}" if ext else name_hash
+    return safe_filename
+
+def finalize_file_group(file_group_id, pickup_code, file_info, total_group_size, expiry_unit, expiry_value, max_downloads):
+    """文件已全部保存到文件组目录后，写入文件组记录并返回最终取件码"""
+    expiry_date = None
+    if expiry_value > 0:
+        # 根据单位设置过期时间
+        if expiry_unit == 'minutes':
+            expiry_date = (datetime.datetime.now() + datetime.timedelta(minutes=expiry_value)).isoformat()
+        elif expiry_unit == 'hours':
+            expiry_date = (datetime.datetime.now() + datetime.timedelta(hours=expiry_value)).isoformat()
+        elif expiry_unit == 'days':
+            expiry_date = (datetime.datetime.now() + datetime.timedelta(days=expiry_value)).isoformat()
+        
+    pickup_code = create_group_record(file_group_id, {
+        'pickup_code': pickup_code,
+        'files': file_info,
+        'created_at': datetime.datetime.now().isoformat(),
+        'expiry_date': expiry_date,
+        'max_downloads': max_downloads if max_downloads > 0 else None,
+        'download_count': 0,
+        'download_history': [],
+        'total_size': total_group_size,
+        'status': 'scanning',
+        'scan_pid': os.getpid()
+    })
+    if expiry_date:
+        schedule_expiry(file_group_id, expiry_date)
+    # 安全检查在后台进行，上传请求不等待检查结果
+    queue_group_scan(file_group_id)
+    return pickup_code
+
+# 安全检查流水线：文件组先以 scanning 状态入库，各文件在进程池中并行检查，全部通过后才能取件
+SCAN_OPTIONS = {
+    'scanners': config["security"].get("scanners", ["local"]),
+    'scan_command': config["security"].get("scan_command", ""),
+    'forbidden_extensions': sorted(FORBIDDEN_EXTENSIONS),
+    'archive_limits': config["security"].get("archive_limits", {}),
+}
+SCAN_WORKERS = config["security"].get("scan_workers", 2)
+# 同时进行检查的文件组数（等待进程池结果的协调线程）
+SCAN_GROUP_CONCURRENCY = 4
+# 未通过检查的文件组记录保留的时间（秒），供上传者查看原因
+REJECTED_GROUP_TTL = 3600
+_scan_lock = threading.Lock()
+_scan_pool = None
+_scan_coordinator = None
+_scans_stopped = False
+
+def get_scan_pool():
+    global _scan_pool
+    with _scan_lock:
+        if _scans_stopped:
+            raise RuntimeError('服务正在退出')
+        if _scan_pool is None:
+            # spawn：子进程不继承服务器进程的线程、锁和数据库连接
+            _scan_pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=SCAN_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+        return _scan_pool
+
+def discard_scan_pool(pool):
+    # 进程池中有进程异常退出后整个池不可再用，下次使用时重建
+    global _scan_pool
+    with _scan_lock:
+        if _scan_pool is pool:
+            _scan_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def queue_group_scan(file_group_id):
+    global _scan_coordinator
+    with _scan_lock:
+        if _scan_coordinator is None:
+            _scan_coordinator = concurrent.futures.ThreadPoolExecutor(
+                max_workers=SCAN_GROUP_CONCURRENCY, thread_name_prefix='group-scan')
+        coordinator = _scan_coordinator
+    coordinator.submit(run_group_scan, file_group_id)
+
+def stop_group_scans():
+    # 退出时放弃未完成的检查，这些文件组保持 scanning 状态，由下次启动的维护进程重新检查
+    global _scans_stopped, _scan_pool
+    with _scan_lock:
+        _scans_stopped = True
+        pool, coordinator = _scan_pool, _scan_coordinator
+        # 不等到解释器退出时才回收进程池，否则其清理回调会在模块卸载后运行而报错
+        _scan_pool = None
+    if coordinator is not None:
+        coordinator.shutdown(wait=False, cancel_futures=True)
+    if pool is not None:
+        # 正在运行的检查受时间预算限制，等待它们结束后检查进程才能正常退出
+        pool.shutdown(wait=True, cancel_futures=True)
+
+@OPERATION_SECONDS.time(operation='scan_group')
+def scan_group_files(file_group_id, files):
+    """并行检查文件组中的所有文件，返回第一个未通过的原因，全部通过时返回 None"""
+    for attempt in range(2):
+        pool = get_scan_pool()
+        futures = {}
+        try:
+            for file in files:
+                if file.get('encoding'):
+                    continue  # 已通过检查后才会压缩（压缩后、标记完成前进程退出的情况）
+                future = pool.submit(scanner.scan_file, get_stored_file_path(file_group_id, file),
+                                     file['name'], SCAN_OPTIONS)
+                futures[future] = file['name']
+            for future in concurrent.futures.as_completed(futures):
+                ok, reason = future.result()
+                if not ok:
+                    for other in futures:
+                        other.cancel()
+                    return f'{futures[future]}: {reason}'
+            return None
+        except concurrent.futures.BrokenExecutor:
+            # 检查进程异常退出（例如解压时内存耗尽），重建进程池后重试一次
+            discard_scan_pool(pool)
+    return '安全检查进程异常退出'
+
+@OPERATION_SECONDS.time(operation='compress_group')
+def compress_group_files(file_group_id, files):
+    """在检查进程池中压缩文件组中值得压缩的文件，返回节省的字节数"""
+    pool = get_scan_pool()
+    futures = {}
+    for file in files:
+        if file.get('encoding'):
+            # 上次压缩写入记录后、替换原文件前进程退出的情况
+            finish_compressed_file(file_group_id, file)
+        if file.get('blob') or file.get('encoding'):
+            continue
+        future = pool.submit(compression.compress_stored_file, get_stored_file_path(file_group_id, file),
+                             file['name'], COMPRESSION_OPTIONS)
+        futures[future] = file
+    applied = []
+    try:
+        results = {}
+        for future in concurrent.futures.as_completed(futures):
+            result = future.result()
+            if result is not None:
+                results[futures[future].get('safe_name', futures[future]['name'])] = result
+        if results:
+            applied = apply_compression(file_group_id, results)
+    finally:
+        # 没有写入记录的压缩结果（出错、文件组已删除）
+        names = {file.get('safe_name', file['name']) for file in applied}
+        for file in futures.values():
+            if file.get('safe_name', file['name']) not in names:
+                with contextlib.suppress(OSError):
+                    os.remove(get_stored_file_path(file_group_id, file) + compression.TEMP_SUFFIX)
+    # 记录已提交，再用压缩结果替换原文件
+    for file in applied:
+        finish_compressed_file(file_group_id, file)
+    return sum(file['size'] - file['stored_size'] for file in applied)
+
+def apply_compression(file_group_id, results):
+    """
+    把压缩结果写入文件记录，results 为 文件名 -> (编码, 压缩后大小, 帧索引)，返回更新后的文件记录；
+    原文件在提交后由调用方替换，替换完成前读取文件时由 finish_compressed_file 补做
+    """
+    conn = get_db()
+    saved = 0
+    applied = []
+    with immediate_transaction(conn):
+        row = conn.execute("SELECT files FROM file_groups WHERE id = ? AND status = 'scanning'",
+                           (file_group_id,)).fetchone()
+        if row is None:
+            return []
+        files = json.loads(row['files'])
+        for file in files:
+            result = results.get(file.get('safe_name', file['name']))
+            if result is None or file.get('blob') or file.get('encoding'):
+                continue
+            encoding, stored_size, offsets = result
+            file.update({'encoding': encoding, 'stored_size': stored_size,
+                         'frame_size': COMPRESSION_OPTIONS['frame_size']})
+            conn.execute('INSERT OR REPLACE INTO frame_index VALUES (?, ?, ?)',
+                         (file_group_id, file.get('safe_name', file['name']), offsets))
+            saved += file['size'] - stored_size
+            applied.append(file)
+        conn.execute('UPDATE file_groups SET files = ? WHERE id = ?',
+                     (json.dumps(files, ensure_ascii=False), file_group_id))
+        _add_storage_usage(conn, -saved)
+    COMPRESSION_SAVED_BYTES.inc(saved)
+    return applied
+
+def run_group_scan(file_group_id):
+    info = get_group_record(file_group_id, with_history=False)
+    if info is None or info['status'] != 'scanning':
+        return
+    try:
+        reason = scan_group_files(file_group_id, info['files'])
+    except Exception as e:
+        if _scans_stopped:
+            return  # 服务正在退出
+        print(f"文件组 {file_group_id} 安全检查出错: {e}", flush=True)
+        reason = '安全检查出错'
+    if reason is None:
+        if COMPRESSION_ENABLED:
+            try:
+                compress_group_files(file_group_id, info['files'])
+            except Exception as e:
+                if _scans_stopped:
+                    return
+                print(f"文件组 {file_group_id} 压缩失败，保留原文件: {e}", flush=True)
+        if mark_group_ready(file_group_id):
+            _group_events.publish(file_group_id, 'status')
+    else:
+        reject_group(file_group_id, reason)
+
+def reject_group(file_group_id, reason):
+    # 删除未通过检查的文件，记录保留一段时间后由过期清理删除
+    keep_until = (datetime.datetime.now() + datetime.timedelta(seconds=REJECTED_GROUP_TTL)).isoformat()
+    result = reject_group_record(file_group_id, reason, keep_until)
+    if result is None:
+        return
+    expiry_date, trash_name = result
+    move_to_trash(trash_name, file_group_id)
+    schedule_expiry(file_group_id, expiry_date)
+    GROUPS_REMOVED.inc(reason='rejected')
+    _group_events.publish(file_group_id, 'status')
+    print(f"文件组 {file_group_id} 未通过安全检查: {reason}", flush=True)
+
+def resume_pending_scans():
+    # 重新检查因进程退出而中断的文件组
+    for file_group_id in claim_stale_scans():
+        queue_group_scan(file_group_id)
 
 def validate_expiry_settings(expiry_unit, expiry_value):
     # 验证有效期设置是否在允许范围内
@@ -194,157 +1779,479 @@ def validate_expiry_settings(expiry_unit, expiry_value):
     else:
         return config["time_limits"]["default_expiry_minutes"]
 
+def open_transfer(direction, file_group_id=None):
+    """登记当前请求的上传或下载，客户端同时进行的传输数已达上限时返回 None"""
+    environ = request.environ
+    transfer = environ.get(TRANSFER_KEY)
+    if transfer is not None and transfer.direction == direction:
+        # 异步服务器接收请求体时已登记的上传
+        return transfer
+    transfer = _transfers.open(request.remote_addr, file_group_id, direction,
+                               defer=bool(environ.get(ASYNC_THROTTLE_KEY)),
+                               throttled=not (direction == 'upload' and environ.get(BODY_THROTTLED_KEY)))
+    if transfer is not None:
+        environ[TRANSFER_KEY] = transfer
+    return transfer
+
+def too_many_transfers_response():
+    return jsonify({'error': '同时进行的传输过多，请等待其他传输完成后重试'}), 429, {'Retry-After': '5'}
+
+def precompressed_response(item, mimetype, cache_control):
+    """按 Accept-Encoding 发送预先压缩的内容，If-None-Match 匹配时返回304"""
+    quality = request.accept_encodings
+    encoding = max((e for e in assets.ENCODINGS if e in item.encoded and quality[e] > 0),
+                   key=lambda e: quality[e], default=None)
+    response = Response(item.encoded[encoding] if encoding else item.data, mimetype=mimetype)
+    # 同一内容的不同编码使用不同的ETag
+    response.set_etag(f'{item.etag}-{encoding}' if encoding else item.etag)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    if item.encoded:
+        response.vary.add('Accept-Encoding')
+    response.headers['Cache-Control'] = cache_control
+    return response.make_conditional(request)
+
+def render_static_page(template_name):
+    """只依赖配置的页面渲染一次后缓存；调试模式下每次重新渲染，以便修改模板后立即生效"""
+    render = functools.partial(render_template, template_name, config=config)
+    page = assets.Page(render()) if app.debug else _pages.get(template_name, render)
+    # 页面引用的资源地址随内容变化，页面本身每次向服务器确认
+    return precompressed_response(page, 'text/html', 'no-cache')
+
 @app.route('/')
 def index():
-    return render_template('index.html')
+    return render_static_page('index.html')
 
 @app.route('/upload', methods=['GET', 'POST'])
 def upload_file():
     if request.method == 'GET':
         # 传递配置项到模板
-        return render_template('upload.html', config=config)
+        return render_static_page('upload.html')
         
     if request.method == 'POST':
-        # 检查是否有文件
-        if 'files[]' not in request.files:
-            return jsonify({'error': '没有文件被上传'}), 400
-            
-        files = request.files.getlist('files[]')
-        if not files or files[0].filename == '':
-            return jsonify({'error': '没有选择文件'}), 400
-            
-        # 检查文件数量限制
-        if len(files) > config["file_limits"]["max_files_per_group"]:
-            return jsonify({'error': f'一次最多只能上传{config["file_limits"]["max_files_per_group"]}个文件'}), 400
-            
-        # 检查存储空间
-        has_space, current_size, max_size = check_storage_limit()
-        if not has_space:
-            return jsonify({'error': f'服务器存储空间已满 ({current_size/(1024**3):.2f}GB/{max_size/(1024**3):.2f}GB)'}), 507
-            
-        # 获取有效期和最大下载次数
-        expiry_unit = request.form.get('expiry_unit', 'minutes')
-        expiry_value = int(request.form.get('expiry_value', config["time_limits"]["default_expiry_minutes"]))
-        # 验证有效期设置
-        expiry_value = validate_expiry_settings(expiry_unit, expiry_value)
+        # 检查存储空间：解析表单前按Content-Length预留
+        reserved_bytes = request.content_length or 0
+        reservation_id, current_size, max_size = reserve_storage(reserved_bytes)
+        if reservation_id is None:
+            return jsonify({'error': f'服务器存储空间不足 ({current_size/(1024**3):.2f}GB/{max_size/(1024**3):.2f}GB)'}), 507
+        transfer = open_transfer('upload')
+        if transfer is None:
+            release_storage(reservation_id)
+            return too_many_transfers_response()
+        ACTIVE_TRANSFERS.inc(direction='upload')
+        try:
+            return save_uploaded_group(transfer)
+        finally:
+            ACTIVE_TRANSFERS.dec(direction='upload')
+            transfer.close()
+            release_storage(reservation_id)
+
+def save_uploaded_group(transfer=None):
+    # 解析上传表单、保存文件并创建文件组；集群模式下使用选择节点时的ID
+    file_group_id = g.get('cluster_key') or str(uuid.uuid4())
+    group_folder = os.path.join(app.config['UPLOAD_FOLDER'], file_group_id)
+    os.makedirs(group_folder, exist_ok=True)
+    # 文件在解析表单的同时经过流水线写入临时文件
+    request.upload_pipeline = pipeline = UploadPipeline(group_folder, transfer)
+    try:
+        return receive_uploaded_group(file_group_id, group_folder)
+    except UploadRejected as e:
+        pipeline.close()
+        discard_folder(group_folder)
+        return jsonify({'error': e.message}), e.status
+    except Exception:
+        pipeline.close()
+        discard_folder(group_folder)
+        raise
+
+def receive_uploaded_group(file_group_id, group_folder):
+    
+    # 检查是否有文件
+    if 'files[]' not in request.files:
+        raise UploadRejected('没有文件被上传')
         
-        max_downloads = int(request.form.get('max_downloads', 0))
+    files = request.files.getlist('files[]')
+    if not files or files[0].filename == '':
+        raise UploadRejected('没有选择文件')
         
-        # 创建文件组ID和取件码
-        file_group_id = str(uuid.uuid4())
+    # 获取有效期和最大下载次数
+    expiry_unit = request.form.get('expiry_unit', 'minutes')
+    expiry_value = int(request.form.get('expiry_value', config["time_limits"]["default_expiry_minutes"]))
+    # 验证有效期设置
+    expiry_value = validate_expiry_settings(expiry_unit, expiry_value)
+    
+    max_downloads = int(request.form.get('max_downloads', 0))
+    
+    # 创建取件码
+    try:
         pickup_code = generate_pickup_code()
+    except RuntimeError as e:
+        raise UploadRejected(f'{e}，请稍后再试', 503)
+    
+    # 大小限制和文件头检查已在接收时完成，这里只需移动到最终位置，完整的安全检查在文件组入库后进行
+    file_info = []
+    total_group_size = 0
+    
+    for file in files:
+        writer = file.stream
+        if not isinstance(writer, UploadFileWriter):
+            raise UploadRejected('不支持的文件类型或包含潜在危险文件')
+        original_filename = file.filename
+        safe_filename = make_safe_filename(original_filename)
+        file_path = os.path.join(group_folder, safe_filename)
+        sha256 = writer.finish(file_path)
         
-        # 确保目录存在
-        group_folder = os.path.join(app.config['UPLOAD_FOLDER'], file_group_id)
-        os.makedirs(group_folder, exist_ok=True)
-        
-        # 处理文件上传
-        file_info = []
-        total_group_size = 0
+        total_group_size += writer.size
+        file_info.append({
+            'name': original_filename,  # 保存原始文件名用于显示
+            'safe_name': safe_filename,  # 保存安全文件名用于存储
+            'size': writer.size,
+            'sha256': sha256,
+            'crc32': writer.crc32,
+            'upload_time': datetime.datetime.now().isoformat()
+        })
+    
+    # 去重模式下所有检查通过后再放入blob存储
+    if DEDUP_ENABLED:
+        for file in file_info:
+            store_blob(os.path.join(group_folder, file['safe_name']), file['sha256'], file['size'], file['crc32'])
+            file['blob'] = file['sha256']
+    
+    # 保存文件组信息
+    pickup_code = finalize_file_group(file_group_id, pickup_code, file_info, total_group_size,
+                                      expiry_unit, expiry_value, max_downloads)
+    # 返回上传成功信息
+    return jsonify({
+        'success': True,
+        'file_group_id': file_group_id,
+        'pickup_code': pickup_code,
+        'status': 'scanning'
+    })
+
+def check_upload_limits(files):
+    """检查待上传文件列表（name、size）的数量、类型和大小，返回错误信息或 None"""
+    if not files:
+        return '没有选择文件'
+    if len(files) > config["file_limits"]["max_files_per_group"]:
+        return f'一次最多只能上传{config["file_limits"]["max_files_per_group"]}个文件'
+    for file in files:
+        # 与表单上传相同的文件名检查
+        if not allowed_file(file['name']) or not check_filename_safety(file['name']):
+            return '不支持的文件类型或包含潜在危险文件'
+        if file['size'] > MAX_CONTENT_LENGTH:
+            return f'文件 {file["name"]} 过大，超过{config["file_limits"]["max_file_size_mb"]}MB限制'
+    if sum(file['size'] for file in files) > config["file_limits"]["max_group_size_mb"] * 1024 * 1024:
+        return f'文件组总大小超过{config["file_limits"]["max_group_size_mb"]}MB限制'
+    return None
+
+def upload_session_response(upload_id, session):
+    return jsonify({
+        'success': True,
+        'upload_id': upload_id,
+        'chunk_size': session['chunk_size'],
+        'files': [{
+            'index': index,
+            'name': file['name'],
+            'size': file['size'],
+            'chunks': file['chunks'],
+            'required': file.get('required'),
+            'received': file.get('received', [])
+        } for index, file in enumerate(session['files'])]
+    })
+
+def remove_upload_session(upload_id):
+    delete_upload_session_record(upload_id)
+    if _catalog is not None:
+        _catalog.remove_upload(upload_id)
+    discard_folder(os.path.join(UPLOAD_SESSION_FOLDER, upload_id))
+
+@app.route('/api/uploads', methods=['POST'])
+def create_upload_session():
+    """
+    创建分块上传会话
+    请求体为JSON：{"files": [{"name", "size", "sha256"(可选)}], "expiry_value", "expiry_unit", "max_downloads"}
+    """
+    payload = request.get_json(silent=True) or {}
+    try:
+        files = [{'name': str(f['name']), 'size': int(f['size']), 'sha256': str(f.get('sha256') or '').lower()}
+                 for f in payload.get('files', [])]
+        expiry_unit = payload.get('expiry_unit', 'minutes')
+        expiry_value = validate_expiry_settings(
+            expiry_unit, int(payload.get('expiry_value', config["time_limits"]["default_expiry_minutes"])))
+        max_downloads = int(payload.get('max_downloads', 0))
+    except (KeyError, TypeError, ValueError):
+        return jsonify({'error': '上传参数无效'}), 400
+    if any(file['size'] < 0 for file in files):
+        return jsonify({'error': '上传参数无效'}), 400
+    
+    error = check_upload_limits(files)
+    if error:
+        return jsonify({'error': error}), 400
+    
+    for file in files:
+        file['chunks'] = (file['size'] + UPLOAD_CHUNK_SIZE - 1) // UPLOAD_CHUNK_SIZE
+        # 已有相同内容的文件只需上传随机抽取的分块用于校验，校验通过后直接引用（秒传）
+        if INSTANT_UPLOAD_ENABLED and file['sha256'] and file['chunks'] and find_blob(file['sha256'], file['size']):
+            file['required'] = sorted(random.sample(range(file['chunks']), min(2, file['chunks'])))
+        elif not file['sha256']:
+            del file['sha256']
+    session = {
+        'files': files,
+        'chunk_size': UPLOAD_CHUNK_SIZE,
+        # 秒传的文件不占用新空间，不计入预留
+        'total_size': sum(file['size'] for file in files if 'required' not in file),
+        'expiry_unit': expiry_unit,
+        'expiry_value': expiry_value,
+        'max_downloads': max_downloads
+    }
+    
+    upload_id = g.get('cluster_key') or str(uuid.uuid4())
+    max_size = config["file_limits"]["total_storage_limit_gb"] * 1024 * 1024 * 1024
+    created, current_size = create_upload_session_record(upload_id, session, max_size)
+    if not created:
+        return jsonify({'error': f'服务器存储空间不足 ({current_size/(1024**3):.2f}GB/{max_size/(1024**3):.2f}GB)'}), 507
+    if _catalog is not None:
+        # 其他节点收到的分块按目录转发到本节点
+        _catalog.register_upload(upload_id, NODE_ID, datetime.datetime.now().isoformat())
+    
+    # 预先创建各文件的临时文件，分块按偏移直接写入，完成时无需再拼接
+    session_folder = os.path.join(UPLOAD_SESSION_FOLDER, upload_id)
+    os.makedirs(session_folder, exist_ok=True)
+    for index, file in enumerate(files):
+        with open(os.path.join(session_folder, f'{index}.part'), 'wb') as f:
+            f.truncate(file['size'])
+    
+    return upload_session_response(upload_id, session)
+
+@app.route('/api/uploads/<upload_id>', methods=['GET'])
+def get_upload_session(upload_id):
+    # 查询已收到的分块，用于断点续传
+    session = get_upload_session_record(upload_id)
+    if session is None:
+        return jsonify({'error': '上传会话不存在或已过期'}), 404
+    return upload_session_response(upload_id, session)
+
+@app.route('/api/uploads/<upload_id>', methods=['DELETE'])
+def abort_upload_session(upload_id):
+    if get_upload_session_record(upload_id) is None:
+        return jsonify({'error': '上传会话不存在或已过期'}), 404
+    remove_upload_session(upload_id)
+    return jsonify({'success': True})
+
+@app.route('/api/uploads/<upload_id>/<int:file_index>/<int:chunk_index>', methods=['PUT'])
+def upload_chunk(upload_id, file_index, chunk_index):
+    session = get_upload_session_record(upload_id)
+    if session is None:
+        return jsonify({'error': '上传会话不存在或已过期'}), 404
+    if file_index >= len(session['files']) or chunk_index >= session['files'][file_index]['chunks']:
+        return jsonify({'error': '分块编号无效'}), 400
+    
+    file = session['files'][file_index]
+    chunk_size = session['chunk_size']
+    offset = chunk_index * chunk_size
+    expected = min(chunk_size, file['size'] - offset)
+    if request.content_length != expected:
+        return jsonify({'error': f'分块大小应为 {expected} 字节'}), 400
+    
+    # 边接收边写入临时文件的对应位置，不在内存中缓存整个分块
+    part_path = os.path.join(UPLOAD_SESSION_FOLDER, upload_id, f'{file_index}.part')
+    written = 0
+    transfer = open_transfer('upload')
+    if transfer is None:
+        return too_many_transfers_response()
+    ACTIVE_TRANSFERS.inc(direction='upload')
+    try:
+        with open(part_path, 'r+b') as f:
+            f.seek(offset)
+            while written < expected:
+                data = request.stream.read(min(64 * 1024, expected - written))
+                if not data:
+                    break
+                f.write(data)
+                written += len(data)
+                transfer.throttle(len(data))
+    except FileNotFoundError:
+        return jsonify({'error': '上传会话不存在或已过期'}), 404
+    finally:
+        ACTIVE_TRANSFERS.dec(direction='upload')
+        transfer.close()
+        UPLOADED_BYTES.inc(written)
+    if written != expected:
+        return jsonify({'error': '分块数据不完整'}), 400
+    
+    # 第一个分块到达时立即检查文件头，发现危险内容直接作废整个会话
+    if chunk_index == 0:
+        with open(part_path, 'rb') as f:
+            head = f.read(min(HEADER_SNIFF_BYTES, expected))
+        if not check_file_header(file['name'], head):
+            remove_upload_session(upload_id)
+            return jsonify({'error': '发现潜在危险文件，上传已取消'}), 400
+        if not check_extension_matches(file['name'], head):
+            remove_upload_session(upload_id)
+            return jsonify({'error': '文件内容与扩展名不符，上传已取消'}), 400
+    
+    mark_chunk_received(upload_id, file_index, chunk_index)
+    return jsonify({'success': True})
+
+@app.route('/api/uploads/<upload_id>/complete', methods=['POST'])
+def complete_upload_session(upload_id):
+    # 所有分块到齐后生成文件组
+    session = get_upload_session_record(upload_id)
+    if session is None:
+        return jsonify({'error': '上传会话不存在或已过期'}), 404
+    missing = sum(len(set(file.get('required') or range(file['chunks'])) - set(file['received']))
+                  for file in session['files'])
+    if missing:
+        return jsonify({'error': f'还有 {missing} 个分块未上传'}), 409
+    
+    try:
+        pickup_code = generate_pickup_code()
+    except RuntimeError as e:
+        return jsonify({'error': f'{e}，请稍后再试'}), 503
+    
+    # 认领会话，避免并发的完成请求重复生成文件组；会话的空间预留在文件组入账前转为预留记录
+    reservation_id = claim_upload_session(upload_id)
+    if reservation_id is None:
+        return jsonify({'error': '上传会话不存在或已过期'}), 404
+    if _catalog is not None:
+        _catalog.remove_upload(upload_id)
+    try:
+        return assemble_upload_session(upload_id, session, pickup_code)
+    finally:
+        release_storage(reservation_id)
+
+def verify_sampled_chunks(part_path, file, chunk_size):
+    # 比较客户端上传的抽样分块与已有blob的对应内容
+    with open(part_path, 'rb') as part, open(blob_path(file['sha256']), 'rb') as blob:
+        for chunk_index in file['required']:
+            offset = chunk_index * chunk_size
+            length = min(chunk_size, file['size'] - offset)
+            part.seek(offset)
+            blob.seek(offset)
+            if part.read(length) != blob.read(length):
+                return False
+    return True
+
+def assemble_upload_session(upload_id, session, pickup_code):
+    # 临时文件直接移动到文件组目录（同一磁盘上只是重命名）
+    session_folder = os.path.join(UPLOAD_SESSION_FOLDER, upload_id)
+    file_group_id = str(uuid.uuid4())
+    group_folder = os.path.join(app.config['UPLOAD_FOLDER'], file_group_id)
+    os.makedirs(group_folder, exist_ok=True)
+    
+    file_info = []
+    total_group_size = 0
+    blob_refs = []
+    
+    def fail(message, status):
+        release_blobs(blob_refs)
+        discard_folder(group_folder)
+        discard_folder(session_folder)
+        return jsonify({'error': message}), status
+    
+    for index, file in enumerate(session['files']):
+        safe_filename = make_safe_filename(file['name'])
+        part_path = os.path.join(session_folder, f'{index}.part')
+        if not os.path.exists(part_path):
+            return fail('上传会话不存在或已过期', 404)
         
-        for file in files:
-            if file and allowed_file(file.filename):                
-                original_filename = file.filename
-                # 生成一个安全的文件名用于存储
-                safe_filename = secure_filename(original_filename)
-                # 如果安全文件名为空（例如只包含非ASCII字符），使用一个哈希值作为文件名
-                if not safe_filename:
-                    name_hash = hashlib.md5(original_filename.encode('utf-8')).hexdigest()
-                    ext = original_filename.rsplit('.', 1)[1].lower() if '.' in original_filename else ''
-                    safe_filename = f"{name_hash}.{ext}" if ext else name_hash
-                
-                file_path = os.path.join(group_folder, safe_filename)
-                file.save(file_path)
-                
-                # 检查病毒
-                if not check_file_for_virus(file_path):
-                    shutil.rmtree(group_folder)  # 删除整个文件夹
-                    return jsonify({'error': '发现潜在危险文件，上传已取消'}), 400
-                
-                file_size = os.path.getsize(file_path)
-                
-                # 检查单个文件大小
-                if file_size > MAX_CONTENT_LENGTH:
-                    shutil.rmtree(group_folder)
-                    return jsonify({'error': f'文件 {original_filename} 过大，超过{config["file_limits"]["max_file_size_mb"]}MB限制'}), 413
-                    
-                total_group_size += file_size
-                
-                # 检查文件组总大小
-                if total_group_size > config["file_limits"]["max_group_size_mb"] * 1024 * 1024:
-                    shutil.rmtree(group_folder)
-                    return jsonify({'error': f'文件组总大小超过{config["file_limits"]["max_group_size_mb"]}MB限制'}), 413
-                
-                file_info.append({
-                    'name': original_filename,  # 保存原始文件名用于显示
-                    'safe_name': safe_filename,  # 保存安全文件名用于存储
-                    'size': file_size,
-                    'upload_time': datetime.datetime.now().isoformat()
-                })
-            else:
-                shutil.rmtree(group_folder)
-                return jsonify({'error': f'不支持的文件类型或包含潜在危险文件'}), 400
+        if file.get('required'):
+            # 秒传：校验抽样分块后直接引用已有的blob
+            try:
+                verified = verify_sampled_chunks(part_path, file, session['chunk_size'])
+            except FileNotFoundError:
+                verified = False
+            if not verified:
+                return fail('文件校验失败，请重新上传', 409)
+            blob = add_blob_ref(file['sha256'], file['size'])
+            if blob is None:
+                return fail('文件校验失败，请重新上传', 409)
+            blob_refs.append(file['sha256'])
+            sha256, crc32 = file['sha256'], blob['crc32']
+        else:
+            file_path = os.path.join(group_folder, safe_filename)
+            os.replace(part_path, file_path)
+            sha256, crc32 = hash_file(file_path)
+            if DEDUP_ENABLED:
+                store_blob(file_path, sha256, file['size'], crc32)
+                blob_refs.append(sha256)
         
-        # 保存文件组信息
-        data = load_data()
-        expiry_date = None
-        if expiry_value > 0:
-            # 根据单位设置过期时间
-            if expiry_unit == 'minutes':
-                expiry_date = (datetime.datetime.now() + datetime.timedelta(minutes=expiry_value)).isoformat()
-            elif expiry_unit == 'hours':
-                expiry_date = (datetime.datetime.now() + datetime.timedelta(hours=expiry_value)).isoformat()
-            elif expiry_unit == 'days':
-                expiry_date = (datetime.datetime.now() + datetime.timedelta(days=expiry_value)).isoformat()
-            
-        data["file_groups"][file_group_id] = {
-            'pickup_code': pickup_code,
-            'files': file_info,
-            'created_at': datetime.datetime.now().isoformat(),
-            'expiry_date': expiry_date,
-            'max_downloads': max_downloads if max_downloads > 0 else None,
-            'download_count': 0,
-            'download_history': [],
-            'total_size': total_group_size
+        total_group_size += file['size']
+        entry = {
+            'name': file['name'],
+            'safe_name': safe_filename,
+            'size': file['size'],
+            'sha256': sha256,
+            'upload_time': datetime.datetime.now().isoformat()
         }
-        save_data(data)
-          # 返回上传成功信息
-        return jsonify({
-            'success': True,
-            'file_group_id': file_group_id,
-            'pickup_code': pickup_code
-        })
+        if crc32 is not None:
+            entry['crc32'] = crc32
+        if DEDUP_ENABLED:
+            entry['blob'] = sha256
+        file_info.append(entry)
+    discard_folder(session_folder)
+    
+    pickup_code = finalize_file_group(file_group_id, pickup_code, file_info, total_group_size,
+                                      session['expiry_unit'], session['expiry_value'], session['max_downloads'])
+    return jsonify({
+        'success': True,
+        'file_group_id': file_group_id,
+        'pickup_code': pickup_code,
+        'status': 'scanning'
+    })
+
+def clean_stale_upload_sessions():
+    # 清理长时间没有新分块的上传会话，以及没有会话记录的临时目录
+    cutoff = datetime.datetime.now() - datetime.timedelta(minutes=UPLOAD_SESSION_TIMEOUT)
+    for upload_id in list_stale_upload_sessions(cutoff):
+        remove_upload_session(upload_id)
+    if os.path.exists(UPLOAD_SESSION_FOLDER):
+        for upload_id in os.listdir(UPLOAD_SESSION_FOLDER):
+            folder = os.path.join(UPLOAD_SESSION_FOLDER, upload_id)
+            if get_upload_session_record(upload_id) is None and os.path.getmtime(folder) < cutoff.timestamp():
+                discard_folder(folder)
+
+def upload_session_gc_loop():
+    while True:
+        try:
+            clean_stale_upload_sessions()
+        except Exception as e:
+            print(f"清理上传会话失败: {e}", flush=True)
+        try:
+            # 处理上传的进程退出后，它未完成的安全检查由维护进程接手
+            resume_pending_scans()
+        except Exception as e:
+            print(f"恢复安全检查失败: {e}", flush=True)
+        time.sleep(300)
 
 @app.route('/pickup', methods=['GET', 'POST'])
 def pickup_file():
     if request.method == 'GET':
-        return render_template('pickup.html')
+        return render_static_page('pickup.html')
         
     if request.method == 'POST':
         pickup_code = request.form.get('pickup_code')
         if not pickup_code:
             return jsonify({'error': '请输入取件码'}), 400
             
-        # 清理过期文件
-        clean_expired_files()
-            
         # 查找对应文件组
-        data = load_data()
-        file_group_id = None
-        
-        for f_id, info in data["file_groups"].items():
-            if info.get('pickup_code') == pickup_code:
-                file_group_id = f_id
-                break
+        file_group_id = find_group_id_by_code(pickup_code)
+        file_group = get_valid_group(file_group_id)
         
-        if not file_group_id:
+        if not file_group:
             return jsonify({'error': '取件码无效或已过期'}), 404
             
-        # 创建下载令牌
-        token = create_download_token(file_group_id)
+        # 安全检查通过后才能取件
+        if file_group['status'] == 'scanning':
+            return jsonify({'error': '文件正在进行安全检查，请稍后再试', 'status': 'scanning'}), 409
+        if file_group['status'] != 'ready':
+            return jsonify({'error': '文件未通过安全检查', 'status': file_group['status']}), 404
+            
+        # 创建下载令牌，多人同时取件时各自的令牌互不影响
+        token = create_download_token(file_group_id, file_group)
         
         # 返回文件列表和下载令牌
-        file_info = data["file_groups"][file_group_id]['files']
+        file_info = file_group['files']
         return jsonify({
             'success': True,
             'file_group_id': file_group_id,
@@ -352,119 +2259,503 @@ def pickup_file():
             'files': file_info
         })
 
+# 流式ZIP打包（存储模式，不压缩）：各部分长度在开始传输前即可确定，支持断点续传
+ZIP_READ_BLOCK = 256 * 1024
+ZIP64_LIMIT = 0xFFFFFFFF
+
+def _dos_datetime(iso_time):
+    try:
+        t = datetime.datetime.fromisoformat(iso_time)
+    except (TypeError, ValueError):
+        t = datetime.datetime(1980, 1, 1)
+    t = max(t, datetime.datetime(1980, 1, 1))
+    return (t.hour << 11) | (t.minute << 5) | (t.second // 2), ((t.year - 1980) << 9) | (t.month << 5) | t.day
+
+def build_zip_layout(entries):
+    """
+    按确定的顺序生成ZIP文件的各个片段
+    entries 为 (文件名, 打开文件的函数, 大小, CRC-32或None, 上传时间) 列表；CRC未知时使用数据描述符，
+    返回片段列表，片段为 bytes、('file', 索引) 或 ('descriptor', 索引)
+    """
+    segments = []
+    central = []
+    offset = 0
+    for index, (arcname, opener, size, crc32, mtime) in enumerate(entries):
+        name = arcname.encode('utf-8')
+        dos_time, dos_date = _dos_datetime(mtime)
+        zip64 = size >= ZIP64_LIMIT
+        use_descriptor = crc32 is None
+        flags = 0x0800 | (0x0008 if use_descriptor else 0)  # UTF-8文件名，可选的数据描述符
+        version = 45 if zip64 or offset >= ZIP64_LIMIT else 20
+        header_crc = 0 if use_descriptor else crc32
+        if zip64:
+            extra = struct.pack('<HHQQ', 0x0001, 16, size, size)
+            header_size = ZIP64_LIMIT
+        else:
+            extra = b''
+            header_size = size
+        local = struct.pack('<IHHHHHIIIHH', 0x04034b50, version, flags, 0, dos_time, dos_date,
+                            header_crc, header_size, header_size, len(name), len(extra)) + name + extra
+        central.append((name, version, flags, dos_time, dos_date, index, size, offset, zip64))
+        segments.append(local)
+        segments.append(('file', index))
+        offset += len(local) + size
+        if use_descriptor:
+            segments.append(('descriptor', index))
+            offset += 24 if zip64 else 16
+    
+    cd_start = offset
+    cd = b''
+    for name, version, flags, dos_time, dos_date, index, size, entry_offset, zip64 in central:
+        crc32 = entries[index][3]
+        zip64_fields = []
+        if zip64:
+            zip64_fields += [size, size]
+        if entry_offset >= ZIP64_LIMIT:
+            zip64_fields.append(entry_offset)
+        extra = struct.pack('<HH' + 'Q' * len(zip64_fields), 0x0001, 8 * len(zip64_fields), *zip64_fields) if zip64_fields else b''
+        cd += struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, version, version, flags, 0, dos_time, dos_date,
+                          crc32 or 0, ZIP64_LIMIT if zip64 else size, ZIP64_LIMIT if zip64 else size,
+                          len(name), len(extra), 0, 0, 0, 0,
+                          ZIP64_LIMIT if entry_offset >= ZIP64_LIMIT else entry_offset) + name + extra
+    count = len(entries)
+    end = b''
+    if count >= 0xFFFF or cd_start >= ZIP64_LIMIT or len(cd) >= ZIP64_LIMIT:
+        zip64_end_offset = cd_start + len(cd)
+        end += struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, 45, 45, 0, 0, count, count, len(cd), cd_start)
+        end += struct.pack('<IIQI', 0x07064b50, 0, zip64_end_offset, 1)
+    end += struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, min(count, 0xFFFF), min(count, 0xFFFF),
+                       min(len(cd), ZIP64_LIMIT), min(cd_start, ZIP64_LIMIT), 0)
+    # 中央目录里的CRC要等数据描述符算出后才能确定，这里作为独立片段在最后生成
+    segments.append(('central', cd, end))
+    return segments
+
+def zip_segment_length(segment, entries):
+    if isinstance(segment, bytes):
+        return len(segment)
+    if segment[0] == 'file':
+        return entries[segment[1]][2]
+    if segment[0] == 'descriptor':
+        return 24 if entries[segment[1]][2] >= ZIP64_LIMIT else 16
+    return len(segment[1]) + len(segment[2])
+
+def iter_zip_stream(entries, segments, start=0, end=None):
+    """生成 [start, end] 范围内的ZIP数据，只有CRC全部已知时才能从中间开始"""
+    computed_crc = {}
+    position = 0
+    for segment in segments:
+        length = zip_segment_length(segment, entries)
+        seg_start, seg_end = position, position + length
+        position = seg_end
+        if end is not None and seg_start > end:
+            break
+        if isinstance(segment, bytes) or segment[0] in ('descriptor', 'central'):
+            if isinstance(segment, bytes):
+                data = segment
+            elif segment[0] == 'descriptor':
+                size = entries[segment[1]][2]
+                fmt = '<IIQQ' if size >= ZIP64_LIMIT else '<IIII'
+                data = struct.pack(fmt, 0x08074b50, computed_crc[segment[1]], size, size)
+            else:
+                data = segment[1] + segment[2]
+                if computed_crc:
+                    data = _patch_central_crc(data, computed_crc, entries)
+            if seg_end <= start:
+                continue
+            lo = max(start - seg_start, 0)
+            hi = length if end is None else min(end + 1 - seg_start, length)
+            yield data[lo:hi]
+            continue
+        # 文件内容
+        index = segment[1]
+        arcname, opener = entries[index][:2]
+        need_crc = entries[index][3] is None
+        if seg_end <= start and not need_crc:
+            continue
+        crc32 = 0
+        with opener() as f:
+            read_from = 0 if need_crc else max(start - seg_start, 0)
+            f.seek(read_from)
+            pos = seg_start + read_from
+            while pos < seg_end:
+                block = f.read(min(ZIP_READ_BLOCK, seg_end - pos))
+                if not block:
+                    raise IOError(f'文件长度与记录不一致: {arcname}')
+                if need_crc:
+                    crc32 = zlib.crc32(block, crc32)
+                block_start = pos
+                pos += len(block)
+                if pos <= start or (end is not None and block_start > end):
+                    continue
+                lo = max(start - block_start, 0)
+                hi = len(block) if end is None else min(end + 1 - block_start, len(block))
+                yield block[lo:hi]
+        if need_crc:
+            computed_crc[index] = crc32
+
+def _patch_central_crc(cd, computed_crc, entries):
+    # 把流式计算出的CRC写回中央目录
+    cd = bytearray(cd)
+    pos = 0
+    index = 0
+    while pos < len(cd) and index < len(entries):
+        name_len, extra_len, comment_len = struct.unpack_from('<HHH', cd, pos + 28)
+        if index in computed_crc:
+            struct.pack_into('<I', cd, pos + 16, computed_crc[index])
+        pos += 46 + name_len + extra_len + comment_len
+        index += 1
+    return bytes(cd)
+
+def count_downloaded_bytes(chunks, transfer=None):
+    for chunk in chunks:
+        DOWNLOADED_BYTES.inc(len(chunk))
+        if transfer is not None:
+            transfer.throttle(len(chunk))
+        yield chunk
+
+def zip_entries_for_group(file_group_id, file_group):
+    # 文件名重复时加上序号，避免解压时互相覆盖
+    entries = []
+    used_names = set()
+    for file in file_group['files']:
+        arcname = file['name']
+        stem, dot, ext = arcname.rpartition('.')
+        counter = 1
+        while arcname in used_names:
+            arcname = f'{stem} ({counter}).{ext}' if dot else f'{file["name"]} ({counter})'
+            counter += 1
+        used_names.add(arcname)
+        entries.append((arcname, functools.partial(open_stored_file, file_group_id, file), file.get('size', 0),
+                        file.get('crc32'), file.get('upload_time')))
+    return entries
+
+@app.route('/download/<file_group_id>.zip')
+def download_all_files(file_group_id):
+    # 把整个文件组打包成一个ZIP流式下载，计为一次下载
+    token = request.args.get('token')
+    file_group = get_group_record(file_group_id, with_history=False)
+    if not token or not validate_token(file_group_id, file_group, token):
+        return jsonify({'error': '无效或已过期的下载链接'}), 403
+    
+    if file_group['status'] != 'ready' or is_group_expired(file_group, check_downloads=False):
+        return jsonify({'error': '找不到请求的文件'}), 404
+    
+    for file in file_group['files']:
+        if not stored_file_intact(file_group_id, file):
+            return jsonify({'error': f'文件 {file["name"]} 不存在'}), 404
+    entries = zip_entries_for_group(file_group_id, file_group)
+    segments = build_zip_layout(entries)
+    total_length = sum(zip_segment_length(segment, entries) for segment in segments)
+    # CRC全部已知时布局完全确定，可以从任意位置续传
+    rangeable = all(entry[3] is not None for entry in entries)
+    
+    byte_range = request.range.range_for_length(total_length) if request.range and rangeable else None
+    transfer = open_transfer('download', file_group_id)
+    if transfer is None:
+        return too_many_transfers_response()
+    status = download_count = None
+    # 从头开始的Range请求同样计数，只有续传不计
+    if byte_range is None or byte_range[0] == 0:
+        client_id = f"{request.remote_addr}-{request.user_agent.string}"
+        status, download_count = record_download(file_group_id, client_id, '全部文件(ZIP)', request.remote_addr)
+        if status == 'limit':
+            transfer.close()
+            return jsonify({'error': '下载次数已达上限'}), 403
+    
+    start, stop = byte_range if byte_range else (0, total_length)
+    ACTIVE_TRANSFERS.inc(direction='download')
+    response = Response(count_downloaded_bytes(iter_zip_stream(entries, segments, start, stop - 1), transfer),
+                        status=206 if byte_range else 200, mimetype='application/zip')
+    response.call_on_close(lambda: ACTIVE_TRANSFERS.dec(direction='download'))
+    response.call_on_close(transfer.close)
+    response.headers['Content-Length'] = str(stop - start)
+    if byte_range:
+        response.headers['Content-Range'] = f'bytes {start}-{stop - 1}/{total_length}'
+    response.headers['Accept-Ranges'] = 'bytes' if rangeable else 'none'
+    response.headers['Cache-Control'] = 'no-cache'
+    zip_name = f'files-{file_group["pickup_code"]}.zip'
+    response.headers['Content-Disposition'] = f'attachment; filename="{zip_name}"'
+    
+    max_downloads = file_group.get('max_downloads')
+    if status == 'recorded' and max_downloads and download_count >= max_downloads:
+        response.call_on_close(lambda: schedule_expiry(file_group_id))
+    return response
+
+# 下载引擎：一次fstat，强ETag，If-Range，多段Range；服务器提供 wsgi.file_wrapper 时由服务器零拷贝发送
+DOWNLOAD_READ_BLOCK = 256 * 1024
+# 单个请求最多接受的Range段数，超过时忽略Range返回整个文件
+MAX_BYTE_RANGES = 64
+# 这些服务器的 file_wrapper 按Content-Length发送，可用于文件中间的一段；其他服务器只用于发送到文件末尾
+LENGTH_BOUNDED_FILE_WRAPPERS = ('gunicorn', 'waitress')
+
+class DownloadFile(io.FileIO):
+    """下载用的文件对象，关闭时执行回调（服务器在传输结束后关闭文件）"""
+    def __init__(self, path):
+        super().__init__(path, 'rb')
+        self.on_close = []
+    
+    def close(self):
+        if self.closed:
+            return
+        super().close()
+        for callback in self.on_close:
+            callback()
+
+class FileRangeIterator:
+    """按块读取文件中的一段，服务器没有 file_wrapper 或需要限速时使用"""
+    def __init__(self, file, start, length, transfer=None):
+        self.file = file
+        self.start = start
+        self.length = length
+        self.transfer = transfer
+    
+    def __iter__(self):
+        self.file.seek(self.start)
+        remaining = self.length
+        while remaining > 0:
+            block = self.file.read(min(DOWNLOAD_READ_BLOCK, remaining))
+            if not block:
+                break
+            remaining -= len(block)
+            DOWNLOADED_BYTES.inc(len(block))
+            if self.transfer is not None:
+                self.transfer.throttle(len(block))
+            yield block
+    
+    def close(self):
+        self.file.close()
+
+class MultiRangeIterator:
+    """multipart/byteranges 响应体"""
+    def __init__(self, file, ranges, size, content_type, boundary, transfer=None):
+        self.file = file
+        self.transfer = transfer
+        self.parts = []
+        for start, stop in ranges:
+            header = (f'\r\n--{boundary}\r\nContent-Type: {content_type}\r\n'
+                      f'Content-Range: bytes {start}-{stop - 1}/{size}\r\n\r\n').encode('latin-1')
+            self.parts.append((header, start, stop - start))
+        self.trailer = f'\r\n--{boundary}--\r\n'.encode('latin-1')
+    
+    def content_length(self):
+        return sum(len(header) + length for header, _, length in self.parts) + len(self.trailer)
+    
+    def __iter__(self):
+        for header, start, length in self.parts:
+            yield header
+            yield from FileRangeIterator(self.file, start, length, self.transfer)
+        yield self.trailer
+    
+    def close(self):
+        self.file.close()
+
+def parse_byte_ranges(size):
+    """
+    解析请求的Range头
+    返回 None 表示按整个文件响应，空列表表示无法满足（416），否则为按顺序合并后的 (start, stop) 列表
+    """
+    byte_range = request.range
+    if byte_range is None or byte_range.units != 'bytes':
+        return None
+    ranges = []
+    for begin, end in byte_range.ranges:
+        if begin < 0:
+            start, stop = max(size + begin, 0), size
+        else:
+            start, stop = begin, min(end if end is not None else size, size)
+        if start < stop:
+            ranges.append((start, stop))
+    ranges.sort()
+    merged = []
+    for start, stop in ranges:
+        # 重叠的区间合并，避免重复发送同一段数据
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+        else:
+            merged.append((start, stop))
+    if len(merged) > MAX_BYTE_RANGES:
+        return None
+    return merged
+
+def if_range_matches(etag, last_modified):
+    # If-Range 不匹配说明文件已变化，此时忽略Range返回整个文件
+    if_range = request.if_range
+    if not request.headers.get('If-Range'):
+        return True
+    if if_range.etag is not None:
+        return if_range.etag == etag
+    return if_range.date is not None and int(if_range.date.timestamp()) == last_modified
+
+def is_not_modified(etag, last_modified):
+    # 条件请求：客户端缓存的内容未变化时返回304
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    if request.if_modified_since is not None:
+        return int(request.if_modified_since.timestamp()) >= last_modified
+    return False
+
+def content_disposition_params(download_name):
+    # 与send_file相同：非ASCII文件名同时提供 filename*（RFC 5987）
+    try:
+        download_name.encode('ascii')
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize('NFKD', download_name).encode('ascii', 'ignore').decode('ascii')
+        quoted = urllib.parse.quote(download_name, safe="!#$&+^`|~")
+        return {'filename': simple, 'filename*': f"UTF-8''{quoted}"}
+    return {'filename': download_name}
+
 @app.route('/download/<file_group_id>/<filename>')
 def download_file(file_group_id, filename):
+    # 加载文件数据；下载次数上限在记录下载时检查，续传请求不受影响
     token = request.args.get('token')
-    if not token or not validate_token(file_group_id, token):
+    file_group = get_group_record(file_group_id, with_history=False)
+    if not token or not validate_token(file_group_id, file_group, token, filename):
         return jsonify({'error': '无效或已过期的下载链接'}), 403
-        
-    # 加载文件数据
-    data = load_data()
-    if file_group_id not in data["file_groups"]:
+    
+    if file_group['status'] != 'ready' or is_group_expired(file_group, check_downloads=False):
         return jsonify({'error': '找不到请求的文件'}), 404
-        
-    # 查找对应的安全文件名
-    safe_filename = None
-    original_filename = filename
-    file_size = 0
-    
-    for file in data["file_groups"][file_group_id]['files']:
-        if file['name'] == filename:
-            # 如果是旧数据可能没有safe_name字段，此时name和safe_name相同
-            safe_filename = file.get('safe_name', file['name'])
-            file_size = file.get('size', 0)
-            break
-            
-    if not safe_filename:
+    
+    stored_file = next((file for file in file_group['files'] if file['name'] == filename), None)
+    if stored_file is None:
         return jsonify({'error': '找不到请求的文件'}), 404
     
-    file_path = os.path.join(app.config['UPLOAD_FOLDER'], file_group_id)
-    full_path = os.path.join(file_path, safe_filename)
+    # 压缩存储的文件：可以原样发送且客户端接受该压缩格式时作为 Content-Encoding 发送，否则按帧解压；
+    # Range请求总是按原始内容处理
+    encoding = stored_file.get('encoding')
+    passthrough = (encoding is not None and not request.range and request.accept_encodings[encoding] > 0
+                   and compression.can_pass_through(encoding, stored_file['size'], stored_file['frame_size']))
     
-    # 检查文件是否存在
-    if not os.path.exists(full_path):
+    # 打开文件后只做一次fstat，大小和修改时间都从这里取
+    finish_compressed_file(file_group_id, stored_file)
+    try:
+        file = DownloadFile(get_stored_file_path(file_group_id, stored_file))
+    except FileNotFoundError:
         return jsonify({'error': '文件不存在'}), 404
+    stat = os.fstat(file.fileno())
+    size = stored_file['size'] if encoding and not passthrough else stat.st_size
+    
+    # 强ETag取自上传时计算的SHA-256，旧数据没有哈希时用大小和修改时间
+    if stored_file.get('sha256'):
+        etag = stored_file['sha256']
+    else:
+        etag = f'{size:x}-{stat.st_mtime_ns:x}'
+    if passthrough:
+        # 压缩后的内容是另一种表示，使用不同的ETag
+        etag = f'{etag}-{encoding}'
+    try:
+        last_modified = int(datetime.datetime.fromisoformat(stored_file['upload_time']).timestamp())
+    except (KeyError, TypeError, ValueError):
+        last_modified = int(stat.st_mtime)
+    
+    def finish(response):
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        response.headers['Accept-Ranges'] = 'bytes'
+        # 允许客户端缓存，但每次使用前必须用ETag重新验证
+        response.headers['Cache-Control'] = 'private, no-cache'
+        if encoding:
+            response.vary.add('Accept-Encoding')
+        return response
     
-    # 获取真实文件大小
-    real_file_size = os.path.getsize(full_path)
+    if request.method == 'GET' and not request.range and is_not_modified(etag, last_modified):
+        file.close()
+        return finish(Response(status=304))
     
-    # 处理范围请求（断点续传）
-    range_header = request.headers.get('Range', None)
+    ranges = parse_byte_ranges(size) if if_range_matches(etag, last_modified) else None
+    if ranges == []:
+        file.close()
+        response = Response(status=416)
+        response.headers['Content-Range'] = f'bytes */{size}'
+        return finish(response)
     
-    # 如果这是第一次请求（不是断点续传），则记录下载信息
-    if not range_header:
+    transfer = open_transfer('download', file_group_id)
+    if transfer is None:
+        file.close()
+        return too_many_transfers_response()
+    file.on_close.append(transfer.close)
+    
+    # 从头开始的下载才记录（断点续传和下载器的分段请求不重复计数）
+    status, download_count = None, None
+    if request.method == 'GET' and (ranges is None or ranges[0][0] == 0):
         # 避免重复记录下载统计，使用请求UA和IP作为简单的客户端标识
         client_id = f"{request.remote_addr}-{request.user_agent.string}"
-        # 检查是否在最近5分钟内已经记录过此客户端的下载
-        record_download = True
-        
-        if 'recent_downloads' not in data["file_groups"][file_group_id]:
-            data["file_groups"][file_group_id]['recent_downloads'] = {}
-        
-        if client_id in data["file_groups"][file_group_id]['recent_downloads']:
-            last_download = datetime.datetime.fromisoformat(data["file_groups"][file_group_id]['recent_downloads'][client_id])
-            time_diff = (datetime.datetime.now() - last_download).total_seconds()
-            if time_diff < 300:  # 5分钟内不重复记录
-                record_download = False
-        
-        if record_download:
-            download_info = {
-                'filename': original_filename,
-                'time': datetime.datetime.now().isoformat(),
-                'ip': request.remote_addr
-            }
-            data["file_groups"][file_group_id]['download_history'].append(download_info)
-            data["file_groups"][file_group_id]['download_count'] = data["file_groups"][file_group_id].get('download_count', 0) + 1
-            data["file_groups"][file_group_id]['recent_downloads'][client_id] = datetime.datetime.now().isoformat()
-            save_data(data)
-    
-    # 使用Flask的send_from_directory，它会自动处理断点续传请求
-    response = send_from_directory(
-        file_path, 
-        safe_filename, 
-        as_attachment=True, 
-        download_name=original_filename
-    )
-    
-    # 启用断点续传，添加必要的头信息
-    response.headers['Accept-Ranges'] = 'bytes'
-    response.headers['Cache-Control'] = 'no-cache'
+        # 5分钟内同一客户端不重复记录
+        status, download_count = record_download(file_group_id, client_id, filename, request.remote_addr)
+        if status == 'limit':
+            file.close()
+            return jsonify({'error': '下载次数已达上限'}), 403
     
-    return response
+    content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    reader = file
+    if encoding and not passthrough:
+        try:
+            reader = compression.FrameReader(file, encoding, size, stored_file['frame_size'],
+                                             load_frame_index(file_group_id, stored_file))
+        except FileNotFoundError:
+            file.close()
+            return jsonify({'error': '文件不存在'}), 404
+    file_wrapper = request.environ.get('wsgi.file_wrapper')
+    bounded_wrapper = request.environ.get('SERVER_SOFTWARE', '').startswith(LENGTH_BOUNDED_FILE_WRAPPERS)
+    if ranges is not None and len(ranges) > 1:
+        boundary = uuid.uuid4().hex
+        body = MultiRangeIterator(reader, ranges, size, content_type, boundary, transfer)
+        response = Response(body, status=206, mimetype=f'multipart/byteranges; boundary={boundary}',
+                            direct_passthrough=True)
+        response.content_length = body.content_length()
+    else:
+        start, stop = ranges[0] if ranges else (0, size)
+        if file_wrapper is not None and (stop == size or bounded_wrapper) and reader is file and not _transfers.shaping:
+            # 服务器从文件当前位置开始发送（gunicorn使用sendfile零拷贝），发送量无法逐块统计，按计划长度计入
+            file.seek(start)
+            body = file_wrapper(file, DOWNLOAD_READ_BLOCK)
+            def count_sent():
+                DOWNLOADED_BYTES.inc(stop - start)
+                transfer.record(stop - start)
+            # 在登记的传输结束之前计入
+            file.on_close.insert(0, count_sent)
+        else:
+            body = FileRangeIterator(reader, start, stop - start, transfer)
+        response = Response(body, status=206 if ranges else 200, mimetype=content_type, direct_passthrough=True)
+        response.content_length = stop - start
+        if ranges:
+            response.headers['Content-Range'] = f'bytes {start}-{stop - 1}/{size}'
+        if passthrough:
+            response.headers['Content-Encoding'] = encoding
+    response.headers.set('Content-Disposition', 'attachment', **content_disposition_params(filename))
+    ACTIVE_TRANSFERS.inc(direction='download')
+    file.on_close.append(lambda: ACTIVE_TRANSFERS.dec(direction='download'))
+    
+    # 达到下载上限后，在本次传输结束、文件关闭时立即清理
+    max_downloads = file_group.get('max_downloads')
+    if status == 'recorded' and max_downloads and download_count >= max_downloads:
+        file.on_close.append(lambda: schedule_expiry(file_group_id))
+    
+    return finish(response)
 
 @app.route('/manage/<file_group_id>')
 def manage_files(file_group_id):
-    data = load_data()
-    if file_group_id not in data["file_groups"]:
+    file_group = get_valid_group(file_group_id, with_history=True)
+    if file_group is None:
         return render_template('error.html', message='找不到指定的文件组')
         
-    file_group = data["file_groups"][file_group_id]
     return render_template('manage.html', file_group=file_group, file_group_id=file_group_id)
 
 @app.route('/api/delete/<file_group_id>', methods=['POST'])
 def delete_file_group(file_group_id):
-    data = load_data()
-    if file_group_id not in data["file_groups"]:
+    # 删除文件夹和数据记录
+    if not remove_file_group(file_group_id, 'deleted'):
         return jsonify({'error': '找不到指定的文件组'}), 404
-        
-    # 删除文件夹
-    folder_path = os.path.join(app.config['UPLOAD_FOLDER'], file_group_id)
-    if os.path.exists(folder_path):
-        shutil.rmtree(folder_path)
-        
-    # 删除数据记录
-    del data["file_groups"][file_group_id]
-    save_data(data)
     
     return jsonify({'success': True})
 
-@app.route('/static/css/style.css')
-def serve_css():
-    return send_from_directory('static/css', 'style.css')
-
-@app.route('/static/js/script.js')
-def serve_js():
-    return send_from_directory('static/js', 'script.js')
+@app.route('/static/<path:filename>')
+def serve_static(filename):
+    asset, fingerprinted = _assets.lookup(filename)
+    if asset is None:
+        return jsonify({'error': '找不到指定的文件'}), 404
+    # 带指纹的地址内容不会变化，可以长期缓存；原始地址每次向服务器确认
+    cache_control = STATIC_IMMUTABLE_CACHE if fingerprinted else 'no-cache'
+    return precompressed_response(asset, asset.mimetype, cache_control)
 
 @app.route('/api/system-info')
 def system_info():
@@ -476,31 +2767,1056 @@ def system_info():
             'used_gb': current_size / (1024**3),
             'max_bytes': max_size,
             'max_gb': max_size / (1024**3),
-            'percent_used': (current_size / max_size) * 100 if max_size > 0 else 0
+            'percent_used': (current_size / max_size) * 100 if max_size > 0 else 0,
+            'physical_bytes': current_size,
+            'logical_bytes': get_logical_storage_usage(),
+            'deduplicate': DEDUP_ENABLED,
+            'instant_upload': INSTANT_UPLOAD_ENABLED
         },
         'file_limits': config["file_limits"],
-        'time_limits': config["time_limits"]
+        'time_limits': config["time_limits"],
+        'reconcile': get_reconcile_report(),
+        # 静态资源的数量、原始大小和各压缩格式下的大小
+        'static_assets': _assets.stats()
     })
 
+@app.before_request
+def start_request_metrics():
+    g.metrics_start = time.perf_counter()
+    if _profiler is not None:
+        _profiler.begin()
+
+@app.after_request
+def record_request_metrics(response):
+    # 未匹配路由的请求归为一类，避免扫描器制造大量不同的标签
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    HTTP_REQUESTS.inc(route=route, method=request.method, status=response.status_code)
+    HTTP_LATENCY.observe(time.perf_counter() - g.metrics_start, route=route)
+    start_metrics_writer()
+    return response
+
+@app.teardown_request
+def finish_request_profile(exc=None):
+    # 出错的请求不经过 after_request，采样在这里结束
+    if _profiler is None:
+        return
+    stacks = _profiler.end()
+    elapsed = time.perf_counter() - g.get('metrics_start', time.perf_counter())
+    if stacks and elapsed * 1000 >= SLOW_REQUEST_MS:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        slug = ''.join(c if c.isalnum() else '_' for c in route).strip('_') or 'index'
+        name = f"{datetime.datetime.now():%Y%m%d-%H%M%S}-{os.getpid()}-{request.method}-{slug}-{elapsed * 1000:.0f}ms.folded"
+        try:
+            metrics.write_profile(os.path.join(PROFILE_FOLDER, name), stacks)
+        except OSError as e:
+            print(f"写入采样结果失败: {e}", flush=True)
+
+def start_metrics_writer():
+    global _metrics_writer_started
+    if _metrics_writer_started or not METRICS_ENABLED:
+        return
+    with _metrics_writer_lock:
+        if _metrics_writer_started:
+            return
+        _metrics_writer_started = True
+    threading.Thread(target=metrics_writer_loop, name='metrics-writer', daemon=True).start()
+    atexit.register(write_metrics_snapshot)
+
+def write_metrics_snapshot():
+    update_transfer_metrics()
+    try:
+        _metrics_store.write(METRICS.snapshot())
+    except OSError as e:
+        print(f"写入运行指标失败: {e}", flush=True)
+
+def metrics_writer_loop():
+    # 定期写入本进程的指标快照，供其他进程的 /metrics 合并
+    while True:
+        time.sleep(METRICS_WRITE_SECONDS)
+        write_metrics_snapshot()
+
+def update_transfer_metrics():
+    # 把本进程各客户端的传输状态写入仪表，合并快照后得到所有进程的合计
+    clients = _transfers.snapshot()
+    CLIENT_TRANSFERS.reset()
+    CLIENT_TRANSFER_RATE.reset()
+    for item in clients:
+        CLIENT_TRANSFERS.set(item['transfers'], client=item['client'], direction=item['direction'])
+        CLIENT_TRANSFER_RATE.set(item['rate'], client=item['client'], direction=item['direction'])
+
+def merged_metrics():
+    # 本进程的当前值加上其他进程最近写入的快照
+    alive = _pid_alive if os.name == 'posix' else (lambda pid: False)
+    return METRICS.merge([(METRICS.snapshot(), True)] + _metrics_store.read_others(alive))
+
+def collect_storage_metrics():
+    # 从数据库读取的全局数值，不需要合并
+    scanning = get_db().execute("SELECT COUNT(*) FROM file_groups WHERE status = 'scanning'").fetchone()[0]
+    with _download_lock:
+        pending_events = len(_download_events)
+    return [
+        ('file_share_groups', 'gauge', '现有文件组数量', [({}, get_counter('group_count'))]),
+        ('file_share_files', 'gauge', '现有文件数量', [({}, get_counter('file_count'))]),
+        ('file_share_groups_scanning', 'gauge', '正在进行安全检查的文件组', [({}, scanning)]),
+        ('file_share_storage_bytes', 'gauge', '存储用量',
+         [({'kind': 'physical'}, get_total_storage_usage()), ({'kind': 'logical'}, get_logical_storage_usage()),
+          ({'kind': 'reserved'}, get_reserved_storage()), ({'kind': 'trash'}, get_trash_bytes())]),
+        ('file_share_pending_download_events', 'gauge', '本进程尚未写入数据库的下载记录', [({}, pending_events)]),
+    ]
+
+@app.route('/metrics')
+def metrics_endpoint():
+    # Prometheus文本格式；多进程部署时合并所有进程的快照
+    if not METRICS_ENABLED:
+        return jsonify({'error': '未启用运行指标'}), 404
+    update_transfer_metrics()
+    text = METRICS.render(merged_metrics(), extra=collect_storage_metrics())
+    return Response(text, mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/api/transfers')
+def transfer_status():
+    # 各客户端正在进行的传输数和最近的速率；其他进程的数据来自其定期写入的快照
+    update_transfer_metrics()
+    merged = merged_metrics()
+    rates = merged[CLIENT_TRANSFER_RATE.name]
+    clients = [{'client': client, 'direction': direction, 'transfers': count,
+                'rate_bytes': rates.get((client, direction), 0)}
+               for (client, direction), count in merged[CLIENT_TRANSFERS.name].items()]
+    clients.sort(key=lambda item: item['rate_bytes'], reverse=True)
+    return jsonify({'limits': TRANSFER_CONFIG, 'clients': clients})
+
+@app.route('/api/storage/rescan', methods=['POST'])
+def rescan_storage():
+    # 在后台重新扫描磁盘并校准存储用量
+    if _rescan_lock.locked():
+        return jsonify({'success': True, 'status': 'running'})
+    threading.Thread(target=reconcile_storage_usage, daemon=True).start()
+    return jsonify({'success': True, 'status': 'started'})
+
 @app.route('/api/file-group/<file_group_id>')
 def get_file_group_info(file_group_id):
-    # 清理过期文件
-    clean_expired_files()
-    
-    # 获取文件组信息的API
-    data = load_data()
-    if file_group_id not in data["file_groups"]:
+    # 获取文件组信息的API，只检查目标文件组是否有效
+    file_group = get_valid_group(file_group_id, with_history=True)
+    if file_group is None:
         return jsonify({'error': '找不到指定的文件组'}), 404
         
     return jsonify({
         'success': True,
-        'file_group': data["file_groups"][file_group_id]
+        'file_group': file_group
     })
 
+def read_group_state(file_group_id):
+    # 实时更新核对用，只读取一行中的几个字段；与 record_download 持有同一把锁，下载次数与已发布的事件一致
+    with _download_lock:
+        row = get_db().execute('SELECT download_count, status, expiry_date, max_downloads FROM file_groups WHERE id = ?',
+                               (file_group_id,)).fetchone()
+        if row is None:
+            return None
+        info = dict(row)
+        info['download_count'] += _pending_counts.get(file_group_id, 0)
+    return info
+
+class GroupEventStream:
+    """
+    一个管理页面的实时更新连接（WSGI和ASGI共用，等待唤醒由调用方完成）：
+    - 连接时发送完整数据，带 Last-Event-ID 重连时只补发错过的事件
+    - 之后推送本进程发布的下载和删除事件，检查结果变化时重发完整数据
+    - 每次唤醒（有事件或心跳到期）从数据库核对一次下载次数和检查状态，与客户端看到的不一致时重发完整数据，
+      其他进程中发生的变化由此在一个心跳间隔内送达；文件组到期时发送删除事件并结束
+    事件编号为 进程标识.事件编号.下载次数.检查状态，重连到任何进程都能据此判断客户端是否需要完整数据
+    """
+    def __init__(self, file_group_id, last_event_id, wake):
+        self.file_group_id = file_group_id
+        self.wake = wake
+        self.seq = None
+        self.state = None  # 客户端看到的 (下载次数, 检查状态)
+        self.expiry_date = None
+        self.done = False
+        self.closed = False
+        parts = (last_event_id or '').split('.')
+        if len(parts) == 4 and parts[1].isdigit() and parts[2].isdigit():
+            self.state = (int(parts[2]), parts[3])
+            if parts[0] == _group_events.token:
+                self.seq = int(parts[1])
+        # 先订阅再读取数据，两者之间发布的事件不会丢失
+        _group_events.subscribe(file_group_id, wake)
+        EVENT_STREAMS.inc()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            _group_events.unsubscribe(self.file_group_id, self.wake)
+            EVENT_STREAMS.dec()
+
+    def event_id(self):
+        return f'{_group_events.token}.{self.seq}.{self.state[0]}.{self.state[1]}'
+
+    def open(self):
+        """首批消息"""
+        messages = ['retry: 3000\n\n']
+        if self.state is None:
+            return messages + self.snapshot()
+        if self.seq is None:
+            # 从其他进程重连：之前的事件无法补发，由 poll 中的核对决定是否需要完整数据
+            self.seq = _group_events.current()
+        return messages + self.poll()
+
+    def poll(self):
+        """处理一次唤醒，返回要发送的消息（没有变化时为心跳）"""
+        pending = _group_events.events_after(self.file_group_id, self.seq)
+        if pending is None:
+            return self.snapshot()
+        messages = []
+        for seq, event, data in pending:
+            self.seq = seq
+            if event == 'removed':
+                return self.removed(data['reason'])
+            if event == 'moved':
+                # 文件组已移到其他节点：结束连接，浏览器自动重连时转发到新的节点
+                self.done = True
+                return [': moved\n\n']
+            if event != 'download':
+                # 检查结果：文件列表等可能一起变化
+                return self.snapshot()
+            self.state = (self.state[0] + 1, self.state[1])
+            messages.append(events.format_event('download', data, self.event_id()))
+        info = read_group_state(self.file_group_id)
+        if info is None:
+            return self.removed(None)
+        if is_group_expired(info):
+            schedule_expiry(self.file_group_id)
+            return self.removed('expired')
+        if (info['download_count'], info['status']) != self.state:
+            return self.snapshot()
+        self.expiry_date = info['expiry_date']
+        return messages or [': ping\n\n']
+
+    def snapshot(self):
+        self.seq = _group_events.current()
+        info = get_valid_group(self.file_group_id, with_history=True)
+        if info is None:
+            return self.removed(None)
+        self.state = (info['download_count'], info['status'])
+        self.expiry_date = info['expiry_date']
+        data = {'file_group': info, 'history_limit': DOWNLOAD_HISTORY_LIMIT}
+        return [events.format_event('snapshot', data, self.event_id())]
+
+    def removed(self, reason):
+        # reason 为 'expired'、'deleted'，不确定原因时为 None
+        self.done = True
+        return [events.format_event('removed', {'reason': reason})]
+
+    def next_wait(self):
+        # 下一次心跳，有效期更早到达时在到期后立即核对
+        timeout = EVENT_HEARTBEAT_SECONDS
+        if self.expiry_date:
+            remaining = datetime.datetime.fromisoformat(self.expiry_date).timestamp() - time.time()
+            timeout = min(timeout, max(remaining, 0) + 0.1)
+        return timeout
+
+EVENT_STREAM_HEADERS = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+# asgi.py 在请求环境中放入的字典：通过检查的实时更新连接写入参数后交给协程发送，不占用线程
+ASYNC_EVENTS_KEY = 'file_share.async_events'
+
+def acquire_event_stream():
+    global _event_stream_count
+    with _event_stream_lock:
+        if EVENT_STREAM_LIMIT is not None and _event_stream_count >= EVENT_STREAM_LIMIT:
+            return False
+        _event_stream_count += 1
+        return True
+
+def release_event_stream():
+    global _event_stream_count
+    with _event_stream_lock:
+        _event_stream_count -= 1
+
+@app.route('/api/file-group/<file_group_id>/events')
+def file_group_events(file_group_id):
+    # 管理页面的实时更新（Server-Sent Events），代替定时轮询；asgi.py 中有不占用线程的实现
+    if not acquire_event_stream():
+        response = jsonify({'error': '实时更新连接过多，请稍后重试'})
+        response.headers['Retry-After'] = '30'
+        return response, 503
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    handoff = request.environ.get(ASYNC_EVENTS_KEY)
+    if handoff is not None:
+        # 由 asgi.py 发送事件，连接结束时释放
+        handoff.update(file_group_id=file_group_id, last_event_id=last_event_id)
+        return Response(mimetype='text/event-stream', headers=EVENT_STREAM_HEADERS)
+    wake = threading.Event()
+    stream = GroupEventStream(file_group_id, last_event_id, wake.set)
+    
+    def generate():
+        yield from stream.open()
+        while not stream.done:
+            wake.wait(stream.next_wait())
+            wake.clear()
+            yield from stream.poll()
+    
+    def finish():
+        # 客户端断开时在下一次心跳写入失败，连接随之关闭
+        stream.close()
+        release_event_stream()
+    
+    response = Response(generate(), mimetype='text/event-stream', headers=EVENT_STREAM_HEADERS)
+    response.call_on_close(finish)
+    return response
+
+# 一致性检查：依次核对文件组记录指向的文件、上传目录中的文件组目录、blob文件，最后重建计数器
+# 每处理完一批把 (阶段, 游标, 统计) 写入 meta 表，中断后从该批之后继续
+RECONCILE_PHASES = ('groups', 'folders', 'blobs', 'counters')
+_reconcile_lock = threading.Lock()
+
+def _load_meta_json(key):
+    row = get_db().execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+    return json.loads(row['value']) if row else None
+
+def _save_meta_json(key, value):
+    conn = get_db()
+    with conn:
+        if value is None:
+            conn.execute('DELETE FROM meta WHERE key = ?', (key,))
+        else:
+            conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, json.dumps(value, ensure_ascii=False)))
+
+def get_reconcile_report():
+    # 最近一次完成的检查结果，以及未完成的检查的进度
+    report = _load_meta_json('reconcile_report')
+    state = _load_meta_json('reconcile_state')
+    return {
+        'last_report': report,
+        'in_progress': {'phase': state['phase'], 'started_at': state['started_at']} if state else None
+    }
+
+def find_missing_files(file_group_id, files):
+    # 磁盘上不存在或大小与记录不符的文件
+    return [file['name'] for file in files if not stored_file_intact(file_group_id, file)]
+
+def reconcile_groups(cursor, stats, pool):
+    """按ID顺序分批检查文件组记录指向的文件，结果写入 missing_files"""
+    conn = get_db()
+    while True:
+        rows = conn.execute('SELECT id, files, missing_files FROM file_groups WHERE id > ? ORDER BY id LIMIT ?',
+                            (cursor, RECONCILE_BATCH)).fetchall()
+        if not rows:
+            return
+        results = pool.map(lambda row: find_missing_files(row['id'], json.loads(row['files'])), rows)
+        updates = []
+        for row, missing in zip(rows, results):
+            stats['groups_checked'] += 1
+            if missing:
+                stats['groups_with_missing_files'] += 1
+                stats['missing_files'] += len(missing)
+            value = json.dumps(missing, ensure_ascii=False) if missing else None
+            if value != row['missing_files']:
+                updates.append((value, row['id'], row['files']))
+        if updates:
+            with conn:
+                # 文件列表在检查期间变化（例如安全检查未通过）时不更新，留给下一次检查
+                conn.executemany('UPDATE file_groups SET missing_files = ? WHERE id = ? AND files = ?', updates)
+        cursor = rows[-1]['id']
+        yield cursor
+
+def _latest_mtime(path):
+    # 目录本身和其中各项的最近修改时间（向已有文件追加内容不会更新目录的修改时间）
+    latest = os.lstat(path).st_mtime
+    if os.path.isdir(path) and not os.path.islink(path):
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    latest = max(latest, entry.stat(follow_symlinks=False).st_mtime)
+                except OSError:
+                    pass
+    return latest
+
+def quarantine_entry(path, name):
+    """把孤立的内容移到隔离目录，由管理员确认后手动删除（仍计入存储用量）"""
+    os.makedirs(QUARANTINE_FOLDER, exist_ok=True)
+    target = os.path.join(QUARANTINE_FOLDER, name)
+    if os.path.lexists(target):
+        target += '-' + uuid.uuid4().hex[:8]
+    os.rename(path, target)
+
+def adopt_orphan_folder(file_group_id, path):
+    """为孤立的文件组目录创建新的文件组（按最长有效期，重新进行安全检查），取件码写入日志"""
+    file_info = []
+    total_size = 0
+    with os.scandir(path) as entries:
+        for entry in sorted(entries, key=lambda entry: entry.name):
+            if not entry.is_file(follow_symlinks=False):
+                continue
+            sha256, crc32 = hash_file(entry.path)
+            stat = entry.stat(follow_symlinks=False)
+            file_info.append({
+                'name': entry.name,
+                'safe_name': entry.name,
+                'size': stat.st_size,
+                'upload_time': datetime.datetime.fromtimestamp(stat.st_mtime).isoformat(),
+                'sha256': sha256,
+                'crc32': crc32
+            })
+            total_size += stat.st_size
+    if not file_info:
+        quarantine_entry(path, file_group_id)
+        return 'quarantined'
+    pickup_code = finalize_file_group(file_group_id, generate_pickup_code(), file_info, total_size,
+                                      'days', config["time_limits"]["max_expiry_days"], 0)
+    print(f"一致性检查：已为孤立目录 {file_group_id} 创建文件组，取件码 {pickup_code}", flush=True)
+    return 'adopted'
+
+def handle_orphan_entry(name):
+    """处理上传目录中没有文件组记录的一项，返回处理结果（None 表示实际上并不孤立）"""
+    path = os.path.join(UPLOAD_FOLDER, name)
+    try:
+        if time.time() - _latest_mtime(path) < ORPHAN_GRACE_SECONDS:
+            return 'recent'
+    except FileNotFoundError:
+        return None
+    # 批量查询之后才创建的文件组
+    if get_db().execute('SELECT 1 FROM file_groups WHERE id = ?', (name,)).fetchone():
+        return None
+    if RECONCILE_ORPHANS == 'adopt' and os.path.isdir(path) and not os.path.islink(path):
+        try:
+            uuid.UUID(name)
+        except ValueError:
+            pass
+        else:
+            return adopt_orphan_folder(name, path)
+    quarantine_entry(path, name)
+    return 'quarantined'
+
+def reconcile_folders(cursor, stats, pool):
+    """按名称顺序分批检查上传目录，没有文件组记录的目录按配置隔离或收养"""
+    reserved = {os.path.basename(BLOB_FOLDER), os.path.basename(TRASH_FOLDER), os.path.basename(QUARANTINE_FOLDER)}
+    names = sorted(name for name in os.listdir(UPLOAD_FOLDER) if name > cursor and name not in reserved)
+    conn = get_db()
+    for start in range(0, len(names), RECONCILE_BATCH):
+        batch = names[start:start + RECONCILE_BATCH]
+        placeholders = ','.join('?' * len(batch))
+        known = {row['id'] for row in conn.execute(f'SELECT id FROM file_groups WHERE id IN ({placeholders})', batch)}
+        stats['folders_checked'] += len(batch)
+        for result in pool.map(handle_orphan_entry, [name for name in batch if name not in known]):
+            if result is not None:
+                stats[f'orphans_{result}'] += 1
+        yield batch[-1]
+
+def handle_orphan_blob(path):
+    # 没有 blobs 记录的blob文件；刚放入的文件修改时间较新（os.replace 保留上传时写入的时间）
+    sha256 = os.path.basename(path)
+    try:
+        if time.time() - os.lstat(path).st_mtime < ORPHAN_GRACE_SECONDS:
+            return 'recent'
+    except FileNotFoundError:
+        return None
+    if get_db().execute('SELECT 1 FROM blobs WHERE sha256 = ?', (sha256,)).fetchone():
+        return None
+    quarantine_entry(path, f'blob-{sha256}')
+    return 'quarantined'
+
+def reconcile_blobs(cursor, stats, pool):
+    """按第一级分片目录检查blob文件，没有记录的移到隔离目录（引用计数在 counters 阶段核对）"""
+    if not os.path.isdir(BLOB_FOLDER):
+        return
+    conn = get_db()
+    for prefix in sorted(name for name in os.listdir(BLOB_FOLDER) if name > cursor):
+        paths = []
+        for root, dirs, files in os.walk(os.path.join(BLOB_FOLDER, prefix)):
+            paths.extend(os.path.join(root, file) for file in files)
+        for start in range(0, len(paths), RECONCILE_BATCH):
+            batch = paths[start:start + RECONCILE_BATCH]
+            hashes = [os.path.basename(path) for path in batch]
+            placeholders = ','.join('?' * len(hashes))
+            known = {row['sha256'] for row in conn.execute(f'SELECT sha256 FROM blobs WHERE sha256 IN ({placeholders})',
+                                                           hashes)}
+            stats['blobs_checked'] += len(batch)
+            for result in pool.map(handle_orphan_blob, [path for path in batch if os.path.basename(path) not in known]):
+                if result is not None:
+                    stats[f'orphan_blobs_{result}'] += 1
+        yield prefix
+
+def reconcile_counters(cursor, stats, pool):
+    """按文件组记录重建数量计数器和blob引用计数，再扫描磁盘校准存储用量"""
+    conn = get_db()
+    with immediate_transaction(conn):
+        row = conn.execute('SELECT COUNT(*) AS group_count, COALESCE(SUM(total_size), 0) AS logical_bytes, '
+                           'COALESCE(SUM(json_array_length(files)), 0) AS file_count FROM file_groups').fetchone()
+        for name in ('group_count', 'file_count', 'logical_bytes'):
+            if get_counter(name) != row[name]:
+                conn.execute('INSERT OR REPLACE INTO counters VALUES (?, ?)', (name, row[name]))
+                stats['counters_fixed'] += 1
+        refs = {row['sha256']: row['refs'] for row in conn.execute(
+            "SELECT json_extract(value, '$.blob') AS sha256, COUNT(*) AS refs "
+            "FROM file_groups, json_each(file_groups.files) "
+            "WHERE json_extract(value, '$.blob') IS NOT NULL GROUP BY sha256")}
+        # 上传入库时先增加blob引用再写入文件组记录，有上传在入库（持有预留）时只修正偏小的引用计数
+        uploading = conn.execute('SELECT 1 FROM storage_reservations LIMIT 1').fetchone() is not None
+        released = []
+        for blob in conn.execute('SELECT sha256, refcount FROM blobs').fetchall():
+            actual = refs.get(blob['sha256'], 0)
+            if actual == blob['refcount'] or (uploading and actual < blob['refcount']):
+                continue
+            stats['blob_refcounts_fixed'] += 1
+            # 没有引用的blob按释放最后一个引用的流程移到回收目录
+            conn.execute('UPDATE blobs SET refcount = ? WHERE sha256 = ?', (actual or 1, blob['sha256']))
+            if not actual:
+                released.append(blob['sha256'])
+        _release_blobs(conn, released)
+        conn.execute('DELETE FROM frame_index WHERE group_id NOT IN (SELECT id FROM file_groups)')
+    reconcile_storage_usage()
+    yield 'done'
+
+RECONCILE_HANDLERS = {
+    'groups': reconcile_groups,
+    'folders': reconcile_folders,
+    'blobs': reconcile_blobs,
+    'counters': reconcile_counters,
+}
+
+@OPERATION_SECONDS.time(operation='reconcile')
+def run_reconcile(restart=False, offline=False):
+    """
+    运行一次一致性检查，未完成的检查从检查点继续（restart 为 True 时从头开始），返回结果统计；
+    本进程中已有检查在进行时返回 None。offline 为 True 时（服务未运行）另外重建索引并检查数据库完整性
+    """
+    if not _reconcile_lock.acquire(blocking=False):
+        return None
+    try:
+        state = None if restart else _load_meta_json('reconcile_state')
+        if state is None:
+            state = {'phase': RECONCILE_PHASES[0], 'cursor': '', 'stats': {},
+                     'started_at': datetime.datetime.now().isoformat()}
+            _save_meta_json('reconcile_state', state)
+        stats = collections.Counter(state['stats'])
+        with concurrent.futures.ThreadPoolExecutor(RECONCILE_WORKERS, thread_name_prefix='reconcile') as pool:
+            for phase in RECONCILE_PHASES[RECONCILE_PHASES.index(state['phase']):]:
+                state['phase'] = phase
+                for cursor in RECONCILE_HANDLERS[phase](state['cursor'], stats, pool):
+                    state['cursor'] = cursor
+                    state['stats'] = stats
+                    _save_meta_json('reconcile_state', state)
+                state['cursor'] = ''
+        report = dict(stats, started_at=state['started_at'], finished_at=datetime.datetime.now().isoformat())
+        if offline:
+            conn = get_db()
+            conn.execute('REINDEX')
+            report['integrity_check'] = '; '.join(row[0] for row in conn.execute('PRAGMA integrity_check'))
+        _save_meta_json('reconcile_report', report)
+        _save_meta_json('reconcile_state', None)
+        return report
+    finally:
+        _reconcile_lock.release()
+
+def reconcile_loop():
+    """启动后继续未完成的检查，之后每隔 RECONCILE_INTERVAL 运行一次"""
+    time.sleep(RECONCILE_START_DELAY)
+    while True:
+        try:
+            report = _load_meta_json('reconcile_report')
+            delay = 0
+            if report is not None and _load_meta_json('reconcile_state') is None:
+                finished = datetime.datetime.fromisoformat(report['finished_at']).timestamp()
+                delay = RECONCILE_INTERVAL - (time.time() - finished)
+            if delay <= 0:
+                report = run_reconcile()
+                if report is not None:
+                    print(f"一致性检查完成: {report}", flush=True)
+                delay = RECONCILE_INTERVAL
+        except Exception as e:
+            print(f"一致性检查失败，稍后从检查点继续: {e}", flush=True)
+            delay = 600
+        time.sleep(delay)
+
+def run_reconcile_command(restart):
+    """命令行入口：在服务停止时运行完整的一致性检查并输出结果，返回退出码"""
+    if os.name == 'posix':
+        import fcntl
+        lock_file = open(MAINTENANCE_LOCK_FILE, 'a')
+        try:
+            # 持有维护锁直到退出，期间启动的服务不会同时运行后台检查
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            print("服务正在运行，一致性检查由服务在后台进行；如需离线检查请先停止服务")
+            return 1
+    print("正在运行一致性检查...", flush=True)
+    report = run_reconcile(restart=restart, offline=True)
+    for key, value in report.items():
+        print(f"  {key}: {value}")
+    return 0 if report.get('integrity_check') == 'ok' else 1
+
+# 集群模式：按目录把请求转发到文件组所在的节点，节点之间移动文件组以平衡用量
+CLUSTER_NODE_HEADER = 'X-Cluster-Node'
+CLUSTER_TIME_HEADER = 'X-Cluster-Time'
+CLUSTER_SIGNATURE_HEADER = 'X-Cluster-Signature'
+# 签名中的一次性随机数和请求体哈希
+CLUSTER_NONCE_HEADER = 'X-Cluster-Nonce'
+CLUSTER_BODY_HEADER = 'X-Cluster-Body'
+# 转发时附带原始客户端的地址，以及新文件组（上传会话）在选择节点时确定的ID
+CLUSTER_CLIENT_HEADER = 'X-Cluster-Client'
+CLUSTER_KEY_HEADER = 'X-Cluster-Key'
+# 按路径中的文件组ID或上传会话ID确定所在节点的路由
+CLUSTER_GROUP_ROUTES = {'download_file', 'download_all_files', 'manage_files', 'delete_file_group',
+                        'get_file_group_info', 'file_group_events'}
+CLUSTER_UPLOAD_ROUTES = {'get_upload_session', 'abort_upload_session', 'upload_chunk', 'complete_upload_session'}
+# 浏览器直接打开的页面和下载可以重定向；页面脚本发出的请求跨域重定向会失败，始终由本节点转发
+CLUSTER_REDIRECT_ROUTES = {'download_file', 'download_all_files', 'manage_files'}
+# 只接受其他节点签名请求的路由
+CLUSTER_INTERNAL_ROUTES = {'receive_moved_file', 'commit_moved_group'}
+# 不超过该大小的请求体读入内存后转发（取件表单需要先读出取件码）
+CLUSTER_BUFFER_BYTES = 64 * 1024
+# 签名中带有哈希的请求体读入内存校验，超过该大小的不接受
+CLUSTER_SIGNED_BODY_BYTES = 16 * 1024 * 1024
+# 转发时不传递的逐跳头部，以及由服务器自行添加的头部
+HOP_BY_HOP_HEADERS = {'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization', 'te', 'trailer',
+                      'transfer-encoding', 'upgrade', 'host', 'date', 'server'}
+# 转发的请求等待数据的时间，需长于实时更新连接的心跳间隔
+CLUSTER_PROXY_TIMEOUT = 300
+
+def request_target():
+    # 转发和签名使用的请求路径：路径按UTF-8编码，查询字符串保持原样
+    target = urllib.parse.quote(request.path)
+    if request.query_string:
+        target += '?' + request.query_string.decode('latin-1')
+    return target
+
+def cluster_headers(method, target, body=None, client=''):
+    """签名的请求头；body 为要发送的请求体（bytes、文件对象或 None），client 为原始客户端的地址"""
+    timestamp = str(int(time.time()))
+    nonce = cluster.new_nonce()
+    digest = cluster.body_digest(body)
+    signature = cluster.sign(_catalog.secret('cluster_secret'), method, target, timestamp, NODE_ID, nonce,
+                             client, digest)
+    headers = {CLUSTER_NODE_HEADER: NODE_ID, CLUSTER_TIME_HEADER: timestamp, CLUSTER_NONCE_HEADER: nonce,
+               CLUSTER_BODY_HEADER: digest, CLUSTER_SIGNATURE_HEADER: signature}
+    if client:
+        headers[CLUSTER_CLIENT_HEADER] = client
+    return headers
+
+def verify_cluster_request():
+    headers = request.headers
+    digest = headers.get(CLUSTER_BODY_HEADER)
+    if not cluster.verify(_catalog.secret('cluster_secret'), request.method, request_target(),
+                          headers.get(CLUSTER_TIME_HEADER), headers.get(CLUSTER_NODE_HEADER),
+                          headers.get(CLUSTER_NONCE_HEADER), headers.get(CLUSTER_CLIENT_HEADER, ''), digest,
+                          headers.get(CLUSTER_SIGNATURE_HEADER)):
+        return False
+    if digest != cluster.UNSIGNED_BODY:
+        if (request.content_length or 0) > CLUSTER_SIGNED_BODY_BYTES:
+            return False
+        if cluster.body_digest(request.get_data(cache=True)) != digest:
+            return False
+    # 签名通过后才登记随机数，同一个签名只能使用一次
+    return _catalog.use_nonce(headers[CLUSTER_NONCE_HEADER])
+
+def parse_cluster_key(value):
+    # 其他节点传来的ID会用作目录名，只接受标准格式的UUID
+    try:
+        return value if value and str(uuid.UUID(value)) == value else None
+    except ValueError:
+        return None
+
+def is_local_group(file_group_id):
+    # 未启用集群模式时所有文件组都在本节点
+    if _catalog is None:
+        return True
+    return get_db().execute('SELECT 1 FROM file_groups WHERE id = ?', (file_group_id,)).fetchone() is not None
+
+@app.before_request
+def route_cluster_request():
+    """集群模式下，请求的文件组或上传会话在其他节点时重定向或转发到所在节点"""
+    if _catalog is None:
+        if request.endpoint in CLUSTER_INTERNAL_ROUTES:
+            return jsonify({'error': '集群模式未启用'}), 404
+        return None
+    if CLUSTER_NODE_HEADER in request.headers:
+        # 其他节点转发来的请求在本节点处理，不再转发
+        if not verify_cluster_request():
+            return jsonify({'error': '集群请求签名无效'}), 403
+        client = request.headers.get(CLUSTER_CLIENT_HEADER)
+        if client:
+            request.remote_addr = request.environ['REMOTE_ADDR'] = client
+        g.cluster_key = parse_cluster_key(request.headers.get(CLUSTER_KEY_HEADER))
+        return None
+    if request.endpoint in CLUSTER_INTERNAL_ROUTES:
+        return jsonify({'error': '集群请求签名无效'}), 403
+    node = find_owner_node()
+    if node is None or node['id'] == NODE_ID:
+        return None
+    if not node['alive']:
+        return jsonify({'error': '文件所在的存储节点暂时不可用，请稍后再试'}), 503
+    if CLUSTER_FORWARD == 'redirect' and request.method in ('GET', 'HEAD') and request.endpoint in CLUSTER_REDIRECT_ROUTES:
+        return redirect(node['url'] + request_target(), code=307)
+    return proxy_to_node(node)
+
+def find_owner_node():
+    """请求针对的文件组或上传会话所在的节点；在本节点或无法确定时返回 None"""
+    endpoint = request.endpoint
+    if endpoint in CLUSTER_GROUP_ROUTES:
+        file_group_id = request.view_args['file_group_id']
+        if is_local_group(file_group_id):
+            return None
+        node_id = _catalog.lookup_group(file_group_id)
+    elif endpoint in CLUSTER_UPLOAD_ROUTES:
+        upload_id = request.view_args['upload_id']
+        if get_db().execute('SELECT 1 FROM upload_sessions WHERE id = ?', (upload_id,)).fetchone():
+            return None
+        node_id = _catalog.lookup_upload(upload_id)
+    elif endpoint == 'pickup_file' and request.method == 'POST':
+        if (request.content_length or 0) > CLUSTER_BUFFER_BYTES:
+            return None
+        # 先缓存请求体，解析表单后仍可原样转发
+        request.get_data(cache=True)
+        pickup_code = request.form.get('pickup_code')
+        if not pickup_code or find_group_id_by_code(pickup_code):
+            return None
+        found = _catalog.lookup_code(pickup_code)
+        node_id = found[1] if found else None
+    elif endpoint in ('upload_file', 'create_upload_session') and request.method == 'POST':
+        return place_new_upload()
+    else:
+        return None
+    if node_id is None or node_id == NODE_ID:
+        return None
+    # 目录中已没有该节点的记录时视为不可用
+    return _catalog.node(node_id) or {'id': node_id, 'alive': False}
+
+def place_new_upload():
+    """新文件组（上传会话）按剩余空间加权的一致性哈希选择节点，选中本节点时返回 None"""
+    key = str(uuid.uuid4())
+    g.cluster_key = key
+    size = request.content_length or 0
+    nodes = [node for node in _catalog.nodes()
+             if node['alive'] and node['state'] == 'active' and node['free_bytes'] > size]
+    ranked = cluster.rank_nodes(key, nodes)
+    # 没有其他可用节点时由本节点接收
+    return ranked[0] if ranked else None
+
+def proxy_to_node(node):
+    """把当前请求转发到 node，以流的方式返回其响应"""
+    target = request_target()
+    headers = {name: value for name, value in request.headers.items() if name.lower() not in HOP_BY_HOP_HEADERS}
+    if g.get('cluster_key'):
+        headers[CLUSTER_KEY_HEADER] = g.cluster_key
+    length = request.content_length
+    if length is None:
+        body = None
+    elif length <= CLUSTER_BUFFER_BYTES:
+        body = request.get_data(cache=True)
+    else:
+        body = request.stream
+    headers.update(cluster_headers(request.method, target, body, request.remote_addr))
+    try:
+        upstream = cluster.open_request(node['url'], request.method, target, headers, body,
+                                        timeout=CLUSTER_PROXY_TIMEOUT)
+    except OSError as e:
+        print(f"转发到节点 {node['id']} 失败: {e}", flush=True)
+        return jsonify({'error': '文件所在的存储节点暂时不可用，请稍后再试'}), 502
+    
+    def relay():
+        # read1 收到数据就返回，实时更新的事件不会积压
+        yield from iter(lambda: upstream.read1(DOWNLOAD_READ_BLOCK), b'')
+    
+    response = Response(relay(), status=upstream.status, headers=[
+        (name, value) for name, value in upstream.getheaders() if name.lower() not in HOP_BY_HOP_HEADERS])
+    response.call_on_close(upstream.close)
+    return response
+
+def moved_group_staging(file_group_id):
+    # 移入的文件先写入上传会话目录，没有会话记录的目录超时后由清理线程删除
+    return os.path.join(UPLOAD_SESSION_FOLDER, f'{file_group_id}.incoming')
+
+@app.route('/cluster/groups/<file_group_id>/files/<name>', methods=['PUT'])
+def receive_moved_file(file_group_id, name):
+    # 其他节点移来的文件组：按存储时的原样（压缩存储的文件为压缩后的内容）接收文件
+    if parse_cluster_key(file_group_id) is None or name != os.path.basename(name) or name.startswith('.'):
+        return jsonify({'error': '参数无效'}), 400
+    length = request.content_length
+    if length is None:
+        return jsonify({'error': '缺少Content-Length'}), 411
+    reservation_id, current_size, max_size = reserve_storage(length)
+    if reservation_id is None:
+        return jsonify({'error': f'服务器存储空间不足 ({current_size/(1024**3):.2f}GB/{max_size/(1024**3):.2f}GB)'}), 507
+    try:
+        staging = moved_group_staging(file_group_id)
+        os.makedirs(staging, exist_ok=True)
+        path = os.path.join(staging, name)
+        received = 0
+        with open(path, 'wb') as f:
+            for block in iter(lambda: request.stream.read(DOWNLOAD_READ_BLOCK), b''):
+                f.write(block)
+                received += len(block)
+        if received != length:
+            os.remove(path)
+            return jsonify({'error': '文件不完整'}), 400
+    finally:
+        release_storage(reservation_id)
+    return jsonify({'success': True})
+
+@app.route('/cluster/groups/<file_group_id>', methods=['POST'])
+def commit_moved_group(file_group_id):
+    # 文件全部收到后写入记录，接管文件组
+    payload = request.get_json(silent=True) or {}
+    info = payload.get('group')
+    if parse_cluster_key(file_group_id) is None or not isinstance(info, dict) or not payload.get('source'):
+        return jsonify({'error': '参数无效'}), 400
+    error = adopt_moved_group(file_group_id, info, payload.get('frames') or {}, payload.get('history') or [],
+                              payload.get('summary') or [], payload['source'])
+    if error:
+        return jsonify({'error': error}), 409
+    return jsonify({'success': True})
+
+def adopt_moved_group(file_group_id, info, frames, history, summary, source):
+    """接管其他节点移来的文件组（文件已在暂存目录中），失败时返回错误信息"""
+    staging = moved_group_staging(file_group_id)
+    group_folder = os.path.join(app.config['UPLOAD_FOLDER'], file_group_id)
+    for file in info.get('files', []):
+        try:
+            size = os.path.getsize(os.path.join(staging, file['safe_name']))
+        except OSError:
+            size = None
+        if size != file.get('stored_size', file['size']):
+            return f"文件 {file['name']} 不完整"
+    if is_local_group(file_group_id) or os.path.exists(group_folder):
+        return '文件组已存在'
+    # 先更新目录再写入记录：两者之间到达的请求在本节点找不到记录，不会被转回源节点
+    if not _catalog.move_group(file_group_id, source, NODE_ID):
+        return '文件组已不存在'
+    if os.path.isdir(staging):
+        os.replace(staging, group_folder)
+    files = info.get('files', [])
+    conn = get_db()
+    try:
+        with immediate_transaction(conn):
+            _insert_group(conn, file_group_id, dict(info, scan_pid=None))
+            conn.execute('UPDATE file_groups SET scan_error = ? WHERE id = ?', (info.get('scan_error'), file_group_id))
+            _add_storage_usage(conn, _physical_size(files))
+            _add_storage_usage(conn, info.get('total_size', 0), 'logical_bytes')
+            _add_storage_usage(conn, 1, 'group_count')
+            _add_storage_usage(conn, len(files), 'file_count')
+            conn.executemany('INSERT INTO frame_index VALUES (?, ?, ?)',
+                             [(file_group_id, name, base64.b64decode(offsets)) for name, offsets in frames.items()])
+            conn.executemany('INSERT INTO download_history (group_id, filename, time, ip) VALUES (?, ?, ?, ?)',
+                             [(file_group_id, item.get('filename'), item.get('time'), item.get('ip'))
+                              for item in history])
+            conn.executemany('INSERT INTO download_summary VALUES (?, ?, ?, ?)',
+                             [(file_group_id, item['filename'], item['count'], item.get('last_time'))
+                              for item in summary])
+    except sqlite3.IntegrityError:
+        # 取件码与本节点启用集群模式前的文件组冲突：交还源节点
+        _catalog.move_group(file_group_id, NODE_ID, source)
+        discard_folder(group_folder)
+        return '文件组记录冲突'
+    if info.get('expiry_date'):
+        schedule_expiry(file_group_id, info['expiry_date'])
+    return None
+
+def drop_moved_copy(file_group_id, node_id):
+    # 文件组已由其他节点接管（移动完成后源节点没来得及删除本地副本）
+    print(f"文件组 {file_group_id} 已移到节点 {node_id}，删除本地副本", flush=True)
+    _group_events.publish(file_group_id, 'moved', {'node': node_id})
+    trash_name = delete_group_record(file_group_id)
+    if trash_name is not None:
+        move_to_trash(trash_name, file_group_id)
+
+def move_group_to_node(file_group_id, node):
+    """
+    把文件组的文件和记录复制到 node，对方接管后删除本地副本，返回是否成功
+    复制期间仍可下载；复制开始后的下载次数不随记录移动
+    """
+    flush_download_events()
+    info = get_group_record(file_group_id, with_history=True)
+    if info is None or info['status'] == 'scanning':
+        return False
+    conn = get_db()
+    frames = {row['name']: base64.b64encode(row['offsets']).decode('ascii')
+              for row in conn.execute('SELECT name, offsets FROM frame_index WHERE group_id = ?', (file_group_id,))}
+    files = []
+    for file in info['files']:
+        # 去重存储的文件在目标节点保存为普通文件
+        entry = {key: value for key, value in file.items() if key != 'blob'}
+        entry['safe_name'] = file.get('safe_name', file['name'])
+        target = f"/cluster/groups/{file_group_id}/files/{urllib.parse.quote(entry['safe_name'])}"
+        finish_compressed_file(file_group_id, file)
+        with open(get_stored_file_path(file_group_id, file), 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size != file.get('stored_size', file['size']):
+                print(f"文件组 {file_group_id} 的文件 {file['name']} 与记录不符，暂不移动", flush=True)
+                return False
+            headers = dict(cluster_headers('PUT', target, f), **{'Content-Length': str(size)})
+            response = cluster.open_request(node['url'], 'PUT', target, headers, f)
+            message = response.read()
+            response.close()
+        if response.status != 200:
+            print(f"向节点 {node['id']} 发送文件失败: {response.status} {message[:200]!r}", flush=True)
+            return False
+        files.append(entry)
+    target = f'/cluster/groups/{file_group_id}'
+    body = json.dumps({
+        'source': NODE_ID,
+        'group': dict({key: info[key] for key in GROUP_COLUMNS}, files=files),
+        'frames': frames,
+        'history': info['download_history'],
+        'summary': info['download_summary'],
+    }, ensure_ascii=False).encode('utf-8')
+    headers = dict(cluster_headers('POST', target, body), **{'Content-Type': 'application/json',
+                                                       'Content-Length': str(len(body))})
+    response = cluster.open_request(node['url'], 'POST', target, headers, body)
+    message = response.read()
+    response.close()
+    if response.status != 200:
+        print(f"节点 {node['id']} 未能接管文件组 {file_group_id}: {response.status} {message[:200]!r}", flush=True)
+        return False
+    # 已连接的实时更新随之结束，浏览器重连时转发到新的节点
+    _group_events.publish(file_group_id, 'moved', {'node': node['id']})
+    trash_name = delete_group_record(file_group_id)
+    if trash_name is not None:
+        move_to_trash(trash_name, file_group_id)
+    return True
+
+def report_node_status():
+    # 心跳：本节点的地址、容量、用量和文件组数；剩余空间取配置容量与磁盘剩余空间中较小者
+    max_bytes = int(config["file_limits"]["total_storage_limit_gb"] * 1024 * 1024 * 1024)
+    used_bytes = get_total_storage_usage() + get_reserved_storage()
+    free_bytes = max(min(max_bytes - used_bytes, shutil.disk_usage(UPLOAD_FOLDER).free), 0)
+    _catalog.heartbeat(NODE_ID, NODE_URL, max_bytes, used_bytes, free_bytes, get_counter('group_count'),
+                       NODE_STARTED_AT)
+
+def sync_cluster_catalog():
+    """
+    核对本节点的文件组与目录：启用集群模式前已有的文件组登记到目录（取件码与其他节点冲突时重新分配），
+    已登记在其他节点的删除本地副本
+    """
+    conn = get_db()
+    for row in conn.execute('SELECT id, pickup_code, created_at FROM file_groups').fetchall():
+        node_id = _catalog.lookup_group(row['id'])
+        if node_id == NODE_ID:
+            continue
+        if node_id is not None:
+            drop_moved_copy(row['id'], node_id)
+            continue
+        pickup_code = row['pickup_code']
+        while not _catalog.register_group(row['id'], pickup_code, NODE_ID, row['created_at']):
+            pickup_code = generate_pickup_code()
+        if pickup_code != row['pickup_code']:
+            with conn:
+                conn.execute('UPDATE file_groups SET pickup_code = ? WHERE id = ?', (pickup_code, row['id']))
+            print(f"文件组 {row['id']} 的取件码与其他节点冲突，已重新分配为 {pickup_code}", flush=True)
+
+def rebalance_groups():
+    """
+    本节点排空时把所有文件组移到其他节点；用量比例高出集群平均值 REBALANCE_MARGIN 以上时，
+    把按一致性哈希应放在其他节点的文件组移过去，直到回到平均值附近；新加入的空节点由此分担已有的文件组
+    """
+    nodes = _catalog.nodes()
+    me = next((node for node in nodes if node['id'] == NODE_ID), None)
+    targets = [node for node in nodes if node['alive'] and node['state'] == 'active' and node['id'] != NODE_ID]
+    if me is None or not targets:
+        return 0
+    draining = me['state'] == 'draining'
+    candidates = targets if draining else targets + [me]
+    excess = None
+    if not draining:
+        capacity = sum(node['capacity_bytes'] for node in candidates)
+        average = sum(node['used_bytes'] for node in candidates) / max(capacity, 1)
+        excess = me['used_bytes'] - (average + REBALANCE_MARGIN) * me['capacity_bytes']
+        if excess <= 0:
+            return 0
+    moved = 0
+    rows = get_db().execute("SELECT id, files FROM file_groups WHERE status != 'scanning' ORDER BY created_at").fetchall()
+    for row in rows:
+        node_id = _catalog.lookup_group(row['id'])
+        if node_id is not None and node_id != NODE_ID:
+            drop_moved_copy(row['id'], node_id)
+            continue
+        size = sum(file.get('stored_size', file['size']) for file in json.loads(row['files']))
+        ranked = [node for node in cluster.rank_nodes(row['id'], candidates) if node['free_bytes'] > size]
+        if not ranked or ranked[0]['id'] == NODE_ID:
+            continue
+        target = ranked[0]
+        try:
+            if not move_group_to_node(row['id'], target):
+                continue
+        except OSError as e:
+            print(f"移动文件组 {row['id']} 到节点 {target['id']} 失败: {e}", flush=True)
+            continue
+        moved += 1
+        target['free_bytes'] -= size
+        if excess is not None:
+            excess -= size
+            if excess <= 0:
+                break
+    if moved:
+        print(f"已移动 {moved} 个文件组到其他节点", flush=True)
+    return moved
+
+def cluster_heartbeat_loop():
+    while True:
+        try:
+            report_node_status()
+            _catalog.prune_nonces()
+        except Exception as e:
+            print(f"更新节点状态失败: {e}", flush=True)
+        time.sleep(HEARTBEAT_SECONDS)
+
+def cluster_rebalance_loop():
+    # 移动文件组可能很慢，与心跳分开运行，避免心跳超时
+    try:
+        sync_cluster_catalog()
+    except Exception as e:
+        print(f"核对集群目录失败: {e}", flush=True)
+    while True:
+        time.sleep(HEARTBEAT_SECONDS)
+        try:
+            rebalance_groups()
+        except Exception as e:
+            print(f"平衡文件组失败: {e}", flush=True)
+
+@app.route('/api/cluster')
+def cluster_status():
+    # 各节点的地址、状态、容量和心跳，供监控使用
+    if _catalog is None:
+        return jsonify({'error': '集群模式未启用'}), 404
+    now = time.time()
+    nodes = [dict(node, heartbeat_age=round(now - node['heartbeat'], 1)) for node in _catalog.nodes()]
+    return jsonify({'node': NODE_ID, 'nodes': nodes})
+
+def run_cluster_command(action, node_id=None):
+    """命令行入口：查看集群状态，排空、恢复或移除节点，返回退出码"""
+    if _catalog is None:
+        print("集群模式未启用（config.json 中的 cluster.enabled）")
+        return 1
+    node_id = node_id or NODE_ID
+    if action == 'status':
+        now = time.time()
+        for node in _catalog.nodes():
+            print(f"{node['id']}{' *' if node['id'] == NODE_ID else ''}  {node['url']}  {node['state']}  "
+                  f"{'正常' if node['alive'] else '无响应'}（{now - node['heartbeat']:.0f}秒前）  "
+                  f"已用 {node['used_bytes']/(1024**3):.2f}GB/{node['capacity_bytes']/(1024**3):.2f}GB  "
+                  f"剩余 {node['free_bytes']/(1024**3):.2f}GB  文件组 {node['group_count']}")
+        return 0
+    if action in ('drain', 'activate'):
+        if not _catalog.set_state(node_id, 'draining' if action == 'drain' else 'active'):
+            print(f"找不到节点 {node_id}")
+            return 1
+        print(f"节点 {node_id} " + ('开始排空，文件组将在后台移到其他节点' if action == 'drain' else '恢复接收新文件组'))
+        return 0
+    node = _catalog.node(node_id)
+    if node is None:
+        print(f"找不到节点 {node_id}")
+        return 1
+    if node['alive']:
+        print(f"节点 {node_id} 仍在运行，请先排空并停止该节点")
+        return 1
+    remaining = _catalog.remove_node(node_id)
+    if remaining:
+        print(f"节点 {node_id} 上还有 {remaining} 个文件组，请先排空")
+        return 1
+    print(f"已移除节点 {node_id}")
+    return 0
+
 def clean_all_files():
     """清理所有文件和数据"""
-    data = load_data()
-    
+
     # 删除所有文件
     if os.path.exists(UPLOAD_FOLDER):
         for item in os.listdir(UPLOAD_FOLDER):
@@ -510,13 +3826,132 @@ def clean_all_files():
             else:
                 os.remove(item_path)
     
-    # 清空数据文件
-    save_data({"file_groups": {}})
+    # 删除未完成的分块上传
+    if os.path.exists(UPLOAD_SESSION_FOLDER):
+        shutil.rmtree(UPLOAD_SESSION_FOLDER, ignore_errors=True)
+    
+    # 清空元数据
+    clear_all_records()
     print("已清理所有文件和数据")
 
+def start_background_tasks():
+    """启动后台维护线程"""
+    global _expiry_worker_running
+    _expiry_worker_running = True
+    threading.Thread(target=storage_rescan_loop, name='storage-rescan', daemon=True).start()
+    threading.Thread(target=upload_session_gc_loop, name='upload-session-gc', daemon=True).start()
+    # 启动时先处理上次退出时没有删除完的内容
+    threading.Thread(target=trash_reaper_loop, name='trash-reaper', daemon=True).start()
+    load_expiry_schedule()
+    threading.Thread(target=expiry_worker_loop, name='expiry-worker', daemon=True).start()
+    if RECONCILE_INTERVAL > 0:
+        threading.Thread(target=reconcile_loop, name='reconcile', daemon=True).start()
+    if _catalog is not None:
+        threading.Thread(target=cluster_heartbeat_loop, name='cluster-heartbeat', daemon=True).start()
+        threading.Thread(target=cluster_rebalance_loop, name='cluster-rebalance', daemon=True).start()
+
+# 多进程部署：后台维护任务只在持有维护锁的worker中运行，该worker退出后由其他worker接替
+MAINTENANCE_LOCK_FILE = DB_FILE + '-maintenance.lock'
+_maintenance_lock_file = None
+
+def run_background_tasks_when_leader():
+    global _maintenance_lock_file
+    import fcntl
+    lock_file = open(MAINTENANCE_LOCK_FILE, 'a')
+    fcntl.flock(lock_file, fcntl.LOCK_EX)  # 阻塞直到获得锁，进程退出时自动释放
+    _maintenance_lock_file = lock_file
+    print(f"进程 {os.getpid()} 负责后台维护任务", flush=True)
+    start_background_tasks()
+
+def reset_process_state():
+    """fork出的worker不能沿用父进程的数据库连接和后台线程状态"""
+    global _db_local, _download_writer_started, _expiry_worker_running, _scan_pool, _scan_coordinator
+    global _metrics_writer_started, _event_stream_count
+    _db_local = threading.local()
+    _download_writer_started = False
+    _expiry_worker_running = False
+    _scan_pool = None
+    _scan_coordinator = None
+    # 每个worker只上报自己处理的请求
+    _metrics_writer_started = False
+    METRICS.reset()
+    _group_events.reset()
+    _event_stream_count = 0
+    _transfers.reset()
+    if _catalog is not None:
+        _catalog.reset()
+
+def run_production_server(host, port, workers, threads):
+    """
+    生产模式：gunicorn 多进程（gthread，每个进程多线程）；
+    没有gunicorn时（例如Windows）使用 waitress 单进程多线程
+    """
+    global EVENT_STREAM_LIMIT
+    # 实时更新连接长期占用工作线程，最多占用一半，其余留给上传下载
+    EVENT_STREAM_LIMIT = max(threads // 2, 1)
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        try:
+            from waitress import serve
+        except ImportError:
+            print("生产模式需要安装 gunicorn（Linux/macOS）或 waitress（Windows）")
+            sys.exit(1)
+        import signal
+        signal.signal(signal.SIGINT, handle_shutdown_signal)
+        signal.signal(signal.SIGTERM, handle_shutdown_signal)
+        start_background_tasks()
+        print(f"使用 waitress 启动，{threads} 个线程")
+        serve(app, host=host, port=port, threads=threads)
+        return
+    
+    # 各worker分别限速
+    configure_transfers(workers)
+    
+    def post_fork(server, worker):
+        reset_process_state()
+        threading.Thread(target=run_background_tasks_when_leader, name='maintenance-leader', daemon=True).start()
+    
+    def worker_exit(server, worker):
+        # worker退出前写入排队中的下载记录，放弃未完成的安全检查
+        stop_group_scans()
+        try:
+            flush_download_events()
+        except Exception as e:
+            print(f"写入下载记录失败: {e}", flush=True)
+    
+    def on_exit(server):
+        # 所有worker退出后由主进程统一清理，只执行一次
+        if os.environ.get('CLEAN_ON_EXIT', 'false').lower() == 'true':
+            print("清理所有文件和数据...", flush=True)
+            clean_all_files()
+        print("服务已安全关闭", flush=True)
+    
+    class ProductionServer(BaseApplication):
+        def load_config(self):
+            options = {
+                'bind': f'{host}:{port}',
+                'workers': workers,
+                'threads': threads,
+                'worker_class': 'gthread',
+                'post_fork': post_fork,
+                'worker_exit': worker_exit,
+                'on_exit': on_exit,
+            }
+            for key, value in options.items():
+                self.cfg.set(key, value)
+        
+        def load(self):
+            return app
+    
+    print(f"使用 gunicorn 启动，{workers} 个进程 × {threads} 个线程")
+    ProductionServer().run()
+
 def handle_shutdown_signal(signum, frame):
     """处理关闭信号"""
     print("\n正在关闭服务...", flush=True)
+    stop_group_scans()
+    flush_download_events()
     
     # 判断是否需要清理文件
     if os.environ.get('CLEAN_ON_EXIT', 'false').lower() == 'true':
@@ -534,30 +3969,41 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='文件共享平台')
     parser.add_argument('--clean', action='store_true', help='启动时清理所有文件')
     parser.add_argument('--clean-on-exit', action='store_true', help='退出时清理所有文件')
+    parser.add_argument('--serve', action='store_true', help='以生产模式运行（多进程、多线程，不使用调试服务器）')
+    parser.add_argument('--workers', type=int, help='生产模式的进程数，默认读取配置文件')
+    parser.add_argument('--threads', type=int, help='生产模式每个进程的线程数，默认读取配置文件')
+    subparsers = parser.add_subparsers(dest='command')
+    reconcile_parser = subparsers.add_parser('reconcile', help='核对元数据与上传目录，重建计数器和索引后退出')
+    reconcile_parser.add_argument('--restart', action='store_true', help='放弃上次未完成的检查，从头开始')
+    cluster_parser = subparsers.add_parser('cluster', help='查看集群状态，排空、恢复或移除节点后退出')
+    cluster_parser.add_argument('action', choices=['status', 'drain', 'activate', 'remove'])
+    cluster_parser.add_argument('--node', help='节点ID，默认为本节点')
     args = parser.parse_args()
     
     # 设置环境变量
     if args.clean_on_exit:
         os.environ['CLEAN_ON_EXIT'] = 'true'
     
-    # 注册信号处理器
-    import signal
-    signal.signal(signal.SIGINT, handle_shutdown_signal)
-    signal.signal(signal.SIGTERM, handle_shutdown_signal)
-    
     # 确保文件夹存在
     os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
     
-    # 确保数据文件存在
-    if not os.path.exists(DATA_FILE):
-        save_data({"file_groups": {}})
+    # 初始化元数据库（首次启动时迁移旧的JSON数据）
+    init_db()
     
-    # 如果需要，清理所有文件
+    if args.command == 'reconcile':
+        sys.exit(run_reconcile_command(args.restart))
+    if args.command == 'cluster':
+        sys.exit(run_cluster_command(args.action, args.node))
+    
+    # 启动清理在创建任何worker之前执行，只执行一次；
+    # 过期文件由后台过期线程清理，一致性检查也在后台进行，启动不等待扫描磁盘
     if args.clean:
         clean_all_files()
-    else:
-        # 只清理过期文件
-        clean_expired_files()
+    clear_storage_reservations()
+    # 上次运行留下的各进程指标快照
+    _metrics_store.clear()
+    # 在创建worker之前生成静态资源的指纹和压缩版本，各worker共用
+    _assets.ensure_built()
     
     # 从配置读取服务器设置
     host = config["server"]["host"]
@@ -570,6 +4016,26 @@ if __name__ == '__main__':
     print(f"配置存储空间: {config['file_limits']['total_storage_limit_gb']}GB")
     print(f"退出时清理文件: {'启用' if args.clean_on_exit else '禁用'}")
     
+    if args.serve:
+        # 主进程的数据库连接不能带入fork出的worker
+        get_db().close()
+        reset_process_state()
+        run_production_server(host, port,
+                              args.workers or config["server"].get("workers", 4),
+                              args.threads or config["server"].get("threads", 8))
+        sys.exit(0)
+    
+    # 注册信号处理器
+    import signal
+    signal.signal(signal.SIGINT, handle_shutdown_signal)
+    signal.signal(signal.SIGTERM, handle_shutdown_signal)
+    
+    _assets.auto_reload = debug
+    
+    # 调试模式下重载器的父进程只负责监视文件，不启动后台任务
+    if not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_background_tasks()
+    
     try:
         app.run(debug=debug, host=host, port=port)
     except KeyboardInterrupt:
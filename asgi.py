@@ -0,0 +1,414 @@
+"""
+ASGI入口，适合大量慢速连接（手机网络等）同时上传、下载的场景
+
+    python asgi.py
+    uvicorn asgi:application --host 0.0.0.0 --port 5000 --timeout-graceful-shutdown 30
+    WEB_CONCURRENCY=4 uvicorn asgi:application ...   # 多进程：限速按进程数平分，用环境变量而不是 --workers 指定进程数
+
+每个连接只占用一个协程，不再占用一个线程：
+- 请求体在协程中接收，边接收边交给业务逻辑读取：上传的大小、类型检查和空间预留在接收过程中进行，
+  不符合要求的上传不必等到全部接收完才拒绝；业务逻辑读完缓冲的数据后才继续接收，由TCP流控限制客户端
+- 业务逻辑仍由 app.py 中的Flask应用处理（容量、有效期、令牌检查等不变），在有界线程池中执行；
+  带请求体的请求使用单独的线程池，慢速上传不会占满下载和页面请求使用的线程
+- 响应体在线程池中逐块读取，客户端收完上一块（服务器发送缓冲区排空）后才读下一块，客户端断开时立即停止
+- 管理页面的实时更新连接同样先经过Flask的检查（集群转发、连接数上限、指标），之后在等待事件时不占用线程，
+  只有读取数据库时才进入线程池
+- 上传下载的限速在协程中等待：上传在接收请求体时限速，下载在发送每一块之后等待，都不占用线程
+"""
+import asyncio
+import collections
+import concurrent.futures
+import io
+import os
+import re
+import sys
+import threading
+
+from werkzeug.exceptions import ClientDisconnected, RequestEntityTooLarge
+
+import app as file_app
+from app import app, config
+
+# 文件读写和业务逻辑使用的线程数，与并发连接数无关
+IO_THREADS = config["server"].get("io_threads", 32)
+# 已接收、业务逻辑还没有读取的请求体超过该大小时暂停接收
+BODY_BUFFER_BYTES = 1024 * 1024
+# 退出时等待进行中的请求的最长时间；实时更新连接不会自行结束，超时后被关闭
+GRACEFUL_SHUTDOWN_SECONDS = 30
+
+_executor = concurrent.futures.ThreadPoolExecutor(max_workers=IO_THREADS, thread_name_prefix='asgi-io')
+# 处理带请求体的请求：业务逻辑读取请求体时等待客户端发送，线程占用时间取决于客户端的速度
+_body_executor = concurrent.futures.ThreadPoolExecutor(max_workers=IO_THREADS, thread_name_prefix='asgi-body')
+
+async def run_in_pool(func, *args, executor=_executor):
+    return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+async def send_simple_response(send, status, message):
+    body = message.encode('utf-8')
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'text/plain; charset=utf-8'),
+                            (b'content-length', str(len(body)).encode('latin-1'))]})
+    await send({'type': 'http.response.body', 'body': body})
+
+class RequestBody(io.RawIOBase):
+    """
+    业务逻辑在线程中读取的请求体（wsgi.input），由事件循环接收后放入
+    缓冲超过 BODY_BUFFER_BYTES 时事件循环暂停接收，业务逻辑读取后再继续
+    """
+    def __init__(self, loop):
+        super().__init__()
+        self.loop = loop
+        self.cond = threading.Condition()
+        self.chunks = collections.deque()
+        self.buffered = 0
+        self.finished = False
+        self.error = None  # 'disconnect' 或 'too_large'
+        self.abandoned = False  # 业务逻辑已处理完请求，不再读取
+        self.paused = False  # 缓冲已满，事件循环等待 space
+        self.space = asyncio.Event()
+        self.space.set()
+
+    def readable(self):
+        return True
+
+    def feed(self, chunk):
+        # 在事件循环中调用
+        with self.cond:
+            if self.abandoned:
+                return
+            self.chunks.append(chunk)
+            self.buffered += len(chunk)
+            if self.buffered >= BODY_BUFFER_BYTES:
+                self.paused = True
+                self.space.clear()
+            self.cond.notify()
+
+    def finish(self, error=None):
+        with self.cond:
+            self.finished = True
+            self.error = error
+            self.cond.notify()
+
+    def abandon(self):
+        with self.cond:
+            self.abandoned = True
+            self.chunks.clear()
+            self.buffered = 0
+            self.cond.notify()
+        self.loop.call_soon_threadsafe(self.space.set)
+
+    def exhaust(self):
+        # 表单解析结束（包括上传被拒绝）时调用，剩余的请求体不再读取，不必等客户端发送完
+        self.abandon()
+
+    def read(self, size=-1):
+        # 与普通文件一样，不到文件末尾时读满 size（werkzeug 把读不满视为客户端断开）
+        if size is None or size < 0:
+            return b''.join(iter(lambda: self.read(BODY_BUFFER_BYTES), b''))
+        parts = []
+        wanted = size
+        with self.cond:
+            while wanted:
+                while not self.chunks and not self.finished and not self.abandoned:
+                    self.cond.wait()
+                if not self.chunks:
+                    break
+                chunk = self.chunks.popleft()
+                if len(chunk) > wanted:
+                    self.chunks.appendleft(chunk[wanted:])
+                    chunk = chunk[:wanted]
+                parts.append(chunk)
+                wanted -= len(chunk)
+                self.buffered -= len(chunk)
+                if self.paused and self.buffered < BODY_BUFFER_BYTES:
+                    self.paused = False
+                    self.loop.call_soon_threadsafe(self.space.set)
+            if not parts and not self.abandoned:
+                if self.error == 'too_large':
+                    raise RequestEntityTooLarge()
+                if self.error == 'disconnect':
+                    raise ClientDisconnected()
+        return b''.join(parts)
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+async def receive_body(receive, body, max_bytes, transfer, disconnected):
+    """
+    接收请求体放入 body，超过 max_bytes 时停止；接收完后继续监听断开事件，客户端断开时设置 disconnected
+    上传限速在接收时进行，等待在协程中，不占用线程
+    """
+    size = 0
+    receiving = True
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            if receiving:
+                body.finish('disconnect')
+            disconnected.set()
+            return
+        if not receiving:
+            continue
+        chunk = message.get('body', b'')
+        size += len(chunk)
+        if max_bytes and size > max_bytes:
+            body.finish('too_large')
+            receiving = False
+            continue
+        if chunk and not body.abandoned:
+            body.feed(chunk)
+            if transfer is not None:
+                delay = file_app._transfers.reserve(transfer, len(chunk))
+                if delay:
+                    await asyncio.sleep(delay)
+            await body.space.wait()
+        if not message.get('more_body', False):
+            body.finish()
+            receiving = False
+            if transfer is not None:
+                transfer.close()
+
+def build_environ(scope, body):
+    # 按PEP 3333由ASGI的scope构造WSGI环境
+    path = scope.get('raw_path') or scope['path'].encode('utf-8')
+    path = path.split(b'?', 1)[0].decode('latin-1')
+    root_path = scope.get('root_path', '')
+    if root_path and path.startswith(root_path):
+        path = path[len(root_path):]
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': root_path,
+        'PATH_INFO': path,
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'SERVER_SOFTWARE': 'asgi',
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        # 请求体按实际接收到的内容结束（支持分块传输），长度上限在接收时检查
+        'wsgi.input_terminated': True,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+        file_app.ASYNC_THROTTLE_KEY: True,
+        # 请求体已在接收时限速，业务逻辑读取时不再限速
+        file_app.BODY_THROTTLED_KEY: True,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            environ[name] = value
+            continue
+        key = f'HTTP_{name}'
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+# 登记为上传传输（限速、客户端并发数）的请求：表单上传和分块上传，与 app.py 中调用 open_transfer('upload') 的路由一致
+UPLOAD_ROUTES = (('POST', re.compile(r'^/upload$')), ('PUT', re.compile(r'^/api/uploads/[^/]+/\d+/\d+$')))
+
+def request_path(scope):
+    path = scope['path']
+    root_path = scope.get('root_path', '')
+    if root_path and path.startswith(root_path):
+        path = path[len(root_path):]
+    return path
+
+def is_upload_request(scope):
+    path = request_path(scope)
+    return any(scope['method'] == method and pattern.match(path) for method, pattern in UPLOAD_ROUTES)
+
+def has_request_body(scope):
+    for name, value in scope.get('headers', []):
+        if name == b'transfer-encoding' or (name == b'content-length' and value != b'0'):
+            return True
+    return False
+
+async def handle_http(scope, receive, send):
+    max_bytes = app.config.get('MAX_CONTENT_LENGTH')
+    for name, value in scope.get('headers', []):
+        if name == b'content-length' and max_bytes and value.isdigit() and int(value) > max_bytes:
+            # 超过上限的请求不接收请求体，直接拒绝
+            await send_simple_response(send, 413, '上传内容超过大小限制')
+            return
+
+    loop = asyncio.get_running_loop()
+    body = RequestBody(loop)
+    executor = _executor
+    upload = None
+    if has_request_body(scope):
+        if is_upload_request(scope):
+            client = scope.get('client') or ('', 0)
+            # 上传的限速在接收请求体时进行，业务逻辑读取时不再限速
+            upload = file_app._transfers.open(client[0], None, 'upload', defer=True, throttled=False)
+            if upload is None:
+                await send_simple_response(send, 429, '同时进行的传输过多，请等待其他传输完成后重试')
+                return
+        executor = _body_executor
+    else:
+        body.finish()
+
+    # 接收请求体的同时运行业务逻辑；请求体接收完后继续监听断开事件，客户端断开时停止发送
+    disconnected = asyncio.Event()
+    receiver = asyncio.ensure_future(receive_body(receive, body, max_bytes, upload, disconnected))
+
+    response_start = {}
+    def start_response(status, headers, exc_info=None):
+        response_start['status'] = int(status.split(' ', 1)[0])
+        response_start['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                     for name, value in headers]
+
+    environ = build_environ(scope, body)
+    if upload is not None:
+        # 业务逻辑登记上传时沿用这个传输，同一个上传不重复计入客户端的传输数
+        environ[file_app.TRANSFER_KEY] = upload
+    # 实时更新连接经过与普通请求相同的检查（集群转发、连接数上限、指标）后交给协程发送
+    event_stream = environ[file_app.ASYNC_EVENTS_KEY] = {}
+    app_iter = None
+    try:
+        app_iter = await run_in_pool(app, environ, start_response, executor=executor)
+        iterator = iter(app_iter)
+        # 取第一块时才能确定响应头（生成器形式的WSGI应用可能延迟调用start_response）
+        chunk = await run_in_pool(next, iterator, None)
+        # 业务逻辑已处理完请求，没有读取的请求体不再保留
+        body.abandon()
+        if event_stream:
+            headers = [(name, value) for name, value in response_start['headers'] if name != b'content-length']
+            await send({'type': 'http.response.start', 'status': response_start['status'], 'headers': headers})
+            await send_group_events(send, disconnected, event_stream['file_group_id'], event_stream['last_event_id'])
+            return
+        await send({'type': 'http.response.start', 'status': response_start['status'],
+                    'headers': response_start['headers']})
+        transfer = environ.get(file_app.TRANSFER_KEY)
+        while chunk is not None and not disconnected.is_set():
+            if chunk:
+                # 发送缓冲区满时这里会等待，慢速客户端不会让服务器读入更多数据
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            if transfer is not None:
+                # 限速的等待时间在读取时累计，在这里等待
+                delay = transfer.take_delay()
+                if delay:
+                    await asyncio.sleep(delay)
+            chunk = await run_in_pool(next, iterator, None)
+        if not disconnected.is_set():
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+    except OSError:
+        pass  # 客户端已断开
+    finally:
+        receiver.cancel()
+        body.abandon()
+        if upload is not None:
+            upload.close()
+        if app_iter is not None and hasattr(app_iter, 'close'):
+            await run_in_pool(app_iter.close)
+
+async def send_group_events(send, disconnected, file_group_id, last_event_id):
+    """与 app.py 中 file_group_events 相同的事件流，等待事件时只占用一个协程；连接数已由 app.py 登记，结束时释放"""
+    loop = asyncio.get_running_loop()
+    wake = asyncio.Event()
+    
+    def notify():
+        # 在发布事件的线程中调用；事件循环已关闭时忽略
+        try:
+            loop.call_soon_threadsafe(wake.set)
+        except RuntimeError:
+            pass
+    
+    stream = file_app.GroupEventStream(file_group_id, last_event_id, notify)
+    closed = asyncio.ensure_future(disconnected.wait())
+    try:
+        messages = await run_in_pool(stream.open)
+        while True:
+            await send({'type': 'http.response.body', 'body': ''.join(messages).encode('utf-8'), 'more_body': True})
+            if stream.done:
+                break
+            waiter = asyncio.ensure_future(wake.wait())
+            await asyncio.wait({waiter, closed}, timeout=stream.next_wait(), return_when=asyncio.FIRST_COMPLETED)
+            waiter.cancel()
+            if closed.done():
+                return
+            wake.clear()
+            messages = await run_in_pool(stream.poll)
+        await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+    except OSError:
+        pass  # 客户端已断开
+    except asyncio.CancelledError:
+        # 服务退出时等待超时：正常结束响应，浏览器随后自动重连
+        await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+    finally:
+        closed.cancel()
+        stream.close()
+        file_app.release_event_stream()
+
+_background_started = False
+
+def startup():
+    """与 app.py 直接运行时相同的启动步骤；多进程运行时后台任务只在一个进程中执行"""
+    global _background_started
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    os.makedirs(file_app.UPLOAD_SESSION_FOLDER, exist_ok=True)
+    # 每个进程分别限速，与 gunicorn 部署相同按进程数平分（uvicorn 的 --workers 默认取自该环境变量）
+    file_app.configure_transfers(int(os.environ.get('WEB_CONCURRENCY', '1')))
+    file_app.init_db()
+    file_app.clear_stale_reservations()
+    file_app._assets.ensure_built()
+    if _background_started:
+        return
+    _background_started = True
+    if os.name == 'posix':
+        threading.Thread(target=file_app.run_background_tasks_when_leader, name='maintenance-leader',
+                         daemon=True).start()
+    else:
+        file_app.start_background_tasks()
+
+def shutdown():
+    file_app.stop_group_scans()
+    file_app.flush_download_events()
+    if os.environ.get('CLEAN_ON_EXIT', 'false').lower() == 'true':
+        file_app.clean_all_files()
+
+async def handle_lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            try:
+                await run_in_pool(startup)
+            except Exception as e:
+                await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                return
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await run_in_pool(shutdown)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def application(scope, receive, send):
+    if scope['type'] == 'http':
+        await handle_http(scope, receive, send)
+    elif scope['type'] == 'lifespan':
+        await handle_lifespan(receive, send)
+
+if __name__ == '__main__':
+    import argparse
+    import uvicorn
+    parser = argparse.ArgumentParser(description='文件共享平台（ASGI）')
+    parser.add_argument('--workers', type=int, default=1, help='进程数')
+    parser.add_argument('--clean-on-exit', action='store_true', help='退出时清理所有文件')
+    args = parser.parse_args()
+    if args.clean_on_exit:
+        os.environ['CLEAN_ON_EXIT'] = 'true'
+    # 传给各worker进程
+    os.environ['WEB_CONCURRENCY'] = str(args.workers)
+    # 上次运行留下的各进程指标快照
+    file_app._metrics_store.clear()
+    uvicorn.run('asgi:application', host=config["server"]["host"], port=config["server"]["port"],
+                workers=args.workers, lifespan='on', timeout_graceful_shutdown=GRACEFUL_SHUTDOWN_SECONDS)
@@ -0,0 +1,153 @@
+"""
+静态资源与静态页面（进程内）
+
+- 启动时读取 static 目录下的所有文件，按内容哈希生成带指纹的文件名（css/style.3f2a9c1d.css），
+  模板通过带指纹的地址引用，内容变化后地址随之变化，浏览器可以长期缓存而不必再向服务器确认
+- 预先压缩为 gzip 和 brotli（安装了 brotli 时），压缩后没有明显变小的（例如图片）只保留原始内容
+- 原始地址仍然可用，每次向服务器确认（ETag）
+- 只依赖配置的页面渲染一次后缓存，同样预先压缩
+"""
+import gzip
+import hashlib
+import mimetypes
+import os
+import threading
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# 文件名中内容哈希的长度
+FINGERPRINT_LENGTH = 8
+# 压缩后不小于原始大小的该比例时不保留压缩版本
+MAX_COMPRESSED_RATIO = 0.9
+# 按优先顺序排列，客户端同样接受时优先使用靠前的
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+def precompress(data):
+    """返回 {编码: 压缩后的数据}，只包含明显变小的编码"""
+    encoded = {}
+    for encoding in ENCODINGS:
+        if encoding == 'br':
+            packed = brotli.compress(data, quality=11)
+        else:
+            # 固定文件头中的时间，内容相同时压缩结果相同
+            packed = gzip.compress(data, compresslevel=9, mtime=0)
+        if len(packed) < len(data) * MAX_COMPRESSED_RATIO:
+            encoded[encoding] = packed
+    return encoded
+
+def fingerprinted_name(path, digest):
+    directory, name = os.path.split(path)
+    stem, ext = os.path.splitext(name)
+    return f"{directory + '/' if directory else ''}{stem}.{digest[:FINGERPRINT_LENGTH]}{ext}"
+
+class Asset:
+    def __init__(self, path, data, mtime):
+        self.path = path  # 相对 static 目录，使用 / 分隔
+        self.data = data
+        self.mtime = mtime
+        self.digest = hashlib.sha256(data).hexdigest()
+        self.etag = self.digest[:32]
+        self.fingerprinted = fingerprinted_name(path, self.digest)
+        self.mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        self.encoded = precompress(data)
+
+class AssetPipeline:
+    def __init__(self, folder, auto_reload=False):
+        self.folder = folder
+        # 调试时每次查找前检查文件是否修改过
+        self.auto_reload = auto_reload
+        self.lock = threading.Lock()
+        self.assets = {}  # 原始路径 -> Asset
+        self.routes = {}  # 请求路径 -> (Asset, 是否带指纹)
+        self.built = False
+
+    def scan(self):
+        """static 目录下的 {路径: 修改时间}"""
+        found = {}
+        for root, dirs, names in os.walk(self.folder):
+            dirs[:] = [name for name in dirs if not name.startswith('.')]
+            for name in names:
+                if name.startswith('.'):
+                    continue
+                full_path = os.path.join(root, name)
+                path = os.path.relpath(full_path, self.folder).replace(os.sep, '/')
+                found[path] = os.stat(full_path).st_mtime
+        return found
+
+    def build(self):
+        # 没有修改过的文件沿用上次的结果
+        assets = {}
+        for path, mtime in self.scan().items():
+            asset = self.assets.get(path)
+            if asset is None or asset.mtime != mtime:
+                with open(os.path.join(self.folder, *path.split('/')), 'rb') as f:
+                    asset = Asset(path, f.read(), mtime)
+            assets[path] = asset
+        routes = {}
+        for asset in assets.values():
+            routes[asset.path] = (asset, False)
+            routes[asset.fingerprinted] = (asset, True)
+        self.assets = assets
+        self.routes = routes
+        self.built = True
+
+    def ensure_built(self):
+        if self.built and not self.auto_reload:
+            return
+        with self.lock:
+            if not self.built or (self.auto_reload and self.changed()):
+                self.build()
+
+    def changed(self):
+        current = self.scan()
+        return current.keys() != self.assets.keys() or any(
+            self.assets[path].mtime != mtime for path, mtime in current.items())
+
+    def url_path(self, path):
+        """带指纹的路径，找不到时返回原路径"""
+        self.ensure_built()
+        asset = self.assets.get(path)
+        return asset.fingerprinted if asset is not None else path
+
+    def lookup(self, path):
+        """请求路径对应的 (Asset, 是否带指纹)，找不到时返回 (None, False)"""
+        self.ensure_built()
+        return self.routes.get(path, (None, False))
+
+    def stats(self):
+        self.ensure_built()
+        return {
+            'files': len(self.assets),
+            'bytes': sum(len(asset.data) for asset in self.assets.values()),
+            'encoded_bytes': {encoding: sum(len(asset.encoded.get(encoding, asset.data))
+                                            for asset in self.assets.values())
+                              for encoding in ENCODINGS},
+        }
+
+class Page:
+    def __init__(self, body):
+        self.data = body.encode('utf-8')
+        self.etag = hashlib.sha256(self.data).hexdigest()[:32]
+        self.encoded = precompress(self.data)
+
+class PageCache:
+    """渲染结果只取决于模板和配置的页面"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pages = {}
+
+    def get(self, key, render):
+        page = self.pages.get(key)
+        if page is None:
+            # 渲染在锁外进行，并发的首次请求可能重复渲染，结果相同
+            page = Page(render())
+            with self.lock:
+                page = self.pages.setdefault(key, page)
+        return page
+
+    def clear(self):
+        with self.lock:
+            self.pages = {}
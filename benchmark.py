@@ -0,0 +1,623 @@
+"""
+性能基准测试
+
+在临时目录中启动一份独立的服务（不影响本目录中的数据），按场景施加负载，统计各接口的
+吞吐量和 p50/p95/p99 延迟，以及服务进程的内存和磁盘IO，结果保存为JSON便于对比：
+
+    python benchmark.py                                  # 默认规模
+    python benchmark.py --profile quick                  # 快速检查
+    python benchmark.py --profile full --server serve    # 百万文件组，生产模式
+    python benchmark.py --compare 旧结果.json 新结果.json
+    python benchmark.py --generate file_data.json --groups 100000   # 只生成合成数据
+
+场景依次为：启动（导入合成的 file_data.json）、大量小文件上传、少量大文件分块上传、
+按取件码取件、并发分段下载、管理页面轮询
+"""
+import argparse
+import concurrent.futures
+import datetime
+import http.client
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import string
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import uuid
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# 启动服务需要复制到临时目录的文件
+APP_FILES = ['app.py', 'asgi.py', 'events.py', 'metrics.py', 'scanner.py', 'transfers.py', 'compression.py', 'assets.py', 'cluster.py', 'config.json', 'templates', 'static']
+RESULTS_DIR = os.path.join(BASE_DIR, 'benchmark_results')
+
+PROFILES = {
+    'quick': {'groups': 10000, 'small_uploads': 200, 'large_count': 1, 'large_mb': 256,
+              'pickups': 2000, 'range_requests': 500, 'polls': 500},
+    'standard': {'groups': 100000, 'small_uploads': 1000, 'large_count': 2, 'large_mb': 1024,
+                 'pickups': 10000, 'range_requests': 2000, 'polls': 2000},
+    'full': {'groups': 1000000, 'small_uploads': 5000, 'large_count': 3, 'large_mb': 4096,
+             'pickups': 50000, 'range_requests': 10000, 'polls': 10000},
+}
+
+CODE_CHARS = string.ascii_uppercase + string.digits
+
+# 合成数据
+
+def generate_file_data(path, groups, files_per_group=3, expired_ratio=0.05, seed=1):
+    """
+    生成旧版 file_data.json 格式的合成数据，返回有效文件组的取件码列表
+    按文件组逐个写入，百万级数据也不需要把整个结构放在内存中
+    """
+    rng = random.Random(seed)
+    now = datetime.datetime.now()
+    codes = set()
+    live_codes = []
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('{"file_groups": {')
+        for index in range(groups):
+            code = ''.join(rng.choice(CODE_CHARS) for _ in range(6))
+            while code in codes:
+                code = ''.join(rng.choice(CODE_CHARS) for _ in range(8))
+            codes.add(code)
+            created = now - datetime.timedelta(minutes=rng.randint(1, 7 * 24 * 60))
+            expired = rng.random() < expired_ratio
+            expiry = now + datetime.timedelta(minutes=-rng.randint(1, 600) if expired else rng.randint(60, 9 * 24 * 60))
+            files = []
+            for file_index in range(rng.randint(1, files_per_group)):
+                name = f'文件_{index}_{file_index}.txt'
+                files.append({'name': name, 'safe_name': f'file_{index}_{file_index}.txt',
+                              'size': rng.randint(1024, 64 * 1024 * 1024), 'upload_time': created.isoformat()})
+            history = [{'filename': files[0]['name'], 'time': (created + datetime.timedelta(minutes=i)).isoformat(),
+                        'ip': f'10.0.{rng.randint(0, 255)}.{rng.randint(1, 254)}'}
+                       for i in range(rng.randint(0, 5))]
+            group = {
+                'pickup_code': code,
+                'files': files,
+                'created_at': created.isoformat(),
+                'expiry_date': expiry.isoformat(),
+                'max_downloads': None if rng.random() < 0.7 else rng.randint(len(history) + 1, 100),
+                'download_count': len(history),
+                'download_history': history,
+                'total_size': sum(file['size'] for file in files),
+            }
+            f.write(('' if index == 0 else ', ') + json.dumps(str(uuid.UUID(int=rng.getrandbits(128))))
+                    + ': ' + json.dumps(group, ensure_ascii=False))
+            if not expired:
+                live_codes.append(code)
+        f.write('}}')
+    return live_codes
+
+# 统计
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    k = (len(sorted_values) - 1) * p / 100
+    lower = int(k)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (k - lower)
+
+class Recorder:
+    """按接口记录每个请求的延迟、状态码和传输字节数"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}
+
+    def record(self, endpoint, seconds, status, nbytes=0):
+        with self.lock:
+            entry = self.samples.setdefault(endpoint, {'latencies': [], 'errors': 0, 'bytes': 0, 'statuses': {}})
+            entry['latencies'].append(seconds)
+            entry['bytes'] += nbytes
+            entry['statuses'][str(status)] = entry['statuses'].get(str(status), 0) + 1
+            if not isinstance(status, int) or status >= 400:
+                entry['errors'] += 1
+
+    def summary(self, wall_seconds):
+        result = {}
+        for endpoint, entry in self.samples.items():
+            latencies = sorted(entry['latencies'])
+            result[endpoint] = {
+                'requests': len(latencies),
+                'errors': entry['errors'],
+                'statuses': entry['statuses'],
+                'throughput_rps': len(latencies) / wall_seconds if wall_seconds else None,
+                'throughput_mb_s': entry['bytes'] / 1024 / 1024 / wall_seconds if wall_seconds else None,
+                'mean_ms': sum(latencies) / len(latencies) * 1000,
+                'p50_ms': percentile(latencies, 50) * 1000,
+                'p95_ms': percentile(latencies, 95) * 1000,
+                'p99_ms': percentile(latencies, 99) * 1000,
+                'max_ms': latencies[-1] * 1000,
+            }
+        return result
+
+class ProcessSampler:
+    """定期采样服务进程（含gunicorn等的子进程）的内存，并统计磁盘读写量，只支持Linux"""
+    def __init__(self, pid, interval=0.5):
+        self.pid = pid
+        self.interval = interval
+        self.peak_rss = 0
+        self.io_totals = {}
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    @staticmethod
+    def available():
+        return os.path.exists('/proc/self/status')
+
+    def process_tree(self):
+        pids = [self.pid]
+        children = {}
+        for name in os.listdir('/proc'):
+            if not name.isdigit():
+                continue
+            try:
+                with open(f'/proc/{name}/stat') as f:
+                    ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            children.setdefault(ppid, []).append(int(name))
+        for pid in pids:
+            pids.extend(children.get(pid, []))
+        return pids
+
+    def sample(self):
+        rss = 0
+        for pid in self.process_tree():
+            try:
+                with open(f'/proc/{pid}/status') as f:
+                    for line in f:
+                        if line.startswith('VmRSS:'):
+                            rss += int(line.split()[1]) * 1024
+                with open(f'/proc/{pid}/io') as f:
+                    counters = dict(line.split(': ') for line in f.read().splitlines())
+                # 已退出的进程保留最后一次的读数
+                self.io_totals[pid] = (int(counters['read_bytes']), int(counters['write_bytes']))
+            except (OSError, KeyError, ValueError):
+                continue
+        self.peak_rss = max(self.peak_rss, rss)
+        return rss
+
+    def io_bytes(self):
+        return (sum(value[0] for value in self.io_totals.values()),
+                sum(value[1] for value in self.io_totals.values()))
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        self.sample()
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.sample()
+
+# HTTP客户端
+
+class Client:
+    """每个线程复用一个HTTP连接，服务器关闭连接时自动重连"""
+    def __init__(self, host, port, recorder):
+        self.host = host
+        self.port = port
+        self.recorder = recorder
+        self.local = threading.local()
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = http.client.HTTPConnection(self.host, self.port, timeout=600)
+        return conn
+
+    def request(self, endpoint, method, path, body=None, headers=None, sink=False):
+        """发送请求并记录到 endpoint 名下，返回 (状态码, 响应体)；sink 为真时丢弃响应体只统计字节数"""
+        headers = dict(headers or {})
+        start = time.perf_counter()
+        for attempt in range(2):
+            conn = self.connection()
+            try:
+                if hasattr(body, 'seek'):
+                    body.seek(0)
+                conn.request(method, path, body=body, headers=headers)
+                response = conn.getresponse()
+                received = 0
+                data = b''
+                while True:
+                    block = response.read(256 * 1024)
+                    if not block:
+                        break
+                    received += len(block)
+                    if not sink:
+                        data += block
+                status = response.status
+                break
+            except (http.client.HTTPException, ConnectionError, socket.timeout):
+                conn.close()
+                self.local.conn = None
+                if attempt:
+                    self.recorder.record(endpoint, time.perf_counter() - start, 'connection_error')
+                    return None, b''
+        elapsed = time.perf_counter() - start
+        sent = len(body) if isinstance(body, (bytes, bytearray)) else int(headers.get('Content-Length', 0))
+        self.recorder.record(endpoint, elapsed, status, sent + received)
+        return status, data
+
+    def json(self, endpoint, method, path, payload=None, form=None, files=None):
+        headers = {}
+        body = None
+        if payload is not None:
+            body = json.dumps(payload).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        elif form is not None or files is not None:
+            body, content_type = encode_multipart(form or {}, files or [])
+            headers['Content-Type'] = content_type
+        status, data = self.request(endpoint, method, path, body=body, headers=headers)
+        try:
+            return status, json.loads(data) if data else {}
+        except ValueError:
+            return status, {}
+
+def encode_multipart(fields, files):
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode('utf-8'))
+    for name, filename, data in files:
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                     f'Content-Type: application/octet-stream\r\n\r\n'.encode('utf-8') + data + b'\r\n')
+    parts.append(f'--{boundary}--\r\n'.encode('utf-8'))
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+def run_concurrently(count, concurrency, task):
+    # 用 concurrency 个线程执行 task(i)，返回总耗时
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(task, i) for i in range(count)]:
+            future.result()
+    return time.perf_counter() - start
+
+# 服务进程
+
+def prepare_workdir(workdir, port, groups, seed):
+    """复制应用到临时目录，写入测试用配置和合成数据，返回有效取件码列表"""
+    for name in APP_FILES:
+        source = os.path.join(BASE_DIR, name)
+        if os.path.isdir(source):
+            shutil.copytree(source, os.path.join(workdir, name))
+        elif os.path.exists(source):
+            shutil.copy2(source, workdir)
+    with open(os.path.join(BASE_DIR, 'config.json'), encoding='utf-8') as f:
+        config = json.load(f)
+    config['server'].update({'host': '127.0.0.1', 'port': port, 'debug': False})
+    with open(os.path.join(workdir, 'config.json'), 'w', encoding='utf-8') as f:
+        json.dump(config, f, ensure_ascii=False, indent=4)
+    if not groups:
+        return []
+    return generate_file_data(os.path.join(workdir, 'file_data.json'), groups, seed=seed)
+
+def server_command(mode, workers):
+    if mode == 'serve':
+        return [sys.executable, 'app.py', '--serve', '--workers', str(workers)]
+    if mode == 'asgi':
+        return [sys.executable, 'asgi.py', '--workers', str(workers)]
+    return [sys.executable, 'app.py']
+
+def start_server(workdir, mode, workers, port, timeout):
+    """启动服务并等待首页可以访问，返回 (进程, 启动耗时)"""
+    log = open(os.path.join(workdir, 'server.log'), 'wb')
+    start = time.perf_counter()
+    process = subprocess.Popen(server_command(mode, workers), cwd=workdir, stdout=log, stderr=subprocess.STDOUT,
+                               start_new_session=True)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'服务启动失败，详见 {log.name}')
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+            conn.request('GET', '/')
+            if conn.getresponse().status == 200:
+                conn.close()
+                return process, time.perf_counter() - start
+        except (ConnectionError, OSError, http.client.HTTPException):
+            time.sleep(0.2)
+    stop_server(process)
+    raise RuntimeError(f'服务在 {timeout} 秒内没有就绪，详见 {log.name}')
+
+def stop_server(process):
+    if process.poll() is not None:
+        return
+    process.terminate()
+    try:
+        process.wait(30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+# 场景
+
+def wait_until_ready(client, file_group_id, timeout=600):
+    # 等待安全检查结束，返回从调用到检查完成的时间
+    start = time.perf_counter()
+    while time.perf_counter() - start < timeout:
+        status, data = client.json('scan_status', 'GET', f'/api/file-group/{file_group_id}')
+        group = data.get('file_group') or {}
+        if group.get('status') != 'scanning':
+            return group.get('status'), time.perf_counter() - start
+        time.sleep(0.2)
+    return 'timeout', time.perf_counter() - start
+
+def scenario_small_uploads(client, args, state):
+    rng = random.Random(args.seed)
+    payloads = [rng.randbytes(rng.randint(1024, 64 * 1024)) for _ in range(32)]
+    uploaded = []
+    lock = threading.Lock()
+
+    def task(i):
+        status, data = client.json('POST /upload', 'POST', '/upload',
+                                   form={'expiry_unit': 'days', 'expiry_value': '1'},
+                                   files=[('files[]', f'small_{i}.txt', payloads[i % len(payloads)])])
+        if status == 200:
+            with lock:
+                uploaded.append(data)
+    wall = run_concurrently(args.small_uploads, args.concurrency, task)
+    state['small_groups'] = uploaded
+    return wall
+
+def upload_large_file(client, name, size_mb, seed, parallel_chunks=4):
+    # 与浏览器相同，通过分块上传接口上传，每个文件同时上传 parallel_chunks 个分块
+    size = size_mb * 1024 * 1024
+    status, session = client.json('POST /api/uploads', 'POST', '/api/uploads', payload={
+        'files': [{'name': name, 'size': size}], 'expiry_unit': 'days', 'expiry_value': 1})
+    if status != 200:
+        return None
+    chunk_size = session['chunk_size']
+    block = random.Random(f'{seed}:{name}').randbytes(chunk_size)
+    upload_id = session['upload_id']
+
+    def put_chunk(chunk_index):
+        length = min(chunk_size, size - chunk_index * chunk_size)
+        client.request('PUT /api/uploads/<id>/<file>/<chunk>', 'PUT', f'/api/uploads/{upload_id}/0/{chunk_index}',
+                       body=block[:length], headers={'Content-Length': str(length)})
+    run_concurrently(session['files'][0]['chunks'], parallel_chunks, put_chunk)
+    status, data = client.json('POST /api/uploads/<id>/complete', 'POST', f'/api/uploads/{upload_id}/complete')
+    return data if status == 200 else None
+
+def scenario_large_uploads(client, args, state):
+    results = []
+    lock = threading.Lock()
+
+    def task(i):
+        data = upload_large_file(client, f'large_{i}.mp4', args.large_mb, args.seed)
+        if data:
+            with lock:
+                results.append(data)
+    wall = run_concurrently(args.large_count, args.large_count, task)
+    # 上传请求不等待安全检查，这里单独统计检查完成所需的时间
+    for data in results:
+        status, seconds = wait_until_ready(client, data['file_group_id'])
+        client.recorder.record('scan_completion', seconds, 200 if status == 'ready' else 500)
+    state['large_groups'] = results
+    return wall
+
+def scenario_pickup(client, args, state):
+    rng = random.Random(args.seed)
+    codes = state['live_codes'] + [group['pickup_code'] for group in state.get('small_groups', [])]
+    # 约10%的请求使用不存在的取件码，单独统计
+    lookups = [('POST /pickup', rng.choice(codes)) if codes and rng.random() < 0.9 else
+               ('POST /pickup (miss)', ''.join(rng.choice(CODE_CHARS) for _ in range(7)))
+               for _ in range(args.pickups)]
+
+    def task(i):
+        endpoint, code = lookups[i]
+        client.json(endpoint, 'POST', '/pickup', form={'pickup_code': code})
+    return run_concurrently(args.pickups, args.concurrency, task)
+
+def scenario_ranged_downloads(client, args, state):
+    group = next(iter(state.get('large_groups') or []), None)
+    if group is None:
+        # 没有大文件时上传一个中等大小的文件用于分段下载
+        group = upload_large_file(client, 'range.mp4', 64, args.seed)
+        if group is None:
+            return None
+        wait_until_ready(client, group['file_group_id'])
+    status, data = client.json('pickup (setup)', 'POST', '/pickup', form={'pickup_code': group['pickup_code']})
+    if status != 200:
+        return None
+    file = data['files'][0]
+    path = (f"/download/{group['file_group_id']}/{urllib.parse.quote(file['name'])}"
+            f"?token={urllib.parse.quote(data['token'])}")
+    rng = random.Random(args.seed)
+    range_size = args.range_kb * 1024
+    offsets = [rng.randrange(0, max(file['size'] - range_size, 1)) for _ in range(args.range_requests)]
+
+    def task(i):
+        start = offsets[i]
+        client.request('GET /download (range)', 'GET', path,
+                       headers={'Range': f'bytes={start}-{start + range_size - 1}'}, sink=True)
+    return run_concurrently(args.range_requests, args.concurrency, task)
+
+def scenario_manage_polling(client, args, state):
+    groups = state.get('small_groups') or []
+    if not groups:
+        return None
+
+    def task(i):
+        group = groups[i % len(groups)]
+        if i % 2:
+            client.request('GET /manage/<id>', 'GET', f"/manage/{group['file_group_id']}", sink=True)
+        else:
+            client.json('GET /api/file-group/<id>', 'GET', f"/api/file-group/{group['file_group_id']}")
+    return run_concurrently(args.polls, args.concurrency, task)
+
+SCENARIOS = [
+    ('small_uploads', scenario_small_uploads),
+    ('large_uploads', scenario_large_uploads),
+    ('pickup', scenario_pickup),
+    ('ranged_downloads', scenario_ranged_downloads),
+    ('manage_polling', scenario_manage_polling),
+]
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BASE_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmark(args):
+    port = args.port or free_port()
+    workdir = tempfile.mkdtemp(prefix='file-share-bench-')
+    result = {
+        'meta': {
+            'time': datetime.datetime.now().isoformat(timespec='seconds'),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'args': {key: value for key, value in vars(args).items() if key not in ('compare', 'generate')},
+        },
+        'phases': {},
+    }
+    try:
+        print(f'生成 {args.groups} 个合成文件组...')
+        state = {'live_codes': prepare_workdir(workdir, port, args.groups, args.seed)}
+        process, startup = start_server(workdir, args.server, args.workers, port, args.startup_timeout)
+        print(f'服务已启动（{args.server}），耗时 {startup:.2f} 秒（含导入合成数据）')
+        result['startup_seconds'] = startup
+        sampler = ProcessSampler(process.pid) if ProcessSampler.available() else None
+        if sampler:
+            sampler.start()
+        client = None
+        try:
+            for name, scenario in SCENARIOS:
+                if name in args.skip:
+                    continue
+                recorder = Recorder()
+                client = Client('127.0.0.1', port, recorder)
+                if sampler:
+                    sampler.peak_rss = sampler.sample()
+                    io_before = sampler.io_bytes()
+                print(f'运行场景 {name}...')
+                wall = scenario(client, args, state)
+                if wall is None:
+                    print('  跳过：缺少前置数据')
+                    continue
+                phase = {'wall_seconds': wall, 'endpoints': recorder.summary(wall)}
+                if sampler:
+                    sampler.sample()
+                    io_after = sampler.io_bytes()
+                    phase['server_rss_peak_mb'] = sampler.peak_rss / 1024 / 1024
+                    phase['disk_read_mb'] = (io_after[0] - io_before[0]) / 1024 / 1024
+                    phase['disk_write_mb'] = (io_after[1] - io_before[1]) / 1024 / 1024
+                result['phases'][name] = phase
+                print_phase(name, phase)
+        finally:
+            if sampler:
+                sampler.stop()
+            stop_server(process)
+    finally:
+        if args.keep:
+            print(f'测试目录保留在 {workdir}')
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+    output = args.output or os.path.join(
+        RESULTS_DIR, f"{datetime.datetime.now():%Y%m%d-%H%M%S}-{result['meta']['commit'] or 'local'}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f'结果已保存到 {output}')
+    return result
+
+# 输出与对比
+
+def format_number(value, digits=1):
+    return '-' if value is None else f'{value:.{digits}f}'
+
+def print_phase(name, phase):
+    extra = ''
+    if 'server_rss_peak_mb' in phase:
+        extra = (f"，内存峰值 {phase['server_rss_peak_mb']:.0f}MB，磁盘读 {phase['disk_read_mb']:.0f}MB"
+                 f" 写 {phase['disk_write_mb']:.0f}MB")
+    print(f"  {name}: {phase['wall_seconds']:.2f} 秒{extra}")
+    print(f"    {'接口':<40}{'请求数':>8}{'错误':>6}{'请求/秒':>10}{'MB/秒':>9}{'p50ms':>9}{'p95ms':>9}{'p99ms':>9}")
+    for endpoint, stats in phase['endpoints'].items():
+        print(f"    {endpoint:<40}{stats['requests']:>8}{stats['errors']:>6}"
+              f"{format_number(stats['throughput_rps']):>10}{format_number(stats['throughput_mb_s']):>9}"
+              f"{format_number(stats['p50_ms']):>9}{format_number(stats['p95_ms']):>9}{format_number(stats['p99_ms']):>9}")
+
+def change(old, new):
+    if not old or new is None:
+        return '-'
+    return f'{(new - old) / old * 100:+.1f}%'
+
+def compare_results(old_path, new_path):
+    """对比两次运行：各接口的吞吐量和 p95/p99 延迟"""
+    with open(old_path, encoding='utf-8') as f:
+        old = json.load(f)
+    with open(new_path, encoding='utf-8') as f:
+        new = json.load(f)
+    print(f"旧: {old['meta']['time']} ({old['meta'].get('commit')})  新: {new['meta']['time']} ({new['meta'].get('commit')})")
+    print(f"启动耗时: {format_number(old.get('startup_seconds'), 2)}s -> {format_number(new.get('startup_seconds'), 2)}s "
+          f"({change(old.get('startup_seconds'), new.get('startup_seconds'))})")
+    for name, phase in new['phases'].items():
+        old_phase = old['phases'].get(name, {})
+        print(f"{name}: {format_number(old_phase.get('wall_seconds'), 2)}s -> {phase['wall_seconds']:.2f}s, "
+              f"内存峰值 {format_number(old_phase.get('server_rss_peak_mb'), 0)}MB -> "
+              f"{format_number(phase.get('server_rss_peak_mb'), 0)}MB")
+        for endpoint, stats in phase['endpoints'].items():
+            old_stats = old_phase.get('endpoints', {}).get(endpoint, {})
+            print(f"    {endpoint:<40} 请求/秒 {change(old_stats.get('throughput_rps'), stats['throughput_rps']):>8}"
+                  f"  p95 {change(old_stats.get('p95_ms'), stats['p95_ms']):>8}"
+                  f"  p99 {change(old_stats.get('p99_ms'), stats['p99_ms']):>8}")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='文件共享平台性能基准测试')
+    parser.add_argument('--profile', choices=PROFILES, default='standard', help='预设规模，下列参数可单独覆盖')
+    parser.add_argument('--groups', type=int, help='合成的已有文件组数量')
+    parser.add_argument('--small-uploads', type=int, help='小文件上传次数')
+    parser.add_argument('--large-count', type=int, help='大文件数量')
+    parser.add_argument('--large-mb', type=int, help='每个大文件的大小（MB）')
+    parser.add_argument('--pickups', type=int, help='取件请求数')
+    parser.add_argument('--range-requests', type=int, help='分段下载请求数')
+    parser.add_argument('--range-kb', type=int, default=1024, help='每个分段的大小（KB）')
+    parser.add_argument('--polls', type=int, help='管理页面轮询请求数')
+    parser.add_argument('--concurrency', type=int, default=16, help='并发客户端数')
+    parser.add_argument('--server', choices=['dev', 'serve', 'asgi'], default='dev',
+                        help='服务运行方式：dev 为 python app.py，serve 为生产模式，asgi 为异步模式')
+    parser.add_argument('--workers', type=int, default=4, help='serve/asgi 模式的进程数')
+    parser.add_argument('--skip', nargs='*', default=[], choices=[name for name, _ in SCENARIOS], help='跳过的场景')
+    parser.add_argument('--port', type=int, help='服务端口，默认自动选择')
+    parser.add_argument('--seed', type=int, default=1, help='随机数种子，相同种子生成相同的数据和请求')
+    parser.add_argument('--startup-timeout', type=int, default=1800, help='等待服务启动的秒数（导入大量合成数据较慢）')
+    parser.add_argument('--output', help='结果文件路径，默认保存到 benchmark_results/')
+    parser.add_argument('--keep', action='store_true', help='保留临时测试目录（含服务日志）')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='对比两次运行的结果文件')
+    parser.add_argument('--generate', metavar='PATH', help='只生成合成的 file_data.json')
+    args = parser.parse_args()
+    for key, value in PROFILES[args.profile].items():
+        if getattr(args, key) is None:
+            setattr(args, key, value)
+    return args
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.compare:
+        compare_results(*args.compare)
+    elif args.generate:
+        codes = generate_file_data(args.generate, args.groups, seed=args.seed)
+        print(f'已生成 {args.groups} 个文件组（{len(codes)} 个未过期）到 {args.generate}')
+    else:
+        run_benchmark(args)
@@ -0,0 +1,258 @@
+"""
+集群模式：多个节点共用一个元数据目录，文件组分布存储在各节点
+
+- 目录是所有节点都能访问的 SQLite 文件，登记各节点的地址、容量和心跳，
+  以及每个文件组（和分块上传会话）所在的节点；取件码在目录中唯一，整个集群共用一个取件码空间
+- 文件组的详细记录和文件仍保存在所在节点本地，目录只用于定位
+- 新文件组按加权的最高随机权重（rendezvous）哈希选择节点，权重为节点的剩余空间：
+  文件组落在各节点的概率与剩余空间成正比，节点加入或排空时只有需要移动的文件组改变位置
+- 节点之间转发的请求用目录中保存的共享密钥签名，签名包括请求体的哈希和原始客户端；
+  每个签名只能使用一次，截获的请求不能重放
+"""
+import hashlib
+import hmac
+import http.client
+import math
+import secrets
+import sqlite3
+import threading
+import time
+import urllib.parse
+
+# 签名的有效时间（秒），节点之间的时钟误差需小于该值
+SIGNATURE_WINDOW = 300
+# 向其他节点发送请求体时每次读取的大小
+SEND_BLOCK = 256 * 1024
+# 以流的方式转发的请求体无法预先计算哈希，签名中以此代替，靠一次性签名防止重放
+UNSIGNED_BODY = 'stream'
+
+class Catalog:
+    def __init__(self, path, node_timeout):
+        self.path = path
+        self.node_timeout = node_timeout
+        self.local = threading.local()
+        self.secrets = {}
+
+    def reset(self):
+        # fork出的进程不能沿用父进程的连接
+        self.local = threading.local()
+
+    def connect(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA busy_timeout=30000')
+            with conn:
+                conn.executescript('''
+                    CREATE TABLE IF NOT EXISTS nodes (
+                        id TEXT PRIMARY KEY,
+                        url TEXT NOT NULL,
+                        state TEXT NOT NULL DEFAULT 'active',
+                        capacity_bytes INTEGER NOT NULL DEFAULT 0,
+                        used_bytes INTEGER NOT NULL DEFAULT 0,
+                        free_bytes INTEGER NOT NULL DEFAULT 0,
+                        group_count INTEGER NOT NULL DEFAULT 0,
+                        heartbeat REAL NOT NULL,
+                        started_at TEXT
+                    );
+                    CREATE TABLE IF NOT EXISTS groups (
+                        id TEXT PRIMARY KEY,
+                        pickup_code TEXT NOT NULL UNIQUE,
+                        node TEXT NOT NULL,
+                        created_at TEXT
+                    );
+                    CREATE INDEX IF NOT EXISTS idx_groups_node ON groups(node);
+                    CREATE TABLE IF NOT EXISTS uploads (
+                        id TEXT PRIMARY KEY,
+                        node TEXT NOT NULL,
+                        created_at TEXT
+                    );
+                    CREATE TABLE IF NOT EXISTS meta (
+                        key TEXT PRIMARY KEY,
+                        value TEXT
+                    );
+                    CREATE TABLE IF NOT EXISTS nonces (
+                        nonce TEXT PRIMARY KEY,
+                        expires REAL NOT NULL
+                    );
+                ''')
+            self.local.conn = conn
+        return conn
+
+    def secret(self, key):
+        """目录中保存的共享密钥，第一次使用时生成"""
+        value = self.secrets.get(key)
+        if value is None:
+            conn = self.connect()
+            with conn:
+                conn.execute('INSERT OR IGNORE INTO meta VALUES (?, ?)', (key, secrets.token_hex(32)))
+            value = self.secrets[key] = bytes.fromhex(
+                conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()[0])
+        return value
+
+    def use_nonce(self, nonce):
+        """登记已使用的签名随机数，已使用过时返回 False"""
+        conn = self.connect()
+        try:
+            with conn:
+                conn.execute('INSERT INTO nonces VALUES (?, ?)', (nonce, time.time() + 2 * SIGNATURE_WINDOW))
+        except sqlite3.IntegrityError:
+            return False
+        return True
+
+    def prune_nonces(self):
+        # 超出签名有效时间的随机数不会再通过验证，不必保留
+        conn = self.connect()
+        with conn:
+            conn.execute('DELETE FROM nonces WHERE expires < ?', (time.time(),))
+
+    def heartbeat(self, node_id, url, capacity, used, free, group_count, started_at):
+        # 更新节点的地址和容量，保留管理员设置的状态
+        conn = self.connect()
+        with conn:
+            conn.execute('INSERT INTO nodes (id, url, capacity_bytes, used_bytes, free_bytes, group_count, heartbeat, '
+                         'started_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT(id) DO UPDATE SET url = excluded.url, '
+                         'capacity_bytes = excluded.capacity_bytes, used_bytes = excluded.used_bytes, '
+                         'free_bytes = excluded.free_bytes, group_count = excluded.group_count, '
+                         'heartbeat = excluded.heartbeat, started_at = excluded.started_at',
+                         (node_id, url, capacity, used, free, group_count, time.time(), started_at))
+
+    def nodes(self):
+        """所有节点，alive 表示最近一次心跳在超时时间内"""
+        now = time.time()
+        result = []
+        for row in self.connect().execute('SELECT * FROM nodes ORDER BY id'):
+            node = dict(row)
+            node['alive'] = now - node['heartbeat'] <= self.node_timeout
+            result.append(node)
+        return result
+
+    def node(self, node_id):
+        return next((node for node in self.nodes() if node['id'] == node_id), None)
+
+    def set_state(self, node_id, state):
+        conn = self.connect()
+        with conn:
+            return conn.execute('UPDATE nodes SET state = ? WHERE id = ?', (state, node_id)).rowcount > 0
+
+    def remove_node(self, node_id):
+        """删除节点记录，仍有文件组登记在该节点时不删除，返回其文件组数"""
+        conn = self.connect()
+        with conn:
+            remaining = conn.execute('SELECT COUNT(*) FROM groups WHERE node = ?', (node_id,)).fetchone()[0]
+            if not remaining:
+                conn.execute('DELETE FROM nodes WHERE id = ?', (node_id,))
+                conn.execute('DELETE FROM uploads WHERE node = ?', (node_id,))
+        return remaining
+
+    def register_group(self, file_group_id, pickup_code, node_id, created_at=None):
+        """登记文件组所在的节点；取件码已被使用时返回 False"""
+        conn = self.connect()
+        try:
+            with conn:
+                conn.execute('INSERT INTO groups VALUES (?, ?, ?, ?)', (file_group_id, pickup_code, node_id, created_at))
+        except sqlite3.IntegrityError:
+            if self.lookup_code(pickup_code) is None:
+                raise
+            return False
+        return True
+
+    def lookup_group(self, file_group_id):
+        row = self.connect().execute('SELECT node FROM groups WHERE id = ?', (file_group_id,)).fetchone()
+        return row['node'] if row else None
+
+    def lookup_code(self, pickup_code):
+        """(文件组ID, 节点)，取件码不存在时返回 None"""
+        row = self.connect().execute('SELECT id, node FROM groups WHERE pickup_code = ?', (pickup_code,)).fetchone()
+        return (row['id'], row['node']) if row else None
+
+    def move_group(self, file_group_id, source, target):
+        # 文件组在移动期间已被删除或已被其他节点接管时返回 False
+        conn = self.connect()
+        with conn:
+            return conn.execute('UPDATE groups SET node = ? WHERE id = ? AND node = ?',
+                                (target, file_group_id, source)).rowcount > 0
+
+    def remove_group(self, file_group_id, node_id):
+        # 只删除登记在 node_id 的记录：已移到其他节点的文件组不受源节点删除本地副本的影响
+        conn = self.connect()
+        with conn:
+            conn.execute('DELETE FROM groups WHERE id = ? AND node = ?', (file_group_id, node_id))
+
+    def clear_node(self, node_id):
+        conn = self.connect()
+        with conn:
+            conn.execute('DELETE FROM groups WHERE node = ?', (node_id,))
+            conn.execute('DELETE FROM uploads WHERE node = ?', (node_id,))
+
+    def register_upload(self, upload_id, node_id, created_at=None):
+        conn = self.connect()
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO uploads VALUES (?, ?, ?)', (upload_id, node_id, created_at))
+
+    def lookup_upload(self, upload_id):
+        row = self.connect().execute('SELECT node FROM uploads WHERE id = ?', (upload_id,)).fetchone()
+        return row['node'] if row else None
+
+    def remove_upload(self, upload_id):
+        conn = self.connect()
+        with conn:
+            conn.execute('DELETE FROM uploads WHERE id = ?', (upload_id,))
+
+def rendezvous_score(key, node_id, weight):
+    # 加权最高随机权重：哈希映射到 (0, 1) 的均匀分布 u，得分 weight / -ln(u) 最高的节点胜出，
+    # 各节点胜出的概率与权重成正比
+    digest = hashlib.sha256(f'{key}:{node_id}'.encode('utf-8')).digest()
+    u = (int.from_bytes(digest[:8], 'big') + 1) / (2 ** 64 + 2)
+    return weight / -math.log(u)
+
+def rank_nodes(key, nodes, weight='free_bytes'):
+    """按一致性哈希对节点排序，第一个为 key 应放置的节点；权重为0的节点不参与"""
+    candidates = [node for node in nodes if node[weight] > 0]
+    return sorted(candidates, key=lambda node: rendezvous_score(key, node['id'], node[weight]), reverse=True)
+
+def body_digest(body):
+    """签名中的请求体哈希：body 为 bytes 或 None（没有请求体），文件对象等流返回 UNSIGNED_BODY"""
+    if body is None:
+        body = b''
+    if isinstance(body, bytes):
+        return hashlib.sha256(body).hexdigest()
+    return UNSIGNED_BODY
+
+def new_nonce():
+    return secrets.token_hex(16)
+
+def sign(secret, method, target, timestamp, node_id, nonce, client, digest):
+    message = f'{method}\n{target}\n{timestamp}\n{node_id}\n{nonce}\n{client}\n{digest}'.encode('utf-8')
+    return hmac.new(secret, message, hashlib.sha256).hexdigest()
+
+def verify(secret, method, target, timestamp, node_id, nonce, client, digest, signature):
+    """检查签名和时间；随机数是否已使用过由调用方在目录中检查"""
+    try:
+        if abs(time.time() - int(timestamp)) > SIGNATURE_WINDOW:
+            return False
+    except (TypeError, ValueError):
+        return False
+    if not node_id or not nonce or not digest or not signature:
+        return False
+    return hmac.compare_digest(sign(secret, method, target, timestamp, node_id, nonce, client, digest), signature)
+
+def open_request(url, method, target, headers, body=None, timeout=60):
+    """
+    向节点发送请求并返回响应，由调用方读取后关闭
+    body 可以是 bytes 或文件对象；headers 中有 Content-Length 时按该长度发送，否则分块发送
+    """
+    parts = urllib.parse.urlsplit(url)
+    connection_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+    connection = connection_class(parts.netloc, timeout=timeout, blocksize=SEND_BLOCK)
+    try:
+        connection.request(method, parts.path.rstrip('/') + target, body=body, headers=headers)
+        response = connection.getresponse()
+    except BaseException:
+        connection.close()
+        raise
+    # 响应对象持有自己的文件句柄，关闭连接后仍可继续读取
+    connection.close()
+    return response
@@ -0,0 +1,188 @@
+"""
+文件的压缩存储
+
+在安全检查的进程池中运行（不依赖Flask和数据库）：
+- 按扩展名和文件头跳过已经压缩过的格式，再压缩几段样本估算压缩率，压缩率不够时不压缩
+- 文本文件使用 gzip（任何浏览器都可以直接接收压缩数据），其他文件在安装了 zstandard 时使用 zstd
+- 原始内容按固定大小分帧，每帧独立压缩后首尾相连，帧在压缩文件中的位置作为索引单独保存，按位置读取时只解压所需的帧
+- zstd 规定多个帧首尾相连仍是一个完整的数据流，可以原样作为 Content-Encoding 发送；
+  多个 gzip 成员相连时浏览器和 curl 只解压第一个成员，只有一帧的 gzip 文件才能原样发送
+"""
+import os
+import struct
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# 写入压缩结果的临时文件后缀，替换原文件前与其位于同一目录
+TEMP_SUFFIX = '.compressing'
+# 小于该大小的文件不压缩
+MIN_COMPRESS_BYTES = 4096
+# 估算压缩率时每段样本的大小
+SAMPLE_BYTES = 64 * 1024
+# 已经压缩过的格式
+COMPRESSED_EXTENSIONS = {'zip', '7z', 'rar', 'gz', 'tgz', 'bz2', 'xz', 'zst', 'docx', 'xlsx', 'pptx', 'odt', 'ods',
+                         'odp', 'jar', 'apk', 'mp3', 'mp4', 'm4a', 'avi', 'mov', 'mkv', 'webm', 'jpg', 'jpeg',
+                         'png', 'gif', 'webp', 'heic'}
+COMPRESSED_SIGNATURES = (b'PK\x03\x04', b"7z\xbc\xaf'\x1c", b'Rar!', b'\x1f\x8b', b'\x28\xb5\x2f\xfd', b'BZh',
+                         b'\xfd7zXZ\x00', b'\x89PNG', b'\xff\xd8\xff', b'GIF8', b'ID3', b'\xff\xfb', b'RIFF',
+                         b'\x1aE\xdf\xa3')
+TEXT_EXTENSIONS = {'txt', 'csv', 'tsv', 'log', 'json', 'xml', 'html', 'htm', 'md', 'svg', 'rtf', 'ini', 'yaml', 'yml'}
+
+def can_pass_through(encoding, size, frame_size):
+    """压缩存储的文件能否原样作为 Content-Encoding 发送"""
+    return encoding == 'zstd' or size <= frame_size
+
+def is_compressed_format(head):
+    # MP4/MOV 的文件头在第4字节处
+    return head.startswith(COMPRESSED_SIGNATURES) or head[4:8] == b'ftyp'
+
+def is_text(filename, head):
+    ext = filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+    if ext in TEXT_EXTENSIONS:
+        return True
+    if b'\x00' in head:
+        return False
+    try:
+        # 样本末尾可能截断了多字节字符
+        head[:-4].decode('utf-8')
+    except UnicodeDecodeError:
+        return False
+    return True
+
+def choose_encoding(path, filename, options):
+    """按文件类型和样本的压缩率选择压缩格式，不值得压缩时返回 None"""
+    ext = filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+    if ext in COMPRESSED_EXTENSIONS:
+        return None
+    size = os.path.getsize(path)
+    if size < MIN_COMPRESS_BYTES:
+        return None
+    with open(path, 'rb') as f:
+        head = f.read(SAMPLE_BYTES)
+        if is_compressed_format(head):
+            return None
+        samples = [head]
+        # 开头、中间、末尾各取一段，避免只看文件头
+        for position in (size // 2, size - SAMPLE_BYTES):
+            if position > SAMPLE_BYTES:
+                f.seek(position)
+                samples.append(f.read(SAMPLE_BYTES))
+    raw = sum(len(sample) for sample in samples)
+    packed = sum(len(zlib.compress(sample, 1)) for sample in samples)
+    if packed > raw * options['max_ratio']:
+        return None
+    codec = options.get('codec', 'auto')
+    if codec == 'gzip' or zstandard is None:
+        return 'gzip'
+    if codec == 'zstd':
+        return 'zstd'
+    return 'gzip' if is_text(filename, head) else 'zstd'
+
+def compress_frame(encoding, data, level):
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    compressor = zlib.compressobj(min(level, 9), zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+def decompress_frame(encoding, data):
+    if encoding == 'zstd':
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data, 31)
+
+def compress_file(source, target, encoding, frame_size, level):
+    """按帧压缩，返回各帧在压缩文件中的起始位置，最后一项为压缩文件的大小"""
+    offsets = [0]
+    with open(source, 'rb') as src, open(target, 'wb') as dst:
+        for data in iter(lambda: src.read(frame_size), b''):
+            dst.write(compress_frame(encoding, data, level))
+            offsets.append(dst.tell())
+    return offsets
+
+def pack_offsets(offsets):
+    return struct.pack(f'<{len(offsets)}Q', *offsets)
+
+def unpack_offsets(data):
+    return struct.unpack(f'<{len(data) // 8}Q', data)
+
+def compress_stored_file(path, filename, options):
+    """
+    在检查进程池中调用：值得压缩时把结果写入 path + TEMP_SUFFIX，返回 (编码, 压缩后大小, 打包的帧索引)，否则返回 None
+    options 包含 codec、level、max_ratio、frame_size
+    """
+    encoding = choose_encoding(path, filename, options)
+    if encoding is None:
+        return None
+    temp_path = path + TEMP_SUFFIX
+    offsets = compress_file(path, temp_path, encoding, options['frame_size'], options['level'])
+    # 样本估算偏乐观时，整体压缩率不够的仍然不压缩
+    if offsets[-1] > os.path.getsize(path) * options['max_ratio']:
+        os.remove(temp_path)
+        return None
+    return encoding, offsets[-1], pack_offsets(offsets)
+
+class FrameReader:
+    """压缩存储的文件按原始内容读取，支持 seek；关闭时关闭底层文件"""
+    def __init__(self, raw, encoding, size, frame_size, offsets):
+        self.raw = raw
+        self.encoding = encoding
+        self.size = size
+        self.frame_size = frame_size
+        self.offsets = offsets
+        self.position = 0
+        self.frame = 0  # 下一个要解压的帧
+        self.buffer = b''
+        self.buffer_pos = 0
+
+    def read_frame(self, index):
+        self.raw.seek(self.offsets[index])
+        return decompress_frame(self.encoding, self.raw.read(self.offsets[index + 1] - self.offsets[index]))
+
+    def seek(self, position, whence=0):
+        if whence == 1:
+            position += self.position
+        elif whence == 2:
+            position += self.size
+        if position == self.position:
+            return position
+        index = position // self.frame_size
+        self.buffer = self.read_frame(index) if index < len(self.offsets) - 1 else b''
+        self.buffer_pos = position - index * self.frame_size
+        self.frame = index + 1
+        self.position = position
+        return position
+
+    def tell(self):
+        return self.position
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size - self.position
+        chunks = []
+        while size > 0:
+            if self.buffer_pos >= len(self.buffer):
+                if self.frame >= len(self.offsets) - 1:
+                    break
+                self.buffer = self.read_frame(self.frame)
+                self.buffer_pos = 0
+                self.frame += 1
+                continue
+            chunk = self.buffer[self.buffer_pos:self.buffer_pos + size]
+            self.buffer_pos += len(chunk)
+            self.position += len(chunk)
+            size -= len(chunk)
+            chunks.append(chunk)
+        return b''.join(chunks)
+
+    def close(self):
+        self.buffer = b''
+        self.raw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,88 @@
+"""
+文件组事件总线（进程内）
+
+下载、安全检查、过期和删除发生时发布事件，管理页面的实时更新连接订阅所关注的文件组：
+- 事件在本进程内按顺序编号，每个文件组保留最近的若干条，断线重连时按编号补发
+- 编号带有进程标识；重连到其他进程（多进程部署）或补发记录已不完整时，由调用方改为发送完整数据
+- 订阅者登记一个回调，有新事件时在发布者的线程中调用，回调只应做唤醒之类的轻量操作
+"""
+import collections
+import json
+import threading
+import uuid
+
+class EventBus:
+    def __init__(self, history=50, max_groups=4096):
+        self.history = history
+        self.max_groups = max_groups
+        self.lock = threading.Lock()
+        self.token = uuid.uuid4().hex[:8]
+        self.seq = 0
+        # 文件组ID -> [下限, deque[(编号, 类型, 数据)]]，编号不大于下限的事件可能已被丢弃
+        self.groups = collections.OrderedDict()
+        # 被整体淘汰的文件组中最大的事件编号
+        self.evicted = 0
+        self.subscribers = {}  # 文件组ID -> set(回调)
+
+    def reset(self):
+        # fork出的进程使用新的进程标识，不能沿用父进程的编号
+        with self.lock:
+            self.token = uuid.uuid4().hex[:8]
+            self.seq = 0
+            self.groups.clear()
+            self.evicted = 0
+            self.subscribers = {}
+
+    def publish(self, key, event, data=None):
+        with self.lock:
+            self.seq += 1
+            entry = self.groups.get(key)
+            if entry is None:
+                # 文件组的事件可能曾被淘汰，下限取淘汰过的最大编号
+                entry = self.groups[key] = [self.evicted, collections.deque()]
+                if len(self.groups) > self.max_groups:
+                    _, (_, old_events) = self.groups.popitem(last=False)
+                    if old_events:
+                        self.evicted = max(self.evicted, old_events[-1][0])
+            else:
+                self.groups.move_to_end(key)
+            entry[1].append((self.seq, event, data))
+            if len(entry[1]) > self.history:
+                entry[0] = entry[1].popleft()[0]
+            callbacks = list(self.subscribers.get(key, ()))
+        for callback in callbacks:
+            callback()
+
+    def subscribe(self, key, callback):
+        with self.lock:
+            self.subscribers.setdefault(key, set()).add(callback)
+
+    def unsubscribe(self, key, callback):
+        with self.lock:
+            callbacks = self.subscribers.get(key)
+            if callbacks is not None:
+                callbacks.discard(callback)
+                if not callbacks:
+                    del self.subscribers[key]
+
+    def current(self):
+        with self.lock:
+            return self.seq
+
+    def events_after(self, key, seq):
+        """编号大于 seq 的事件列表；可能有事件已被丢弃时返回 None"""
+        with self.lock:
+            entry = self.groups.get(key)
+            floor = entry[0] if entry is not None else self.evicted
+            if seq < floor:
+                return None
+            return [item for item in entry[1] if item[0] > seq] if entry is not None else []
+
+def format_event(event, data, event_id=None):
+    # Server-Sent Events 消息格式，数据为一行JSON
+    lines = []
+    if event_id is not None:
+        lines.append(f'id: {event_id}')
+    lines.append(f'event: {event}')
+    lines.append(f'data: {json.dumps(data, ensure_ascii=False)}')
+    return '\n'.join(lines) + '\n\n'
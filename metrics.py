@@ -0,0 +1,266 @@
+"""
+运行指标与慢请求采样
+
+- 计数器、仪表、直方图，输出为Prometheus文本格式（不依赖 prometheus_client）
+- 多进程部署时各进程定期把快照写入同一目录，读取时合并：计数器和直方图累加所有进程
+  （包括已退出的），仪表只累加仍在运行的进程
+- 采样分析器：按固定间隔抓取请求线程的调用栈，慢请求结束时输出为折叠栈格式
+  （每行 "调用栈 次数"，可直接用于 flamegraph.pl 或 speedscope）
+"""
+import collections
+import functools
+import json
+import math
+import os
+import sys
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def reset(self):
+        with self.lock:
+            self.values = {}
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                # 各桶的计数（不累积）、总和、总数
+                entry = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][index] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def time(self, **labels):
+        """装饰器：统计函数的执行时间"""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.observe(time.perf_counter() - start, **labels)
+            return wrapper
+        return decorator
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, labelnames=()):
+        return self.add(Counter(name, help_text, labelnames))
+
+    def gauge(self, name, help_text, labelnames=()):
+        return self.add(Gauge(name, help_text, labelnames))
+
+    def histogram(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.add(Histogram(name, help_text, labelnames, buckets))
+
+    def reset(self):
+        for metric in self.metrics:
+            metric.reset()
+
+    def snapshot(self):
+        # 可序列化为JSON的当前值：{指标名: [[标签值...], 值], ...}
+        result = {}
+        for metric in self.metrics:
+            with metric.lock:
+                result[metric.name] = [[list(key), [list(value[0]), value[1], value[2]] if metric.kind == 'histogram'
+                                        else value] for key, value in metric.values.items()]
+        return result
+
+    def merge(self, snapshots):
+        """合并多个进程的快照，snapshots 为 (快照, 进程是否在运行) 列表"""
+        merged = {metric.name: {} for metric in self.metrics}
+        for metric in self.metrics:
+            values = merged[metric.name]
+            for snapshot, alive in snapshots:
+                if metric.kind == 'gauge' and not alive:
+                    continue
+                for key, value in snapshot.get(metric.name, []):
+                    key = tuple(key)
+                    if metric.kind == 'histogram':
+                        if len(value[0]) != len(metric.buckets):
+                            continue  # 桶定义已变化的旧快照
+                        entry = values.setdefault(key, [[0] * len(metric.buckets), 0.0, 0])
+                        entry[0] = [a + b for a, b in zip(entry[0], value[0])]
+                        entry[1] += value[1]
+                        entry[2] += value[2]
+                    else:
+                        values[key] = values.get(key, 0) + value
+        return merged
+
+    def render(self, merged, extra=()):
+        """输出Prometheus文本格式；extra 为 (名称, 类型, 说明, [(标签字典, 值)]) 形式的附加指标"""
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for key, value in sorted(merged.get(metric.name, {}).items()):
+                labels = dict(zip(metric.labelnames, key))
+                if metric.kind != 'histogram':
+                    lines.append(f'{metric.name}{format_labels(labels)} {format_value(value)}')
+                    continue
+                counts, total, count = value
+                cumulative = 0
+                for bound, bucket_count in zip(metric.buckets, counts):
+                    cumulative += bucket_count
+                    lines.append(f'{metric.name}_bucket{format_labels(dict(labels, le=format_value(bound)))} {cumulative}')
+                lines.append(f'{metric.name}_bucket{format_labels(dict(labels, le="+Inf"))} {count}')
+                lines.append(f'{metric.name}_sum{format_labels(labels)} {format_value(total)}')
+                lines.append(f'{metric.name}_count{format_labels(labels)} {count}')
+        for name, kind, help_text, samples in extra:
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in samples:
+                lines.append(f'{name}{format_labels(labels)} {format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"') for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+def format_value(value):
+    if isinstance(value, float):
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        return repr(value)
+    return str(value)
+
+class SnapshotStore:
+    """多进程共享的快照目录，每个进程一个文件"""
+    def __init__(self, folder):
+        self.folder = folder
+
+    def write(self, snapshot, pid=None):
+        os.makedirs(self.folder, exist_ok=True)
+        path = os.path.join(self.folder, f'{pid or os.getpid()}.json')
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(snapshot, f)
+        os.replace(temp_path, path)
+
+    def read_others(self, alive):
+        """读取其他进程的快照，返回 (快照, 进程是否在运行) 列表"""
+        result = []
+        if not os.path.isdir(self.folder):
+            return result
+        for name in os.listdir(self.folder):
+            pid, ext = os.path.splitext(name)
+            if ext != '.json' or not pid.isdigit() or int(pid) == os.getpid():
+                continue
+            try:
+                with open(os.path.join(self.folder, name), encoding='utf-8') as f:
+                    result.append((json.load(f), alive(int(pid))))
+            except (OSError, ValueError):
+                continue  # 正在被替换或已被清理
+        return result
+
+    def clear(self):
+        if os.path.isdir(self.folder):
+            for name in os.listdir(self.folder):
+                try:
+                    os.remove(os.path.join(self.folder, name))
+                except OSError:
+                    pass
+
+class SamplingProfiler:
+    """按固定间隔采样已登记线程的调用栈，被采样的请求本身不增加任何开销"""
+    def __init__(self, interval):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.active = {}  # 线程ID -> Counter(调用栈)
+        self.thread = None
+
+    def begin(self):
+        with self.lock:
+            self.active[threading.get_ident()] = collections.Counter()
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='request-profiler', daemon=True)
+                self.thread.start()
+
+    def end(self):
+        with self.lock:
+            return self.active.pop(threading.get_ident(), None)
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                if not self.active:
+                    continue
+                frames = sys._current_frames()
+                for ident, stacks in self.active.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        stacks[collapse_stack(frame)] += 1
+
+def collapse_stack(frame):
+    # 从最外层到最内层，以分号分隔
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+def write_profile(path, stacks):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        for stack, count in stacks.most_common():
+            f.write(f'{stack} {count}\n')
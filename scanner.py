@@ -0,0 +1,205 @@
+"""
+上传文件的安全检查
+
+在独立的进程池中运行（不依赖Flask和数据库），每个文件调用一次 scan_file()。
+检查器可以通过配置组合：
+- local：文件名、文件头（魔数）、压缩包内容检查，不需要任何外部程序
+- command：调用外部扫描程序（例如 clamscan），退出码非0视为有风险
+"""
+import io
+import subprocess
+import time
+import zipfile
+
+HEADER_SNIFF_BYTES = 4096
+# 可执行文件的文件头（ELF、Mach-O）；Windows PE 和脚本解释器行只有两个字节，普通文本也可能以此开头，单独检查
+EXECUTABLE_SIGNATURES = (b'\x7fELF', b'\xfe\xed\xfa\xce', b'\xfe\xed\xfa\xcf',
+                         b'\xce\xfa\xed\xfe', b'\xcf\xfa\xed\xfe')
+# 纯文本类型：以 #! 开头的脚本按文本分享是正常用法
+TEXT_EXTENSIONS = {'txt', 'md', 'csv', 'tsv', 'log', 'json', 'xml', 'ini', 'yaml', 'yml'}
+ZIP_SIGNATURES = (b'PK\x03\x04', b'PK\x05\x06')
+# 扩展名对应的文件头，内容与扩展名不符的文件视为伪装
+EXTENSION_SIGNATURES = {
+    'png': (b'\x89PNG\r\n\x1a\n',),
+    'jpg': (b'\xff\xd8\xff',),
+    'jpeg': (b'\xff\xd8\xff',),
+    'gif': (b'GIF87a', b'GIF89a'),
+    'zip': ZIP_SIGNATURES,
+    'docx': ZIP_SIGNATURES,
+    'xlsx': ZIP_SIGNATURES,
+    'pptx': ZIP_SIGNATURES,
+    'rar': (b'Rar!\x1a\x07',),
+    '7z': (b"7z\xbc\xaf'\x1c",),
+    'doc': (b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1',),
+    'xls': (b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1',),
+    'ppt': (b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1',),
+}
+
+DEFAULT_ARCHIVE_LIMITS = {
+    'max_entries': 10000,            # 所有层级合计的条目数
+    'max_depth': 3,                  # 压缩包嵌套层数
+    'max_ratio': 100,                # 单个条目的压缩比
+    'max_uncompressed_mb': 4096,     # 解压后的总大小（按条目声明的大小计算）
+    'max_nested_mb': 64,             # 嵌套压缩包需要读入内存检查，超过该大小直接拒绝
+    'max_seconds': 60,               # 单个文件的检查时间
+}
+
+class ScanRejected(Exception):
+    """检查未通过，参数为原因"""
+
+def file_extension(filename):
+    return filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
+
+def check_filename_safety(filename, forbidden_extensions):
+    # 检查文件扩展名，以及隐藏的多个扩展名（如 file.php.jpg）
+    if file_extension(filename) in forbidden_extensions:
+        return False
+    name_parts = filename.split('.')
+    if len(name_parts) > 2:
+        suspicious_exts = [part.lower() for part in name_parts[1:-1]]
+        if any(ext in forbidden_extensions for ext in suspicious_exts):
+            return False
+    return True
+
+def is_pe_executable(head):
+    # MZ 头中 0x3C 处的偏移指向 PE 签名时才是 Windows 可执行文件
+    if len(head) < 0x40 or not head.startswith(b'MZ'):
+        return False
+    offset = int.from_bytes(head[0x3c:0x40], 'little')
+    return head[offset:offset + 4] == b'PE\0\0'
+
+def check_file_header(filename, head):
+    """检查文件开头的字节：图片中嵌入的PHP代码、伪装成其他类型的可执行文件"""
+    ext = file_extension(filename)
+    if ext in ['jpg', 'jpeg', 'png', 'gif'] and (b'<?php' in head or b'<?=' in head):
+        return False
+    if head.startswith(EXECUTABLE_SIGNATURES) or is_pe_executable(head):
+        return False
+    if head.startswith(b'#!') and ext not in TEXT_EXTENSIONS:
+        return False
+    return True
+
+def check_extension_matches(filename, head):
+    # 已知类型的文件头必须与扩展名一致（空文件不检查）
+    ext = file_extension(filename)
+    if not head:
+        return True
+    if ext == 'pdf':
+        # PDF允许标记前有少量其他字节
+        return b'%PDF-' in head[:1024]
+    signatures = EXTENSION_SIGNATURES.get(ext)
+    return signatures is None or head.startswith(signatures)
+
+class LocalScanner:
+    """内置检查：文件名、文件头、压缩包（条目数、嵌套层数、压缩比、总大小、时间预算）"""
+    def __init__(self, options):
+        self.forbidden_extensions = set(options.get('forbidden_extensions', []))
+        self.limits = dict(DEFAULT_ARCHIVE_LIMITS, **options.get('archive_limits', {}))
+
+    def scan(self, path, filename):
+        self.deadline = time.monotonic() + self.limits['max_seconds']
+        if not check_filename_safety(filename, self.forbidden_extensions):
+            raise ScanRejected('不允许的文件类型')
+        with open(path, 'rb') as f:
+            head = f.read(HEADER_SNIFF_BYTES)
+            if not check_file_header(filename, head):
+                raise ScanRejected('文件内容可能包含可执行代码')
+            if not check_extension_matches(filename, head):
+                raise ScanRejected('文件内容与扩展名不符')
+            # 按内容而不是扩展名判断是否为压缩包，改了扩展名的压缩包同样检查
+            if head.startswith(ZIP_SIGNATURES):
+                f.seek(0)
+                self.entries = 0
+                self.uncompressed = 0
+                self.scan_zip(f, depth=1)
+
+    def check_time(self):
+        if time.monotonic() > self.deadline:
+            raise ScanRejected('压缩包检查超时')
+
+    def scan_zip(self, file, depth):
+        if depth > self.limits['max_depth']:
+            raise ScanRejected('压缩包嵌套层数过多')
+        try:
+            archive = zipfile.ZipFile(file)
+        except (zipfile.BadZipFile, OSError, ValueError):
+            raise ScanRejected('压缩包已损坏')
+        with archive:
+            for info in archive.infolist():
+                self.check_time()
+                self.entries += 1
+                if self.entries > self.limits['max_entries']:
+                    raise ScanRejected('压缩包文件数量过多')
+                if info.is_dir():
+                    continue
+                if not check_filename_safety(info.filename, self.forbidden_extensions):
+                    raise ScanRejected(f'压缩包中包含不允许的文件 {info.filename}')
+                self.uncompressed += info.file_size
+                if self.uncompressed > self.limits['max_uncompressed_mb'] * 1024 * 1024:
+                    raise ScanRejected('压缩包解压后过大')
+                if info.file_size > 1024 * 1024 and info.file_size > info.compress_size * self.limits['max_ratio']:
+                    raise ScanRejected('压缩包压缩比异常（疑似压缩炸弹）')
+                if info.flag_bits & 0x1:
+                    continue  # 加密的条目无法检查内容
+                self.scan_entry(archive, info, depth)
+
+    def scan_entry(self, archive, info, depth):
+        try:
+            with archive.open(info) as entry:
+                head = entry.read(HEADER_SNIFF_BYTES)
+                if not check_file_header(info.filename, head):
+                    raise ScanRejected(f'压缩包中的 {info.filename} 可能包含可执行代码')
+                if not head.startswith(ZIP_SIGNATURES):
+                    return
+                # 嵌套的压缩包：读入内存后递归检查，实际解压的字节数同样受限，不信任声明的大小
+                limit = self.limits['max_nested_mb'] * 1024 * 1024
+                data = bytearray(head)
+                while len(data) <= limit:
+                    self.check_time()
+                    block = entry.read(1024 * 1024)
+                    if not block:
+                        break
+                    data += block
+                if len(data) > limit:
+                    raise ScanRejected('嵌套的压缩包过大')
+        except (zipfile.BadZipFile, OSError, ValueError, NotImplementedError, EOFError):
+            raise ScanRejected(f'压缩包中的 {info.filename} 已损坏')
+        self.scan_zip(io.BytesIO(bytes(data)), depth + 1)
+
+class CommandScanner:
+    """调用外部扫描程序，命令中的 {path} 替换为文件路径，退出码非0视为有风险"""
+    def __init__(self, options):
+        self.command = options.get('scan_command') or ''
+        self.timeout = dict(DEFAULT_ARCHIVE_LIMITS, **options.get('archive_limits', {}))['max_seconds']
+
+    def scan(self, path, filename):
+        if not self.command:
+            return
+        args = [part.replace('{path}', path) for part in self.command.split()]
+        try:
+            result = subprocess.run(args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=self.timeout)
+        except subprocess.TimeoutExpired:
+            raise ScanRejected('外部扫描程序超时')
+        except OSError as e:
+            raise ScanRejected(f'无法运行外部扫描程序: {e}')
+        if result.returncode != 0:
+            raise ScanRejected('外部扫描程序报告风险')
+
+SCANNERS = {
+    'local': LocalScanner,
+    'command': CommandScanner,
+}
+
+def scan_file(path, filename, options):
+    """
+    依次运行配置的检查器，返回 (是否通过, 原因)
+    options 包含 scanners、forbidden_extensions、archive_limits、scan_command
+    """
+    try:
+        for name in options.get('scanners', ['local']):
+            SCANNERS[name](options).scan(path, filename)
+    except ScanRejected as e:
+        return False, str(e)
+    except OSError as e:
+        return False, f'无法读取文件: {e}'
+    return True, None
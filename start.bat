@@ -18,12 +18,19 @@ if /i "%~1"=="--clean-on-exit" (
   shift
   goto parse_args
 )
+if /i "%~1"=="--serve" (
+  set SERVE_ARG=--serve
+  echo [选项] 以生产模式运行
+  shift
+  goto parse_args
+)
 if /i "%~1"=="-h" (
   echo 用法: start.bat [选项]
   echo.
   echo 选项:
   echo   --clean           启动时清理所有文件和数据
   echo   --clean-on-exit   退出时清理所有文件和数据
+  echo   --serve           以生产模式运行（不使用调试服务器）
   echo   -h, --help        显示此帮助信息
   exit /b 0
 )
@@ -38,6 +45,6 @@ if not exist config.json (
 )
 
 echo 正在启动文件共享平台...
-python app.py %CLEAN_ARG% %CLEAN_EXIT_ARG%
+python app.py %CLEAN_ARG% %CLEAN_EXIT_ARG% %SERVE_ARG%
 
 pause
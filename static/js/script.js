@@ -31,6 +31,7 @@ document.addEventListener('DOMContentLoaded', function() {
         const pickupCodeElement = document.getElementById('pickup-code');
         const managementUrlElement = document.getElementById('management-url');
         const copyButton = document.getElementById('copy-code');
+        const scanStatusElement = document.getElementById('scan-status');
         const resetButton = document.getElementById('reset-upload');
         const expiryValueInput = document.getElementById('expiry-value');
         const expiryUnitSelect = document.getElementById('expiry-unit');
@@ -111,6 +112,127 @@ document.addEventListener('DOMContentLoaded', function() {
             }
         }
         
+        // 分块上传设置
+        const CHUNK_CONCURRENCY = 4;
+        const CHUNK_RETRIES = 3;
+        
+        // 用文件名、大小和修改时间标识一次上传，刷新页面后重新选择相同文件即可续传
+        function uploadSessionKey(files) {
+            return 'upload-session:' + files.map(file => `${file.name}:${file.size}:${file.lastModified}`).join('|');
+        }
+        
+        // 解析服务器返回的错误信息
+        function readError(response) {
+            return response.json()
+                .then(data => data.error || `HTTP error! Status: ${response.status}`)
+                .catch(() => response.status === 413 ? '文件太大，超出服务器限制' : `HTTP error! Status: ${response.status}`);
+        }
+        
+        function requestJson(url, options) {
+            return fetch(url, options).then(response => {
+                if (!response.ok) {
+                    return readError(response).then(message => { throw new Error(message); });
+                }
+                return response.json();
+            });
+        }
+        
+        // 获取可续传的会话，没有则新建
+        function openUploadSession(sessionKey) {
+            const savedId = localStorage.getItem(sessionKey);
+            const resume = savedId
+                ? fetch(`/api/uploads/${savedId}`).then(response => response.ok ? response.json() : null).catch(() => null)
+                : Promise.resolve(null);
+            
+            return resume.then(session => {
+                if (session && session.success) {
+                    return session;
+                }
+                localStorage.removeItem(sessionKey);
+                return requestJson('/api/uploads', {
+                    method: 'POST',
+                    headers: {'Content-Type': 'application/json'},
+                    body: JSON.stringify({
+                        files: selectedFiles.map(file => ({name: file.name, size: file.size})),
+                        expiry_value: document.getElementById('expiry-value').value,
+                        expiry_unit: document.getElementById('expiry-unit').value,
+                        max_downloads: document.getElementById('max-downloads').value
+                    })
+                }).then(session => {
+                    localStorage.setItem(sessionKey, session.upload_id);
+                    return session;
+                });
+            });
+        }
+        
+        // 上传单个分块，失败时重试
+        function uploadChunk(session, task, attempt = 1) {
+            const file = selectedFiles[task.fileIndex];
+            const start = task.chunkIndex * session.chunk_size;
+            const blob = file.slice(start, Math.min(start + session.chunk_size, file.size));
+            
+            return fetch(`/api/uploads/${session.upload_id}/${task.fileIndex}/${task.chunkIndex}`, {
+                method: 'PUT',
+                body: blob
+            }).then(response => {
+                if (!response.ok) {
+                    return readError(response).then(message => { throw new Error(message); });
+                }
+                return blob.size;
+            }).catch(error => {
+                if (attempt >= CHUNK_RETRIES) {
+                    throw error;
+                }
+                return new Promise(resolve => setTimeout(resolve, 1000 * attempt))
+                    .then(() => uploadChunk(session, task, attempt + 1));
+            });
+        }
+        
+        // 并行上传所有缺少的分块
+        function uploadMissingChunks(session) {
+            const totalBytes = selectedFiles.reduce((sum, file) => sum + file.size, 0);
+            let uploadedBytes = 0;
+            const tasks = [];
+            
+            session.files.forEach(fileState => {
+                const received = new Set(fileState.received);
+                // 服务器已有相同内容时只要求上传抽样分块
+                const required = fileState.required ? new Set(fileState.required) : null;
+                for (let chunkIndex = 0; chunkIndex < fileState.chunks; chunkIndex++) {
+                    if (received.has(chunkIndex) || (required && !required.has(chunkIndex))) {
+                        uploadedBytes += Math.min(session.chunk_size, fileState.size - chunkIndex * session.chunk_size);
+                    } else {
+                        tasks.push({fileIndex: fileState.index, chunkIndex: chunkIndex});
+                    }
+                }
+            });
+            
+            function updateProgress() {
+                const percentComplete = totalBytes > 0 ? Math.round((uploadedBytes / totalBytes) * 100) : 100;
+                progressFill.style.width = percentComplete + '%';
+                progressText.textContent = '上传中 (' + percentComplete + '%)';
+            }
+            updateProgress();
+            
+            function worker() {
+                const task = tasks.shift();
+                if (!task) {
+                    return Promise.resolve();
+                }
+                return uploadChunk(session, task).then(size => {
+                    uploadedBytes += size;
+                    updateProgress();
+                    return worker();
+                });
+            }
+            
+            const workers = [];
+            for (let i = 0; i < CHUNK_CONCURRENCY; i++) {
+                workers.push(worker());
+            }
+            return Promise.all(workers);
+        }
+        
         // 表单提交事件
         uploadForm.addEventListener('submit', function(e) {
             e.preventDefault();
@@ -120,82 +242,85 @@ document.addEventListener('DOMContentLoaded', function() {
                 return;
             }
             
-            const formData = new FormData();
-            
-            // 添加文件
-            selectedFiles.forEach(file => {
-                formData.append('files[]', file);
-            });
-              // 添加其他表单数据
-            formData.append('expiry_value', document.getElementById('expiry-value').value);
-            formData.append('expiry_unit', document.getElementById('expiry-unit').value);
-            formData.append('max_downloads', document.getElementById('max-downloads').value);
-            
             // 显示上传进度条
             uploadForm.classList.add('hide');
             uploadProgress.classList.remove('hide');
             
-            // 发送请求
-            const xhr = new XMLHttpRequest();
+            const sessionKey = uploadSessionKey(selectedFiles);
+            let uploadId = null;
             
-            xhr.upload.addEventListener('progress', function(e) {
-                if (e.lengthComputable) {
-                    const percentComplete = Math.round((e.loaded / e.total) * 100);
-                    progressFill.style.width = percentComplete + '%';
-                    progressText.textContent = '上传中 (' + percentComplete + '%)';
-                }
-            });
-              xhr.addEventListener('load', function() {
-                uploadProgress.classList.add('hide');
-                  if (xhr.status === 200) {
-                    try {
-                        const response = JSON.parse(xhr.responseText);
-                        
-                        // 显示上传结果
-                        pickupCodeElement.textContent = response.pickup_code;
-                        
-                        // 使用相对URL而非绝对URL
-                        const managementUrl = `/manage/${response.file_group_id}`;
-                        managementUrlElement.textContent = '管理链接';
-                        managementUrlElement.href = managementUrl;
-                        uploadResult.classList.remove('hide');
-                    } catch (e) {
-                        alert('解析响应错误: ' + e.message);
-                        alert('上传成功，但返回数据解析失败。请刷新页面重试。');
-                        uploadForm.classList.remove('hide');
+            openUploadSession(sessionKey)
+                .then(session => {
+                    uploadId = session.upload_id;
+                    return uploadMissingChunks(session);
+                })
+                .then(() => {
+                    progressText.textContent = '正在处理文件...';
+                    return fetch(`/api/uploads/${uploadId}/complete`, {method: 'POST'});
+                })
+                .then(response => {
+                    if (!response.ok) {
+                        // 文件被拒绝或会话已失效，下次需要重新上传
+                        localStorage.removeItem(sessionKey);
+                        return readError(response).then(message => { throw new Error(message); });
                     }
-                } else {
-                    let errorMessage = '上传失败';
+                    return response.json();
+                })
+                .then(response => {
+                    localStorage.removeItem(sessionKey);
+                    uploadProgress.classList.add('hide');
                     
-                    try {
-                        const response = JSON.parse(xhr.responseText);
-                        if (response.error) {
-                            errorMessage = response.error;
-                        }                    } catch (e) {
-                        // 如果服务器返回HTML，可能是由于服务器错误或413文件过大
-                        if (xhr.status === 413) {
-                            errorMessage = '文件太大，超出服务器限制';
-                        } else if (xhr.responseText.includes('html')) {
-                            errorMessage = '服务器错误，请联系管理员';
-                        } else {
-                            errorMessage = '解析响应错误: ' + e.message;
-                        }
-                    }
+                    // 显示上传结果
+                    pickupCodeElement.textContent = response.pickup_code;
                     
-                    alert(errorMessage);
+                    // 使用相对URL而非绝对URL
+                    const managementUrl = `/manage/${response.file_group_id}`;
+                    managementUrlElement.textContent = '管理链接';
+                    managementUrlElement.href = managementUrl;
+                    uploadResult.classList.remove('hide');
+                    if (response.status === 'scanning') {
+                        watchScanStatus(response.file_group_id);
+                    }
+                })
+                .catch(error => {
+                    uploadProgress.classList.add('hide');
                     uploadForm.classList.remove('hide');
+                    alert('上传失败: ' + error.message + (uploadId ? '\n重新选择相同文件后再次上传可继续未完成的部分' : ''));
+                });
+        });
+        
+        // 安全检查在后台进行，由服务器推送检查结果
+        let scanEvents = null;
+        function watchScanStatus(fileGroupId) {
+            scanStatusElement.textContent = '正在进行安全检查，通过后即可取件...';
+            scanStatusElement.classList.remove('hide', 'error');
+            if (scanEvents) scanEvents.close();
+            const source = scanEvents = new EventSource(`/api/file-group/${fileGroupId}/events`);
+            source.addEventListener('snapshot', event => {
+                const fileGroup = JSON.parse(event.data).file_group;
+                if (fileGroup.status === 'scanning') return;
+                source.close();
+                if (fileGroup.status === 'ready') {
+                    scanStatusElement.textContent = '安全检查已通过，可以取件';
+                } else {
+                    scanStatusElement.textContent = '文件未通过安全检查，已被删除：' + (fileGroup.scan_error || '');
+                    scanStatusElement.classList.add('error');
                 }
             });
-            
-            xhr.addEventListener('error', function() {
-                uploadProgress.classList.add('hide');
-                uploadForm.classList.remove('hide');
-                alert('上传时发生网络错误');
+            source.addEventListener('removed', () => {
+                source.close();
+                scanStatusElement.textContent = '文件组已失效';
+                scanStatusElement.classList.add('error');
             });
-            
-            xhr.open('POST', '/upload', true);
-            xhr.send(formData);
-        });
+            source.addEventListener('error', () => {
+                // 服务器拒绝了连接时稍后重新连接，网络中断由浏览器自动重连
+                if (source.readyState === EventSource.CLOSED && scanEvents === source) {
+                    setTimeout(() => {
+                        if (scanEvents === source) watchScanStatus(fileGroupId);
+                    }, 30000);
+                }
+            });
+        }
         
         // 复制取件码
         if (copyButton) {
@@ -215,6 +340,10 @@ document.addEventListener('DOMContentLoaded', function() {
         // 重置上传表单
         if (resetButton) {
             resetButton.addEventListener('click', function() {
+                if (scanEvents) {
+                    scanEvents.close();
+                    scanEvents = null;
+                }
                 uploadResult.classList.add('hide');
                 uploadForm.classList.remove('hide');
                 fileInput.value = '';
@@ -261,7 +390,10 @@ document.addEventListener('DOMContentLoaded', function() {
                 })
                 .then(response => {
                     if (!response.ok) {
-                        throw new Error(`HTTP error! Status: ${response.status}`);
+                        // 显示服务器给出的原因（如文件正在进行安全检查）
+                        return response.json().catch(() => ({})).then(data => {
+                            throw new Error(data.error || `HTTP error! Status: ${response.status}`);
+                        });
                     }
                     return response.json();
                 })
@@ -377,31 +509,29 @@ document.addEventListener('DOMContentLoaded', function() {
                     return;
                 }
                 
-                // 依次下载所有文件
-                let index = 0;
-                downloadProgress.classList.remove('hide');
-                
-                function downloadNext() {
-                    if (index >= currentFiles.length) {
-                        // 全部下载完成
-                        downloadProgress.classList.add('hide');
-                        return;
-                    }
-                    
-                    const file = currentFiles[index];
-                    const progressPercent = Math.round((index / currentFiles.length) * 100);
-                    downloadProgress.querySelector('.progress-fill').style.width = progressPercent + '%';
-                    downloadProgress.querySelector('.progress-text').textContent = 
-                        '下载中 (' + (index + 1) + '/' + currentFiles.length + ')';
-                    
-                    startDownload(file.name);
-                    index++;
-                    
-                    // 延迟下载下一个文件，增加间隔到5秒，避免浏览器限制
-                    setTimeout(downloadNext, 5000);
+                if (!fileGroupId || !downloadToken) {
+                    alert('下载信息无效，请重新获取');
+                    return;
+                }
+                if (downloadStatus['__all__']) {
+                    alert('打包下载正在进行中，请等待下载完成');
+                    return;
                 }
+                downloadStatus['__all__'] = true;
                 
-                downloadNext();
+                // 服务器将整个文件组打包成一个ZIP流式返回，只计一次下载
+                const downloadLink = document.createElement('a');
+                downloadLink.href = `/download/${fileGroupId}.zip?token=${downloadToken}`;
+                downloadLink.style.display = 'none';
+                document.body.appendChild(downloadLink);
+                downloadLink.click();
+                
+                setTimeout(() => {
+                    document.body.removeChild(downloadLink);
+                    setTimeout(() => {
+                        downloadStatus['__all__'] = false;
+                    }, 180000);
+                }, 100);
             });
         }
     }
@@ -412,14 +542,17 @@ document.addEventListener('DOMContentLoaded', function() {
         const confirmDeleteButton = document.getElementById('confirm-delete');
         const cancelDeleteButton = document.getElementById('cancel-delete');
         const refreshButton = document.getElementById('refresh-page');
-        const autoRefreshCheckbox = document.getElementById('auto-refresh');
+        const liveStatus = document.getElementById('live-status');
         const lastUpdateTime = document.getElementById('last-update-time');
         const refreshSpinner = document.getElementById('refresh-spinner');
         
         if (!deleteButton) return;
         
         let fileGroupId = deleteButton.dataset.id;
-        let autoRefreshInterval = null;
+        let currentGroup = null;
+        let historyLimit = 0;
+        let eventSource = null;
+        let lastEventId = null;
         
         // 更新页面上次刷新时间
         function updateLastRefreshTime() {
@@ -437,7 +570,8 @@ document.addEventListener('DOMContentLoaded', function() {
                 .then(response => response.json())
                 .then(data => {
                     if (data.success && data.file_group) {
-                        updatePageWithNewData(data.file_group);
+                        currentGroup = data.file_group;
+                        updatePageWithNewData(currentGroup);
                         updateLastRefreshTime();
                     } else {
                         alert('获取数据失败: ' + (data.error || '未知错误'));
@@ -462,6 +596,18 @@ document.addEventListener('DOMContentLoaded', function() {
                 downloadCountElement.textContent = fileGroup.download_count;
             }
             
+            // 更新安全检查状态
+            const scanStatusValue = document.getElementById('scan-status-value');
+            if (scanStatusValue) {
+                if (fileGroup.status === 'scanning') {
+                    scanStatusValue.textContent = '检查中';
+                } else if (fileGroup.status === 'rejected') {
+                    scanStatusValue.textContent = '未通过（' + (fileGroup.scan_error || '') + '）';
+                } else {
+                    scanStatusValue.textContent = '已通过';
+                }
+            }
+            
             // 更新下载历史
             const historyTableBody = document.querySelector('.history-panel .file-table tbody');
             if (historyTableBody) {
@@ -497,6 +643,108 @@ document.addEventListener('DOMContentLoaded', function() {
                     historyTableBody.appendChild(row);
                 }
             }
+            
+            // 只保留最近的下载记录，更早的记录体现在按文件统计中
+            const historyNote = document.getElementById('history-note');
+            if (historyNote) {
+                const shown = fileGroup.download_history ? fileGroup.download_history.length : 0;
+                historyNote.textContent = '仅显示最近 ' + shown + ' 条下载记录';
+                historyNote.classList.toggle('hide', fileGroup.download_count <= shown);
+            }
+            
+            // 更新按文件统计
+            const summaryTableBody = document.querySelector('#summary-table tbody');
+            if (summaryTableBody) {
+                summaryTableBody.innerHTML = '';
+                const summary = fileGroup.download_summary || [];
+                summary.forEach(item => {
+                    const row = document.createElement('tr');
+                    [item.filename, item.count, item.last_time ? item.last_time.replace('T', ' ').substring(0, 16) : ''].forEach(value => {
+                        const cell = document.createElement('td');
+                        cell.textContent = value;
+                        row.appendChild(cell);
+                    });
+                    summaryTableBody.appendChild(row);
+                });
+                if (summary.length === 0) {
+                    const row = document.createElement('tr');
+                    const cell = document.createElement('td');
+                    cell.textContent = '暂无下载记录';
+                    cell.className = 'no-data';
+                    cell.setAttribute('colspan', '3');
+                    row.appendChild(cell);
+                    summaryTableBody.appendChild(row);
+                }
+            }
+        }
+        
+        // 把一条下载事件合并到当前数据中
+        function applyDownload(download) {
+            currentGroup.download_count += 1;
+            const history = currentGroup.download_history || (currentGroup.download_history = []);
+            history.push(download);
+            if (historyLimit && history.length > historyLimit) {
+                history.splice(0, history.length - historyLimit);
+            }
+            const summary = currentGroup.download_summary || (currentGroup.download_summary = []);
+            const filename = download.filename || '';
+            let item = summary.find(entry => entry.filename === filename);
+            if (!item) {
+                item = { filename: filename, count: 0, last_time: null };
+                summary.push(item);
+            }
+            item.count += 1;
+            item.last_time = download.time;
+            summary.sort((a, b) => b.count - a.count || (a.filename < b.filename ? -1 : a.filename > b.filename ? 1 : 0));
+        }
+        
+        function setLiveStatus(text, isError) {
+            if (!liveStatus) return;
+            liveStatus.textContent = text;
+            liveStatus.classList.toggle('error', !!isError);
+        }
+        
+        // 实时更新：服务器推送下载记录、检查结果和删除，断线后浏览器自动重连并补发错过的事件
+        function connectEvents() {
+            const query = lastEventId ? `?last_event_id=${encodeURIComponent(lastEventId)}` : '';
+            eventSource = new EventSource(`/api/file-group/${fileGroupId}/events${query}`);
+            
+            eventSource.addEventListener('open', () => setLiveStatus('实时更新中'));
+            
+            eventSource.addEventListener('snapshot', event => {
+                lastEventId = event.lastEventId;
+                const data = JSON.parse(event.data);
+                currentGroup = data.file_group;
+                historyLimit = data.history_limit;
+                updatePageWithNewData(currentGroup);
+                updateLastRefreshTime();
+            });
+            
+            eventSource.addEventListener('download', event => {
+                lastEventId = event.lastEventId;
+                if (!currentGroup) return;
+                applyDownload(JSON.parse(event.data));
+                updatePageWithNewData(currentGroup);
+                updateLastRefreshTime();
+            });
+            
+            eventSource.addEventListener('removed', event => {
+                eventSource.close();
+                const data = JSON.parse(event.data);
+                setLiveStatus(data.reason === 'deleted' ? '文件组已被删除' : '文件组已过期或已失效', true);
+                if (refreshButton) refreshButton.disabled = true;
+                deleteButton.disabled = true;
+            });
+            
+            eventSource.addEventListener('error', () => {
+                if (eventSource.readyState === EventSource.CLOSED) {
+                    // 服务器拒绝了连接（例如连接数已满），稍后重新连接
+                    setLiveStatus('实时更新暂不可用，30秒后重试', true);
+                    setTimeout(connectEvents, 30000);
+                } else {
+                    setLiveStatus('连接中断，正在重新连接...', true);
+                }
+            });
         }
         
         // 手动刷新按钮
@@ -505,43 +753,8 @@ document.addEventListener('DOMContentLoaded', function() {
                 refreshPageData();
             });
         }
-          // 自动刷新切换
-        if (autoRefreshCheckbox) {
-            autoRefreshCheckbox.addEventListener('change', function() {
-                if (this.checked) {
-                    // 开启自动刷新（增加到60秒一次，减少服务器负载）
-                    autoRefreshInterval = setInterval(refreshPageData, 60000);
-                    localStorage.setItem('autoRefresh', 'true');
-                    
-                    // 显示刷新状态
-                    if (lastUpdateTime) {
-                        lastUpdateTime.parentElement.innerHTML += ' <span class="refresh-note">(每分钟自动刷新)</span>';
-                    }
-                } else {
-                    // 关闭自动刷新
-                    if (autoRefreshInterval) {
-                        clearInterval(autoRefreshInterval);
-                        autoRefreshInterval = null;
-                    }
-                    localStorage.setItem('autoRefresh', 'false');
-                    
-                    // 移除刷新状态提示
-                    const refreshNote = document.querySelector('.refresh-note');
-                    if (refreshNote) {
-                        refreshNote.remove();
-                    }
-                }
-            });
-            
-            // 只在管理页面才开启自动刷新
-            if (window.location.pathname.includes('/manage/') && localStorage.getItem('autoRefresh') === 'true') {
-                autoRefreshCheckbox.checked = true;
-                autoRefreshCheckbox.dispatchEvent(new Event('change'));
-            } else {
-                // 默认不开启自动刷新
-                autoRefreshCheckbox.checked = false;
-            }
-        }
+        
+        connectEvents();
         
         // 初始化时更新刷新时间
         updateLastRefreshTime();
@@ -0,0 +1,221 @@
+"""
+上传下载的带宽整形与公平分配（进程内）
+
+- 令牌桶限速：每个客户端（IP）、每个文件组，以及全局，上传和下载分别计算
+- 全局带宽按正在传输的客户端平分（近似公平排队）：新开始的小文件下载立即得到与大文件相同的份额，
+  使用多连接下载器的客户端所有连接合用一份
+- 限制每个客户端同时进行的传输数
+- 令牌桶允许透支，传输每发送一块就预扣相应的字节数并返回需要等待的时间，等待在锁外进行；
+  异步服务器（asgi.py）不在线程中等待，取出累计的等待时间后在协程中等待
+"""
+import collections
+import math
+import threading
+import time
+
+# 客户端速率按最近若干秒的传输量计算
+RATE_WINDOW_SECONDS = 5
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def set_rate(self, rate, burst):
+        with self.lock:
+            self.refill(time.monotonic())
+            self.rate = rate
+            self.burst = burst
+            self.tokens = min(self.tokens, burst)
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, nbytes):
+        """扣除 nbytes，返回余额恢复到不为负所需的秒数"""
+        with self.lock:
+            self.refill(time.monotonic())
+            self.tokens -= nbytes
+            return -self.tokens / self.rate if self.tokens < 0 else 0
+
+class RateMeter:
+    """按秒累计传输量"""
+    def __init__(self):
+        self.seconds = collections.deque()  # [(秒, 字节数)]
+        self.total = 0
+
+    def add(self, nbytes, now=None):
+        second = int(now or time.time())
+        if self.seconds and self.seconds[-1][0] == second:
+            self.seconds[-1][1] += nbytes
+        else:
+            self.seconds.append([second, nbytes])
+            while self.seconds[0][0] <= second - RATE_WINDOW_SECONDS:
+                self.seconds.popleft()
+        self.total += nbytes
+
+    def rate(self, now=None):
+        cutoff = int(now or time.time()) - RATE_WINDOW_SECONDS
+        return sum(nbytes for second, nbytes in self.seconds if second > cutoff) / RATE_WINDOW_SECONDS
+
+class ClientState:
+    def __init__(self):
+        self.transfers = 0
+        self.bucket = None
+        self.meter = RateMeter()
+        self.idle_since = None
+
+class Transfer:
+    """一个进行中的上传或下载"""
+    def __init__(self, scheduler, client, group, direction, defer, throttled):
+        self.scheduler = scheduler
+        self.client = client
+        self.group = group
+        self.direction = direction
+        self.defer = defer
+        self.throttled = throttled
+        self.delay = 0.0
+        self.closed = False
+
+    def throttle(self, nbytes):
+        """计入 nbytes 并按限速等待；defer 为 True 时只累计等待时间，由调用方取出"""
+        if not self.throttled:
+            return
+        wait = self.scheduler.reserve(self, nbytes)
+        if self.defer:
+            self.delay += wait
+        elif wait:
+            time.sleep(wait)
+
+    def record(self, nbytes):
+        # 由服务器直接发送（sendfile）的数据只计入速率统计
+        self.scheduler.reserve(self, nbytes, shape=False)
+
+    def take_delay(self):
+        delay, self.delay = self.delay, 0.0
+        return delay
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.scheduler.close(self)
+
+class TransferScheduler:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clients = {}  # (方向, 客户端) -> ClientState
+        self.groups = {}  # (方向, 文件组ID) -> [传输数, TokenBucket]
+        self.connections = collections.Counter()  # 客户端 -> 上传和下载的传输数之和
+        self.configure()
+
+    def configure(self, global_rate=0, client_rate=0, group_rate=0, max_connections=0, burst_seconds=1):
+        """速率单位为字节/秒，0 表示不限制"""
+        with self.lock:
+            self.global_rate = global_rate
+            self.client_rate = client_rate
+            self.group_rate = group_rate
+            self.max_connections = max_connections
+            self.burst_seconds = burst_seconds
+            for direction in ('upload', 'download'):
+                self.rebalance(direction)
+
+    @property
+    def shaping(self):
+        return bool(self.global_rate or self.client_rate or self.group_rate)
+
+    def reset(self):
+        # fork出的进程不沿用父进程的传输状态
+        with self.lock:
+            self.clients = {}
+            self.groups = {}
+            self.connections = collections.Counter()
+
+    def client_share(self, direction):
+        # 客户端的限速：自身上限与全局带宽平分给正在传输的客户端后的份额中较小者
+        active = sum(1 for (d, _), state in self.clients.items() if d == direction and state.transfers)
+        share = self.global_rate / max(active, 1) if self.global_rate else math.inf
+        return min(self.client_rate or math.inf, share)
+
+    def rebalance(self, direction):
+        # 正在传输的客户端数量变化后调整各客户端的份额
+        rate = self.client_share(direction)
+        for (d, _), state in self.clients.items():
+            if d != direction:
+                continue
+            if rate == math.inf:
+                state.bucket = None
+            elif state.bucket is None:
+                state.bucket = TokenBucket(rate, rate * self.burst_seconds)
+            else:
+                state.bucket.set_rate(rate, rate * self.burst_seconds)
+
+    def open(self, client, group, direction, defer=False, throttled=True):
+        """开始一个传输，客户端同时进行的传输数已达上限时返回 None"""
+        with self.lock:
+            if self.max_connections and self.connections[client] >= self.max_connections:
+                return None
+            self.connections[client] += 1
+            state = self.clients.get((direction, client))
+            if state is None:
+                state = self.clients[(direction, client)] = ClientState()
+            state.transfers += 1
+            state.idle_since = None
+            if state.transfers == 1:
+                self.rebalance(direction)
+            if group is not None and self.group_rate:
+                entry = self.groups.get((direction, group))
+                if entry is None:
+                    entry = self.groups[(direction, group)] = [
+                        0, TokenBucket(self.group_rate, self.group_rate * self.burst_seconds)]
+                entry[0] += 1
+            self.prune()
+        return Transfer(self, client, group, direction, defer, throttled)
+
+    def close(self, transfer):
+        with self.lock:
+            self.connections[transfer.client] -= 1
+            if self.connections[transfer.client] <= 0:
+                del self.connections[transfer.client]
+            state = self.clients.get((transfer.direction, transfer.client))
+            if state is not None:
+                state.transfers -= 1
+                if not state.transfers:
+                    state.idle_since = time.time()
+                    self.rebalance(transfer.direction)
+            entry = self.groups.get((transfer.direction, transfer.group))
+            if entry is not None:
+                entry[0] -= 1
+                if not entry[0]:
+                    del self.groups[(transfer.direction, transfer.group)]
+
+    def prune(self):
+        # 空闲超过速率统计窗口的客户端不再保留
+        cutoff = time.time() - RATE_WINDOW_SECONDS
+        idle = [key for key, state in self.clients.items()
+                if not state.transfers and state.idle_since is not None and state.idle_since < cutoff]
+        for key in idle:
+            del self.clients[key]
+
+    def reserve(self, transfer, nbytes, shape=True):
+        with self.lock:
+            state = self.clients.get((transfer.direction, transfer.client))
+            entry = self.groups.get((transfer.direction, transfer.group))
+            if state is not None:
+                state.meter.add(nbytes)
+            buckets = [state.bucket if state is not None else None, entry[1] if entry is not None else None]
+        if not shape:
+            return 0
+        return max((bucket.reserve(nbytes) for bucket in buckets if bucket is not None), default=0)
+
+    def snapshot(self):
+        """各客户端当前的传输数和速率（字节/秒）"""
+        now = time.time()
+        with self.lock:
+            self.prune()
+            return [{'client': client, 'direction': direction, 'transfers': state.transfers,
+                     'rate': state.meter.rate(now), 'bytes': state.meter.total}
+                    for (direction, client), state in sorted(self.clients.items())]